@@ -0,0 +1,65 @@
+# Benchmark for the HDF5 cache presets: the equivalent of "aptool ls -l"
+# on a paper with many small items, and a calclet doing random slicing
+# in a large chunked dataset.
+#
+# Usage: python cache_settings.py [number_of_items]
+
+import os
+import sys
+import time
+
+import numpy as np
+import tempdir
+
+from activepapers.storage import ActivePaper, cache_presets
+from activepapers.utility import datatype
+
+
+def make_paper(filename, nitems, preset):
+    paper = ActivePaper(filename, 'w', libver='latest', cache=preset)
+    for i in range(nitems):
+        paper.data.create_dataset('small/item%d' % i, data=i)
+    paper.data.create_dataset('large', shape=(4000, 4000), dtype=np.float64,
+                              chunks=(100, 100), compression='gzip')
+    large = paper.data['large']
+    for i in range(0, 4000, 500):
+        large[i:i+500] = np.random.random((500, 4000))
+    paper.create_calclet('slicing',
+"""
+from activepapers.contents import data
+import numpy as np
+large = data['large']
+total = 0.
+for i, j in np.random.RandomState(0).randint(0, 3900, (2000, 2)):
+    total += large[i:i+50, j:j+50].sum()
+data['total'] = total
+""")
+    paper.close()
+
+def ls_long(filename, preset):
+    with ActivePaper(filename, 'r', cache=preset) as paper:
+        for item in paper.iter_items():
+            datatype(item)
+            item.attrs.get('ACTIVE_PAPER_TIMESTAMP', None)
+            paper.is_stale(item)
+
+def run_calclet(filename, preset):
+    with ActivePaper(filename, 'r+', cache=preset) as paper:
+        assert paper.run_codelet('slicing') is None
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time()-start
+
+def run(nitems):
+    with tempdir.TempDir() as t:
+        for preset in sorted(cache_presets):
+            filename = os.path.join(t, preset + '.ap')
+            make_paper(filename, nitems, preset)
+            print("%-14s  ls -l %7.3f s  random slicing %7.3f s"
+                  % (preset, timed(ls_long, filename, preset),
+                     timed(run_calclet, filename, preset)))
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,55 @@
+# Benchmark for the HDF5 file format used for papers:
+# lookup and listing of a data group with many members,
+# in the default (earliest) format and in the latest format.
+#
+# Usage: python group_format.py [number_of_items]
+
+import os
+import random
+import sys
+import time
+
+import tempdir
+
+from activepapers.storage import ActivePaper
+
+
+def make_paper(filename, nitems, libver):
+    paper = ActivePaper(filename, 'w', libver=libver)
+    group = paper.data_group
+    for i in range(nitems):
+        group.create_dataset('item%d' % i, data=i)
+    paper.close()
+
+def timed(function, *args):
+    start = time.time()
+    result = function(*args)
+    return time.time()-start, result
+
+def list_items(filename):
+    with ActivePaper(filename, 'r') as paper:
+        return len(list(paper.data_group))
+
+def look_up_items(filename, names):
+    with ActivePaper(filename, 'r') as paper:
+        group = paper.data_group
+        for name in names:
+            group[name].attrs.get('ACTIVE_PAPER_TIMESTAMP')
+
+def run(nitems):
+    random.seed(42)
+    names = ['item%d' % random.randrange(nitems) for i in range(1000)]
+    with tempdir.TempDir() as t:
+        for libver in ['earliest', 'latest']:
+            filename = os.path.join(t, libver + '.ap')
+            t_create, _ = timed(make_paper, filename, nitems, libver)
+            t_list, n = timed(list_items, filename)
+            t_lookup, _ = timed(look_up_items, filename, names)
+            assert n == nitems
+            print("%-8s  create %7.3f s  list %7.3f s  "
+                  "1000 lookups %7.3f s  size %d bytes"
+                  % (libver, t_create, t_list, t_lookup,
+                     os.path.getsize(filename)))
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
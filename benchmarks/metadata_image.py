@@ -0,0 +1,48 @@
+# Benchmark for the metadata image: repeated opens of a paper with
+# many items, each followed by the equivalent of "aptool ls -l",
+# as done by short-lived processes working on the same paper.
+#
+# Usage: python metadata_image.py [number_of_items [number_of_opens]]
+
+import os
+import sys
+import time
+
+import tempdir
+
+from activepapers.storage import ActivePaper
+
+
+def make_paper(filename, nitems, metadata_image):
+    paper = ActivePaper(filename, 'w', libver='latest',
+                        metadata_image=metadata_image)
+    for i in range(nitems):
+        paper.data.create_dataset('group%d/item%d' % (i % 100, i), data=i)
+    paper.close()
+
+def ls_long(filename):
+    with ActivePaper(filename, 'r') as paper:
+        items = [item for item in paper.item_metadata() if item.is_item]
+        mod_times = dict((item.name, item.timestamp) for item in items)
+        for item in items:
+            any(mod_times[dep] > item.timestamp for dep in item.dependencies)
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time()-start
+
+def run(nitems, nopens):
+    with tempdir.TempDir() as t:
+        for metadata_image in [False, True]:
+            filename = os.path.join(t, 'paper%d.ap' % metadata_image)
+            make_paper(filename, nitems, metadata_image)
+            times = [timed(ls_long, filename) for i in range(nopens)]
+            print("metadata image %-5s  first open %7.3f s  "
+                  "average of %d opens %7.3f s"
+                  % (metadata_image, times[0], nopens,
+                     sum(times)/len(times)))
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 5)
@@ -0,0 +1,434 @@
+# Static prediction of the dependencies of calclets.
+#
+# The dependencies of a calclet are recorded when it runs, so they
+# are unknown for calclets that have never been run, and outdated for
+# calclets that have been modified since. This module predicts them
+# from the calclet's source code. It recognizes
+#  - data['name'] and the creation methods of groups
+#    (create_dataset, create_group, ...) with literal names,
+#    also for subgroups assigned to variables,
+#  - open(...) and open_documentation(...) with literal file names,
+#  - code['name'] with literal names,
+#  - imports of modules stored in the paper,
+# where data, open, open_documentation, and code are imported
+# from activepapers.contents. Names computed at run time cannot be
+# predicted, so a prediction can be incomplete. Predictions are
+# checked against the tracked dependencies after a calclet has run,
+# see mismatches().
+
+import ast
+import collections
+import posixpath
+
+import h5py
+
+from activepapers.utility import ascii, utf8, isstring, datatype, owner
+
+Prediction = collections.namedtuple('Prediction',
+                                    ['reads', 'writes', 'modules',
+                                     'complete'])
+
+_creation_methods = frozenset(['create_dataset', 'require_dataset',
+                               'create_group', 'require_group',
+                               'create_appendable', 'require_appendable'])
+
+_group_methods = frozenset(['create_group', 'require_group'])
+
+
+def _literal(node):
+    # The value of a string literal, or None.
+    if hasattr(ast, 'Index') and isinstance(node, ast.Index):
+        node = node.value
+    if isinstance(node, ast.Constant) and isstring(node.value):
+        return node.value
+    if hasattr(ast, 'Str') and isinstance(node, ast.Str):
+        return node.s
+    return None
+
+def _is_string_key(node):
+    # True if a subscript can be a name rather than an index.
+    if hasattr(ast, 'Index') and isinstance(node, ast.Index):
+        node = node.value
+    return not isinstance(node, (ast.Slice, ast.Tuple)) \
+           and not (isinstance(node, ast.Constant)
+                    and not isstring(node.value))
+
+def _section(path):
+    # '/data' for '/data/a/b'
+    return '/' + path.split('/')[1]
+
+def _join(group, name, section):
+    if name.startswith('/'):
+        return posixpath.normpath(section + name)
+    return posixpath.normpath(posixpath.join(group, name))
+
+
+class _Analyzer(ast.NodeVisitor):
+
+    def __init__(self):
+        self.reads = set()
+        self.writes = set()
+        self.modules = set()
+        self.complete = True
+        # Names referring to activepapers.contents
+        self.contents = set()
+        # Names referring to groups, with the group's path and a flag
+        # saying if it is certainly a group rather than a dataset
+        self.groups = {}
+        # Names referring to the file opening functions
+        self.openers = {}
+
+    def _contents_attribute(self, node):
+        # Return the attribute of activepapers.contents that node
+        # refers to, or None.
+        if isinstance(node, ast.Name):
+            return None
+        if isinstance(node, ast.Attribute):
+            value = node.value
+            if isinstance(value, ast.Name) and value.id in self.contents:
+                return node.attr
+            if isinstance(value, ast.Attribute) \
+               and isinstance(value.value, ast.Name) \
+               and value.value.id in self.contents \
+               and value.attr == 'contents':
+                # import activepapers; activepapers.contents.data
+                return node.attr
+        return None
+
+    def _group(self, node):
+        # Return the path and certainty of the group that node
+        # refers to, or None.
+        if isinstance(node, ast.Name):
+            return self.groups.get(node.id, None)
+        attr = self._contents_attribute(node)
+        if attr == 'data':
+            return '/data', True
+        if attr == 'code':
+            return '/code', True
+        if attr == 'output':
+            return '/output', True
+        if isinstance(node, ast.Subscript):
+            group = self._group(node.value)
+            name = _literal(node.slice)
+            if group is not None and name is not None:
+                return _join(group[0], name, _section(group[0])), False
+        if isinstance(node, ast.Call) \
+           and isinstance(node.func, ast.Attribute) \
+           and node.func.attr in _group_methods:
+            group = self._group(node.func.value)
+            name = node.args and _literal(node.args[0])
+            if group is not None and name:
+                return _join(group[0], name, '/data'), True
+        return None
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            if alias.name == 'activepapers.contents':
+                self.contents.add(alias.asname or 'activepapers')
+            elif alias.name == 'activepapers':
+                self.contents.add(alias.asname or 'activepapers')
+            else:
+                self.modules.add(alias.name)
+
+    def visit_ImportFrom(self, node):
+        if node.level:
+            return
+        if node.module == 'activepapers.contents':
+            for alias in node.names:
+                name = alias.asname or alias.name
+                if alias.name == 'data':
+                    self.groups[name] = ('/data', True)
+                elif alias.name == 'code':
+                    self.groups[name] = ('/code', True)
+                elif alias.name == 'output':
+                    # Resolved by predict()
+                    self.groups[name] = ('/output', True)
+                elif alias.name == 'open':
+                    self.openers[name] = '/data'
+                elif alias.name == 'open_documentation':
+                    self.openers[name] = '/documentation'
+        elif node.module == 'activepapers':
+            for alias in node.names:
+                if alias.name == 'contents':
+                    self.contents.add(alias.asname or alias.name)
+        elif node.module is not None:
+            self.modules.add(node.module)
+
+    def visit_Assign(self, node):
+        self.visit(node.value)
+        for target in node.targets:
+            self.visit(target)
+            if isinstance(target, ast.Name):
+                group = self._group(node.value)
+                if group is None:
+                    self.groups.pop(target.id, None)
+                else:
+                    self.groups[target.id] = group
+
+    def visit_Subscript(self, node):
+        group = self._group(node.value)
+        if group is not None:
+            path, certain = group
+            name = _literal(node.slice)
+            if name is None:
+                if certain and _is_string_key(node.slice):
+                    self.complete = False
+            else:
+                path = _join(path, name, _section(path))
+                if isinstance(node.ctx, ast.Store):
+                    self.writes.add(path)
+                elif isinstance(node.ctx, ast.Load):
+                    self.reads.add(path)
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        func = node.func
+        opener = None
+        if isinstance(func, ast.Name):
+            opener = self.openers.get(func.id, None)
+        else:
+            attr = self._contents_attribute(func)
+            opener = {'open': '/data',
+                      'open_documentation': '/documentation'}.get(attr, None)
+        if opener is not None:
+            self._open(node, opener)
+        elif isinstance(func, ast.Attribute) \
+             and func.attr in _creation_methods | set(['get']):
+            group = self._group(func.value)
+            if group is not None:
+                name = node.args and _literal(node.args[0])
+                if not name:
+                    self.complete = False
+                elif func.attr == 'get':
+                    self.reads.add(_join(group[0], name, '/data'))
+                else:
+                    self.writes.add(_join(group[0], name, '/data'))
+        self.generic_visit(node)
+
+    def _open(self, node, section):
+        path = node.args and _literal(node.args[0])
+        mode = 'r'
+        if len(node.args) > 1:
+            mode = _literal(node.args[1])
+        for keyword in node.keywords:
+            if keyword.arg == 'mode':
+                mode = _literal(keyword.value)
+        if not path or mode is None:
+            self.complete = False
+            return
+        path = _join(section, path, section)
+        if mode[0] in 'ra':
+            self.reads.add(path)
+        if mode[0] in 'wa':
+            self.writes.add(path)
+
+
+def analyze(source):
+    """
+    :param source: the source code of a calclet
+    :type source: str
+    :return: the paths the calclet reads and writes, the names of the
+             modules it imports, and a flag saying if the prediction is
+             complete, i.e. if all names are literals
+    :rtype: Prediction
+    """
+    analyzer = _Analyzer()
+    analyzer.visit(ast.parse(source))
+    return Prediction(frozenset(analyzer.reads), frozenset(analyzer.writes),
+                      frozenset(analyzer.modules), analyzer.complete)
+
+#
+# Predictions in the context of a paper
+#
+
+def _item_path(paper, path):
+    # Return the path of the item containing path, or None if path
+    # is a group that is not an item. Paths that don't exist are
+    # returned unchanged.
+    parts = path.split('/')
+    for i in range(3, len(parts)+1):
+        node = paper.get_node('/'.join(parts[:i]))
+        if node is None:
+            return path
+        if datatype(node) == 'data' and isinstance(node, h5py.Group):
+            # A data item
+            return node.name
+    if isinstance(node, h5py.Group):
+        return None
+    return path
+
+def _top_level(paths):
+    # Remove the paths that are inside other paths.
+    return frozenset(path for path in paths
+                     if not any(path.startswith(other + '/')
+                                for other in paths))
+
+def predict(paper, calclet):
+    """
+    :param paper: an open ActivePaper
+    :param calclet: the path of a calclet
+    :type calclet: str
+    :return: the predicted dependencies of the calclet. The reads
+             are the items as recorded in ACTIVE_PAPER_DEPENDENCIES,
+             including the modules stored in the paper, the writes
+             are the items the calclet creates.
+    :rtype: Prediction
+    """
+    node = paper.get_node(calclet)
+    prediction = analyze(utf8(node[...].flat[0]))
+    # activepapers.contents.output is /data, except for parameter
+    # sweeps, whose instances write to subgroups of one group.
+    output = '/data'
+    table = paper.parameter_table(calclet)
+    if table is not None:
+        output = paper.sweep_group_name(calclet)
+    def resolve(path):
+        if path == '/output' or path.startswith('/output/'):
+            if table is not None:
+                # The row is not known statically.
+                return output
+            return output + path[7:]
+        return path
+    prediction = prediction._replace(
+                     reads=frozenset(resolve(p) for p in prediction.reads),
+                     writes=frozenset(resolve(p) for p in prediction.writes))
+    reads = set()
+    if table is not None:
+        reads.add(table.name)
+    for path in prediction.reads:
+        if path.startswith('/code/'):
+            reads.add(path)
+        else:
+            item = _item_path(paper, path)
+            if item is not None:
+                reads.add(item)
+    modules = set()
+    for name in prediction.modules:
+        module = paper.get_local_module(name)
+        if module is None:
+            continue
+        if datatype(module) != 'module':
+            module = module.get('__init__', None)
+        if module is not None and module.in_paper(paper):
+            modules.add(module.name)
+    return Prediction(frozenset(reads | modules),
+                      _top_level(prediction.writes),
+                      frozenset(modules), prediction.complete)
+
+def tracked(paper, calclet):
+    """
+    :param paper: an open ActivePaper
+    :param calclet: the path of a calclet
+    :type calclet: str
+    :return: the dependencies recorded during the calclet's last
+             run, in the same form as those returned by predict(),
+             or None if the calclet has no outputs
+    :rtype: Prediction
+    """
+    owned = [name for name in paper.owned_by(calclet)
+             if not name.startswith('/code/')]
+    if not owned:
+        return None
+    writes = owned
+    if paper.parameter_table(calclet) is not None:
+        # The outputs of all instances of a parameter sweep.
+        sweep = paper.sweep_group_name(calclet)
+        writes = [sweep if name.startswith(sweep + '/') else name
+                  for name in owned]
+    reads = set()
+    for name in owned:
+        for dep in paper.get_node(name).attrs.get(
+                       'ACTIVE_PAPER_DEPENDENCIES', []):
+            dep = ascii(dep)
+            if dep == calclet:
+                continue
+            node = paper.get_node(dep)
+            if node is not None \
+               and datatype(node) in ['calclet', 'importlet']:
+                continue
+            reads.add(dep)
+    modules = frozenset(dep for dep in reads
+                        if dep.startswith('/code/python-packages/'))
+    return Prediction(frozenset(reads), frozenset(writes), modules, True)
+
+def mismatches(paper, calclet):
+    """
+    Compare the predicted dependencies of a calclet to those
+    recorded during its last run.
+
+    :param paper: an open ActivePaper
+    :param calclet: the path of a calclet
+    :type calclet: str
+    :return: None if the calclet has no outputs, or else a dictionary
+             with the keys 'unpredicted_reads', 'unpredicted_writes'
+             (dependencies that were not predicted), 'unused_reads',
+             and 'unused_writes' (predictions that did not happen),
+             whose values are sorted lists of paths, and the key
+             'complete' (the completeness of the prediction)
+    :rtype: dict
+    """
+    actual = tracked(paper, calclet)
+    if actual is None:
+        return None
+    predicted = predict(paper, calclet)
+    # Code items are not recorded as dependencies.
+    predicted_reads = set(path for path in predicted.reads
+                          if not path.startswith('/code/')
+                          or path in predicted.modules)
+    # Reading back its own outputs is not a dependency.
+    own = predicted.writes | actual.writes
+    return dict(
+        unpredicted_reads=sorted(actual.reads - predicted_reads - own),
+        unused_reads=sorted(predicted_reads - actual.reads - own),
+        unpredicted_writes=sorted(actual.writes - predicted.writes),
+        unused_writes=sorted(predicted.writes - actual.writes),
+        complete=predicted.complete)
+
+def _overlap(paths1, paths2):
+    return any(p1 == p2 or p1.startswith(p2 + '/') or p2.startswith(p1 + '/')
+               for p1 in paths1 for p2 in paths2)
+
+def schedule(paper, calclets):
+    """
+    Order calclets according to their dependencies, using the
+    dependencies recorded during their last run if there is one,
+    and the predicted ones otherwise.
+
+    :param paper: an open ActivePaper
+    :param calclets: the paths of the calclets
+    :type calclets: list
+    :return: a list of stages, each of which is a list of calclets
+             that don't depend on each other and can be run at the
+             same time, after those of the preceding stages. A
+             calclet whose prediction is incomplete may read or
+             write anything, so it is alone in its stage, after
+             the stages of the other calclets that are ready.
+    :rtype: list
+    """
+    calclets = sorted(calclets)
+    deps = {}
+    for calclet in calclets:
+        deps[calclet] = tracked(paper, calclet) or predict(paper, calclet)
+    before = dict((calclet, set()) for calclet in calclets)
+    for i, c1 in enumerate(calclets):
+        for c2 in calclets[i+1:]:
+            if _overlap(deps[c1].writes, deps[c2].reads):
+                before[c2].add(c1)
+            if _overlap(deps[c2].writes, deps[c1].reads):
+                before[c1].add(c2)
+            if _overlap(deps[c1].writes, deps[c2].writes) \
+               and c1 not in before[c2] and c2 not in before[c1]:
+                # Calclets writing the same items must not run at
+                # the same time.
+                before[c2].add(c1)
+    stages = []
+    done = set()
+    while len(done) < len(calclets):
+        ready = [c for c in calclets
+                 if c not in done and before[c] <= done]
+        if not ready:
+            raise ValueError("cyclic dependencies")
+        stage = [c for c in ready if deps[c].complete] or ready[:1]
+        stages.append(stage)
+        done.update(stage)
+    return stages
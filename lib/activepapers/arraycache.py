@@ -0,0 +1,135 @@
+# An in-memory cache of complete datasets, shared by codelets.
+#
+# When many calclets read the same input, as happens during
+# "aptool update" or ActivePaper.rebuild(), an ArrayCache passed to
+# the papers (argument array_cache of ActivePaper) avoids reading and
+# decompressing it again for each calclet. Only reads of complete
+# datasets through DatasetWrapper.__getitem__ use the cache.
+#
+# Entries are keyed by file name, dataset path, and timestamp, so
+# a dataset that has been modified and stamped since it was cached is
+# read again. Writes through a DatasetWrapper also remove the entries
+# for the dataset immediately. The cached arrays are shared by all
+# readers and therefore returned read-only. Codelets that modify
+# the arrays they read must make a copy. Arrays larger than the
+# cache are neither cached nor made read-only.
+#
+# The cache is bounded by the total size of the cached arrays. When
+# a new array does not fit, the least recently used ones are removed.
+
+import collections
+import os
+import threading
+
+
+def is_full_read(item):
+    """
+    :param item: an index expression as passed to __getitem__
+    :return: True if the expression selects a complete dataset
+             in its original shape
+    :rtype: bool
+    """
+    if not isinstance(item, tuple):
+        item = (item,)
+    return all(i is Ellipsis
+               or (isinstance(i, slice) and i == slice(None))
+               for i in item)
+
+
+class ArrayCache(object):
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: the maximal total size of the cached arrays
+        :type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, ds):
+        """
+        :param ds: an HDF5 dataset
+        :type ds: h5py.Dataset
+        :return: the key for the current contents of the dataset,
+                 or None if the dataset cannot be cached
+        """
+        t = ds.attrs.get('ACTIVE_PAPER_TIMESTAMP', None)
+        if t is None or ds.shape == () or ds.dtype.kind not in 'biufcS':
+            return None
+        return (os.path.abspath(ds.file.filename), ds.name, float(t))
+
+    def read(self, ds):
+        """
+        :param ds: an HDF5 dataset
+        :type ds: h5py.Dataset
+        :return: the complete contents of the dataset
+        :rtype: numpy.ndarray
+        """
+        key = self.key(ds)
+        if key is None:
+            return ds[...]
+        with self._lock:
+            array = self._entries.get(key, None)
+            if array is not None:
+                self._entries.pop(key)
+                self._entries[key] = array
+                self.hits += 1
+                return array
+            self.misses += 1
+        array = ds[...]
+        if array.nbytes <= self.max_bytes:
+            array.flags.writeable = False
+            self._add(key, array)
+        return array
+
+    def _add(self, key, array):
+        with self._lock:
+            if key in self._entries:
+                return
+            while self._entries \
+                  and self.nbytes + array.nbytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self.nbytes -= old.nbytes
+                self.evictions += 1
+            self._entries[key] = array
+            self.nbytes += array.nbytes
+
+    def invalidate(self, ds):
+        """
+        Remove all entries for a dataset.
+
+        :param ds: an HDF5 dataset
+        :type ds: h5py.Dataset
+        """
+        filename = os.path.abspath(ds.file.filename)
+        with self._lock:
+            for key in [k for k in self._entries
+                        if k[0] == filename and k[1] == ds.name]:
+                self.nbytes -= self._entries.pop(key).nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def statistics(self):
+        """
+        :return: the number of hits, misses, and evictions, the hit
+                 rate, and the number and total size of the entries
+        :rtype: dict
+        """
+        with self._lock:
+            reads = self.hits + self.misses
+            return dict(hits=self.hits, misses=self.misses,
+                        evictions=self.evictions,
+                        hit_rate=float(self.hits)/reads if reads else None,
+                        entries=len(self._entries), nbytes=self.nbytes)
+
+    def __repr__(self):
+        return "<ArrayCache %d entries, %d of %d bytes>" \
+               % (len(self._entries), self.nbytes, self.max_bytes)
@@ -0,0 +1,106 @@
+# Chunk shape analysis based on recorded access patterns.
+#
+# When access recording is enabled for a paper, every read through
+# DatasetWrapper.__getitem__ is summarized by the shape of the
+# selected region. The functions in this module estimate how much
+# data a given chunk shape forces HDF5 to read for these selections,
+# and propose chunk shapes that reduce this amount.
+
+import numpy as np
+
+import activepapers.regions
+
+# HDF5's default chunk cache holds 1 MB, and chunks larger than
+# the cache are read again for every access.
+target_chunk_bytes = 1024*1024
+
+# Every chunk read has a fixed cost (B-tree lookup, seek, filter
+# setup) that is modeled as the equivalent of reading this many bytes.
+chunk_overhead_bytes = 16*1024
+
+
+def selection_shape(shape, item):
+    """
+    :param shape: the shape of a dataset
+    :type shape: tuple
+    :param item: an index expression as passed to __getitem__
+    :return: the extent of the selected region along each axis,
+             or None if the index expression is not understood
+    :rtype: tuple
+    """
+    bounds = activepapers.regions.selection_bounds(shape, item)
+    if bounds is None:
+        return None
+    # The span covers everything HDF5 has to touch.
+    return tuple(stop-start for start, stop in bounds)
+
+def estimated_read_bytes(chunks, itemsize, selection):
+    """
+    :return: the average number of bytes read from the file for a
+             selection of the given shape at a random position,
+             including the fixed per-chunk overhead
+    :rtype: float
+    """
+    nchunks = 1.
+    for c, s in zip(chunks, selection):
+        if s == 0:
+            return 0.
+        # A block of s elements at a random offset touches
+        # (s+c-1)/c chunks of size c on average.
+        nchunks *= float(s+c-1)/c
+    chunk_bytes = itemsize*np.prod(chunks)
+    return nchunks * (chunk_bytes + chunk_overhead_bytes)
+
+def total_read_bytes(chunks, itemsize, selections):
+    """
+    :param selections: a list of (selection_shape, count) pairs
+    :return: the estimated total number of bytes read
+    """
+    return sum(count * estimated_read_bytes(chunks, itemsize, selection)
+               for selection, count in selections)
+
+def _fit_to_target(chunks, shape, itemsize):
+    chunks = list(chunks)
+    # Shrink the largest axes until the chunk fits in the cache.
+    while itemsize*np.prod(chunks) > target_chunk_bytes \
+          and max(chunks) > 1:
+        i = chunks.index(max(chunks))
+        chunks[i] = (chunks[i]+1)//2
+    return tuple(chunks)
+
+def _candidates(shape, itemsize, selections):
+    for selection, count in selections:
+        chunks = tuple(max(1, min(s, n)) for s, n in zip(selection, shape))
+        chunks = _fit_to_target(chunks, shape, itemsize)
+        yield chunks
+        # Grow the chunk along each axis that the selection covers only
+        # partially, which trades read volume for fewer chunk accesses.
+        for axis in range(len(shape)):
+            grown = list(chunks)
+            while grown[axis] < shape[axis] and \
+                  itemsize*np.prod(grown) < target_chunk_bytes/2:
+                grown[axis] = min(shape[axis], 2*grown[axis])
+                yield _fit_to_target(grown, shape, itemsize)
+
+def advise_chunks(shape, itemsize, selections, current=None):
+    """
+    :param shape: the shape of the dataset
+    :type shape: tuple
+    :param itemsize: the size of one element in bytes
+    :type itemsize: int
+    :param selections: the recorded accesses, as a list of
+                       (selection_shape, count) pairs
+    :type selections: list
+    :param current: the current chunk shape (None for contiguous storage)
+    :return: the chunk shape with the lowest estimated read volume
+    :rtype: tuple
+    """
+    shape = tuple(shape)
+    if len(shape) == 0 or 0 in shape:
+        return current
+    candidates = set(_candidates(shape, itemsize, selections))
+    if current is not None:
+        candidates.add(tuple(current))
+    cost = lambda chunks: (total_read_bytes(chunks, itemsize, selections),
+                           chunks != current, chunks)
+    return min(candidates, key=cost)
@@ -2,6 +2,7 @@
 
 import fnmatch
 import itertools as it
+import json
 import os
 import re
 import subprocess
@@ -12,9 +13,17 @@ import tempdir
 import numpy
 import h5py
 
+import activepapers.analysis
+import activepapers.arraycache
+import activepapers.chunking
+import activepapers.overlay
+import activepapers.prefetch
+import activepapers.preview
+import activepapers.regions
 import activepapers.storage
+import activepapers.workers
 from activepapers.utility import ascii, datatype, mod_time, stamp, \
-                                 timestamp, raw_input
+                                 timestamp, raw_input, owner
 
 class CLIExit(Exception):
     pass
@@ -32,6 +41,16 @@ def get_paper(input_filename):
         sys.stderr.write("no HDF5 file in current directory\n")
     raise CLIExit
 
+def open_paper(paper_name, mode, **kwargs):
+    # Overlays can be used instead of papers by most commands.
+    if not activepapers.overlay.is_overlay(paper_name):
+        return activepapers.storage.ActivePaper(paper_name, mode, **kwargs)
+    try:
+        return activepapers.overlay.OverlayPaper(paper_name, **kwargs)
+    except ValueError as exc:
+        sys.stderr.write(exc.args[0] + '\n')
+        raise CLIExit
+
 
 #
 # Support for checkin/checkout/extract
@@ -97,22 +116,24 @@ def extract_to_file(paper, item, file=None, filename=None, directory=None):
 
 def update_from_file(paper, filename, type=None,
                      force_update=False, dry_run=False,
-                     dataset_name=None, create_new=True):
+                     dataset_name=None, create_new=True,
+                     incremental=False):
     if not os.path.exists(filename):
         raise ValueError("File %s not found" % filename)
     mtime = os.path.getmtime(filename)
     basename = filename
     ext = ''
     if dataset_name is not None:
-        item = paper.file.get(dataset_name, None)
+        item = paper.get_node(dataset_name)
         if item is not None:
             basename = item.name
     else:
-        item = paper.file.get(basename, None)
+        item = paper.get_node(basename)
         if item is None:
             basename, ext = os.path.splitext(filename)
-            item = paper.file.get(basename, None)
+            item = paper.get_node(basename)
     language = file_languages.get(ext, None)
+    parameters = None
     if item is None:
         if not create_new:
             return
@@ -159,10 +180,14 @@ def update_from_file(paper, filename, type=None,
             type = datatype(item)
         if language is None:
             language = item.attrs.get('ACTIVE_PAPER_LANGUAGE', None)
+        incremental = incremental \
+                      or bool(item.attrs.get('ACTIVE_PAPER_INCREMENTAL',
+                                             False))
+        parameters = item.attrs.get('ACTIVE_PAPER_PARAMETERS', None)
         if dry_run:
             sys.stdout.write("Delete %s\n" % item.name)
         else:
-            del item.parent[item.name.split('/')[-1]]
+            del paper.get_node(item.parent.name)[item.name.split('/')[-1]]
     if dry_run:
         fulltype = type if language is None else '/'.join((type, language))
         sys.stdout.write("Create item %s of type %s from file %s\n"
@@ -172,6 +197,10 @@ def update_from_file(paper, filename, type=None,
             code = open(filename, 'rb').read().decode('utf-8')
             item = paper.store_python_code(basename[5:], code)
             stamp(item, type, {})
+            if type == 'calclet' and incremental:
+                paper.mark_incremental(item)
+            if type == 'calclet' and parameters is not None:
+                paper.set_parameter_table(item, ascii(parameters))
             timestamp(item, mtime)
         elif type in ['file', 'text']:
             f = paper.open_internal_file(basename, 'w')
@@ -194,25 +223,182 @@ def process_patterns(patterns):
                 if p is not None]
     return patterns
 
+#
+# Support for du
+#
+# All numbers are obtained from HDF5 metadata, no raw data is read.
+#
+
+def _metadata_size(node):
+    info = h5py.h5o.get_info(node.id)
+    size = info.hdr.space.total
+    meta_size = getattr(info, 'meta_size', None)
+    if meta_size is not None:
+        size += meta_size.obj.index_size + meta_size.obj.heap_size \
+                + meta_size.attr.index_size + meta_size.attr.heap_size
+    return size
+
+def dataset_usage(ds):
+    """
+    :param ds: an HDF5 dataset
+    :type ds: h5py.Dataset
+    :return: the storage statistics for the dataset
+    :rtype: dict
+    """
+    logical = int(numpy.prod(ds.shape, dtype=numpy.int64)) * ds.dtype.itemsize
+    usage = dict(logical=logical,
+                 disk=int(ds.id.get_storage_size()),
+                 metadata=_metadata_size(ds),
+                 chunks=0,
+                 chunk_capacity=0)
+    if ds.chunks is not None and hasattr(ds.id, 'get_num_chunks'):
+        nchunks = ds.id.get_num_chunks()
+        usage['chunks'] = nchunks
+        usage['chunk_capacity'] = nchunks * ds.dtype.itemsize \
+                                  * int(numpy.prod(ds.chunks))
+    return usage
+
+def node_usage(node):
+    """
+    :param node: an HDF5 dataset or group
+    :return: the storage statistics for the node, including
+             everything inside it if it is a group
+    :rtype: dict
+    """
+    if isinstance(node, h5py.Dataset):
+        return dataset_usage(node)
+    usage = dict(logical=0, disk=0, metadata=_metadata_size(node),
+                 chunks=0, chunk_capacity=0)
+    def add(name, item):
+        if isinstance(item, h5py.Dataset):
+            item_usage = dataset_usage(item)
+        else:
+            item_usage = dict(metadata=_metadata_size(item))
+        for key, value in item_usage.items():
+            usage[key] += value
+    node.visititems(add)
+    return usage
+
+def _finish_usage(name, usage):
+    entry = dict(name=name)
+    entry.update(usage)
+    capacity = entry.pop('chunk_capacity')
+    entry['ratio'] = float(entry['logical'])/entry['disk'] \
+                     if entry['disk'] > 0 else None
+    # The fill of the chunks is estimated assuming that all the data
+    # lies in allocated chunks.
+    entry['chunk_fill'] = min(1., float(entry['logical'])/capacity) \
+                          if capacity > 0 else None
+    return entry
+
+def storage_usage(paper, by='item'):
+    """
+    :param paper: an open ActivePaper
+    :param by: 'item', 'group', or 'codelet'
+    :return: a list of dictionaries, one per item, group, or codelet
+    """
+    entries = {}
+    def accumulate(name, usage):
+        total = entries.setdefault(name, dict.fromkeys(usage, 0))
+        for key, value in usage.items():
+            total[key] += value
+    for item in paper.iter_items():
+        usage = node_usage(item)
+        if by == 'item':
+            accumulate(item.name, usage)
+        elif by == 'group':
+            # Each item counts for all the groups that contain it.
+            path = item.name.split('/')[1:-1]
+            for i in range(len(path)):
+                accumulate('/' + '/'.join(path[:i+1]), usage)
+        elif by == 'codelet':
+            codelet = item.attrs.get('ACTIVE_PAPER_GENERATING_CODELET', None)
+            accumulate('<none>' if codelet is None else ascii(codelet),
+                       usage)
+        else:
+            raise ValueError("unknown grouping %s" % by)
+    return [_finish_usage(name, usage) for name, usage in entries.items()]
+
+def _format_size(nbytes):
+    for unit in ['B', 'K', 'M', 'G']:
+        if nbytes < 1024:
+            return "%d%s" % (nbytes, unit)
+        nbytes = nbytes // 1024
+    return "%dT" % nbytes
+
 #
 #  Command handlers called from argparse
 #
 
-def create(paper, d=None):
+def create(paper, d=None, libver=None, compact=False, metadata_image=False,
+           track_regions=False):
     if paper is None:
         sys.stderr.write("no paper given\n")
         raise CLIExit
-    paper = activepapers.storage.ActivePaper(paper, 'w', d)
+    paper = activepapers.storage.ActivePaper(paper, 'w', d, libver=libver,
+                                             compact=compact,
+                                             metadata_image=metadata_image
+                                                            or None,
+                                             track_regions=track_regions)
     paper.close()
 
+def upgrade(paper, libver):
+    paper = get_paper(paper)
+    activepapers.storage.upgrade(paper, libver)
+
 def ls(paper, long, type, pattern):
     paper = get_paper(paper)
-    paper = activepapers.storage.ActivePaper(paper, 'r')
+    paper = open_paper(paper, 'r')
     pattern = process_patterns(pattern)
-    for item in paper.iter_items():
+    # The metadata of all items is read at once, which is
+    # much faster for papers with a metadata image.
+    items = [item for item in paper.item_metadata() if item.is_item]
+    mod_times = dict((item.name, item.timestamp) for item in items)
+    unfinished = set(paper.checkpoints())
+    def parameter_table(item):
+        # The parameter table of an instance of a parameter sweep,
+        # which is not an ordinary dependency, and True if the
+        # instance's row has changed.
+        if item.parameter_row is None:
+            return None, False
+        return paper.check_parameter_row(item.owner, item.parameter_row)
+    def is_stale(item):
+        if item.owner in unfinished:
+            return True
+        table, changed = parameter_table(item)
+        if changed:
+            return True
+        for dep in item.dependencies:
+            if dep == table:
+                continue
+            t = mod_times.get(dep, None)
+            if t is None:
+                t = mod_time(paper.get_node(dep))
+            if t > item.timestamp:
+                return True
+        return False
+    def dirty_regions(item):
+        # The modified regions of the item's dependencies, as a string,
+        # or None if the item is not stale.
+        if not is_stale(item):
+            return None
+        table, changed = parameter_table(item)
+        if not paper.track_regions or item.owner in unfinished or changed:
+            return ''
+        dirty = paper.dirty_regions(paper.get_node(item.name))
+        dirty.pop(table, None)
+        if not dirty:
+            return None
+        return ' '.join('%s[%s]' % (path[1:],
+                                    ' '.join(activepapers.regions
+                                             .format_region(region)
+                                             for region in regions))
+                        for path, regions in sorted(dirty.items())
+                        if regions is not None)
+    for item in items:
         name = item.name[1:] # remove initial slash
-        dtype = datatype(item)
-        if item.attrs.get('ACTIVE_PAPER_DUMMY_DATASET', False):
+        dtype = item.datatype
+        if item.dummy:
             dtype = 'dummy'
         if pattern and \
            not any(p.match(name) for p in pattern):
@@ -220,16 +406,19 @@ def ls(paper, long, type, pattern):
         if type is not None and dtype != type:
             continue
         if long:
-            t = item.attrs.get('ACTIVE_PAPER_TIMESTAMP', None)
+            t = item.timestamp
             if t is None:
                 sys.stdout.write(21*" ")
             else:
                 sys.stdout.write(time.strftime("%Y-%m-%d/%H:%M:%S  ",
-                                               time.localtime(t/1000.)))
+                                               time.localtime(t)))
             field_len = len("importlet ")  # the longest data type name
             sys.stdout.write((dtype + field_len*" ")[:field_len])
-            sys.stdout.write('*' if paper.is_stale(item) else ' ')
+            dirty = dirty_regions(item)
+            sys.stdout.write(' ' if dirty is None else '*')
         sys.stdout.write(name)
+        if long and dirty:
+            sys.stdout.write('  (dirty: %s)' % dirty)
         sys.stdout.write('\n')
     paper.close()
 
@@ -312,9 +501,93 @@ def dummy(paper, force, pattern):
             raise
     paper.close()
 
+def slim_plan(paper, budget):
+    """
+    Choose the calclets whose outputs are replaced by dummies.
+    Recomputing an item requires running its calclet, so the outputs
+    of a calclet are replaced all together, and the cost of a calclet
+    is the runtime recorded during its last complete run. Calclets
+    without a recorded runtime are not considered, and neither are
+    importlets, which may depend on resources outside of the paper.
+    The calclets of existing dummies count against the budget,
+    because all of them must be run to restore the paper. Calclets
+    are chosen in the order of the number of bytes saved per second
+    of recomputation.
+
+    :param paper: an open ActivePaper
+    :param budget: the maximal estimated time, in seconds, needed for
+                   recomputing all dummy items
+    :type budget: float
+    :return: the names of the items to replace by dummies, the number
+             of bytes saved, and the estimated recomputation time
+    :rtype: tuple
+    """
+    calclets = {}
+    for item in paper.iter_items():
+        codelet = owner(item)
+        if codelet is None or not item.name.startswith('/data/'):
+            continue
+        items, dummies = calclets.setdefault(codelet, ([], []))
+        if paper.is_dummy(item):
+            dummies.append(item.name)
+        else:
+            items.append(item)
+    time_used = 0.
+    candidates = []
+    for codelet, (items, dummies) in calclets.items():
+        node = paper.file.get(codelet, None)
+        if node is None or datatype(node) != 'calclet':
+            continue
+        runtime = node.attrs.get('ACTIVE_PAPER_RUNTIME', None)
+        if dummies:
+            time_used += 0. if runtime is None else float(runtime)
+            cost = 0.
+        elif runtime is None:
+            continue
+        else:
+            cost = float(runtime)
+        if items:
+            saved = sum(node_usage(item)['disk'] for item in items)
+            candidates.append((saved, cost, [item.name for item in items]))
+    candidates.sort(key=lambda c: (c[1] > 0, -c[0]/c[1] if c[1] > 0
+                                                        else -c[0]))
+    names = []
+    total_saved = 0
+    for saved, cost, items in candidates:
+        if saved > 0 and time_used + cost <= budget:
+            names.extend(items)
+            total_saved += saved
+            time_used += cost
+    return sorted(names), total_saved, time_used
+
+def slim(paper, budget, force, dry_run):
+    paper_name = get_paper(paper)
+    with activepapers.storage.ActivePaper(paper_name, 'r') as paper:
+        names, saved, time_used = slim_plan(paper, budget)
+    if not names:
+        return
+    if dry_run or not force:
+        for name in names:
+            sys.stdout.write(name + '\n')
+        sys.stdout.write("Saves %s, estimated recomputation time %.1f s\n"
+                         % (_format_size(saved), time_used))
+    if dry_run:
+        return
+    if not force:
+        while True:
+            reply = raw_input("Replace by dummy datasets? (y/n) ")
+            if reply in "yn":
+                break
+        if reply == 'n':
+            return
+    with activepapers.storage.ActivePaper(paper_name, 'r+') as paper:
+        for name in names:
+            paper.replace_by_dummy(name)
+    activepapers.storage.repack(paper_name)
+
 def set_(paper, dataset, expr):
     paper = get_paper(paper)
-    paper = activepapers.storage.ActivePaper(paper, 'r+')
+    paper = open_paper(paper, 'r+')
     value = eval(expr, numpy.__dict__, {})
     try:
         del paper.data[dataset]
@@ -332,13 +605,16 @@ def group(paper, group_name):
         raise CLIExit
     paper = get_paper(paper)
     paper = activepapers.storage.ActivePaper(paper, 'r+')
-    paper.file.create_group(group_name)
+    paper.create_group(paper.file, group_name)
     paper.close()
 
 def extract(paper, dataset, filename):
     paper = get_paper(paper)
-    paper = activepapers.storage.ActivePaper(paper, 'r')
-    ds = paper.file[dataset]
+    paper = open_paper(paper, 'r')
+    ds = paper.get_node(dataset)
+    if ds is None:
+        sys.stderr.write("Dataset %s does not exist\n" % dataset)
+        raise CLIExit
     try:
         if filename == '-':
             extract_to_file(paper, ds, file=sys.stdout)
@@ -348,30 +624,40 @@ def extract(paper, dataset, filename):
         sys.stderr.write(exc.args[0] + '\n')
         raise CLIExit
 
-def _script(paper, dataset, filename, run, create_method):
+def _script(paper, dataset, filename, run, create_method, **kwargs):
     paper = get_paper(paper)
-    paper = activepapers.storage.ActivePaper(paper, 'r+')
+    paper = open_paper(paper, 'r+')
     script = open(filename).read()
-    codelet = getattr(paper, create_method)(dataset, script)
+    codelet = getattr(paper, create_method)(dataset, script, **kwargs)
     if run:
-        codelet.run()
+        if paper.parameter_table(codelet.path) is not None:
+            paper.run_sweep(codelet.path)
+        else:
+            codelet.run()
     paper.close()
 
-def calclet(paper, dataset, filename, run):
-    _script(paper, dataset, filename, run, "create_calclet")
+def calclet(paper, dataset, filename, run, parameters=None):
+    _script(paper, dataset, filename, run, "create_calclet",
+            parameters=parameters)
 
 def importlet(paper, dataset, filename, run):
     _script(paper, dataset, filename, run, "create_importlet")
 
 def import_module(paper, module):
     paper = get_paper(paper)
-    paper = activepapers.storage.ActivePaper(paper, 'r+')
+    paper = open_paper(paper, 'r+')
     paper.import_module(module)
     paper.close()
 
-def run(paper, codelet, debug, profile, checkin):
+def run(paper, codelet, debug, profile, checkin, record_access,
+        isolated=False, resume=False, reuse_storage=False, jobs=None,
+        all_rows=False, preview=None, preview_sampling='stride'):
     paper = get_paper(paper)
-    with activepapers.storage.ActivePaper(paper, 'r+') as paper:
+    if preview is not None:
+        _preview(paper, codelet, debug, preview, preview_sampling)
+        return
+    with open_paper(paper, 'r+', record_access=record_access,
+                    reuse_storage=reuse_storage) as paper:
         if checkin:
             for root, dirs, files in os.walk('code'):
                 for f in files:
@@ -381,13 +667,17 @@ def run(paper, codelet, debug, profile, checkin):
                     except ValueError as exc:
                         sys.stderr.write(exc.args[0] + '\n')
         try:
-            if profile is None:
-                exc = paper.run_codelet(codelet, debug)
+            sweep = paper.parameter_table(
+                        '/code/' + codelet.lstrip('/')) is not None
+            if sweep and (jobs is not None or all_rows):
+                exc = _run_sweep(paper, codelet, jobs, all_rows)
+            elif profile is None:
+                exc = paper.run_codelet(codelet, debug, isolated, resume)
             else:
                 import cProfile, pstats
                 pr = cProfile.Profile()
                 pr.enable()
-                exc = paper.run_codelet(codelet, debug)
+                exc = paper.run_codelet(codelet, debug, isolated, resume)
                 pr.disable()
                 ps = pstats.Stats(pr)
                 ps.dump_stats(profile)
@@ -396,45 +686,201 @@ def run(paper, codelet, debug, profile, checkin):
             raise CLIExit
         if exc is not None:
             sys.stderr.write(exc)
+        else:
+            _report_mismatches(paper, '/code/' + codelet.lstrip('/'))
 
-def _find_calclet_for_dummy_or_stale_item(paper_name):
-    paper = activepapers.storage.ActivePaper(paper_name, 'r')
+def _preview(paper_name, codelet, debug, fraction, sampling):
+    # Run a codelet on a sample of its inputs, without modifying the
+    # paper, and show what it has written.
+    try:
+        paper = activepapers.preview.PreviewPaper(paper_name, fraction,
+                                                  sampling)
+    except ValueError as exc:
+        sys.stderr.write(exc.args[0] + '\n')
+        raise CLIExit
+    with paper:
+        start = time.time()
+        try:
+            exc = paper.run_codelet(codelet, debug)
+        except KeyError:
+            sys.stderr.write("Codelet %s does not exist\n" % codelet)
+            raise CLIExit
+        elapsed = time.time() - start
+        if exc is not None:
+            sys.stderr.write(exc)
+        sys.stdout.write("Preview on %g of the rows (%s sampling), "
+                         "%.2f s; nothing was stored\n"
+                         % (fraction, sampling, elapsed))
+        for ds in paper.outputs():
+            sys.stdout.write("%s: shape %s, dtype %s\n"
+                             % (ds.name, repr(ds.shape), str(ds.dtype)))
+            if ds.size <= 10:
+                sys.stdout.write("  %s\n" % str(ds[()]))
+
+def _run_sweep(paper, calclet, jobs, all_rows=False):
+    # Run the instances of a parameter sweep, in jobs worker processes
+    # if jobs is given, and return their tracebacks.
+    rows = None
+    if all_rows:
+        rows = range(len(paper.parameter_table('/code/'
+                                               + calclet.lstrip('/'))))
+    errors = paper.run_sweep(calclet, rows,
+                             jobs if jobs is not None and jobs > 1 else None)
+    errors = ["Row %d: %s" % (row, errors[row]) for row in sorted(errors)
+              if errors[row] is not None]
+    return ''.join(errors) if errors else None
+
+def _report_mismatches(paper, calclet):
+    # Compare the dependencies tracked during a run to the predicted
+    # ones. Names missing from an incomplete prediction are expected.
+    diff = activepapers.analysis.mismatches(paper, calclet)
+    if diff is None:
+        return
+    lines = []
+    if diff['complete']:
+        lines.extend("  unpredicted read %s\n" % path
+                     for path in diff['unpredicted_reads'])
+        lines.extend("  unpredicted write %s\n" % path
+                     for path in diff['unpredicted_writes'])
+    lines.extend("  predicted read %s did not happen\n" % path
+                 for path in diff['unused_reads'])
+    lines.extend("  predicted write %s did not happen\n" % path
+                 for path in diff['unused_writes'])
+    if lines:
+        sys.stderr.write("Dependencies of %s differ from the prediction:\n"
+                         % calclet)
+        for line in lines:
+            sys.stderr.write(line)
+
+def _update_plan(paper_name, complete=False):
+    # Return the calclets that must be run to update the paper, in
+    # order, each with the name of an item that makes it necessary.
+    # Unless complete is True, only the first calclet is returned.
+    paper = open_paper(paper_name, 'r')
     deps = paper.dependency_hierarchy()
     next(deps) # the first set has no dependencies
-    calclet = None
-    item_name = None
+    plan = []
+    planned = set()
     for item_set in deps:
         for item in item_set:
-            if paper.is_dummy(item) or paper.is_stale(item):
-                item_name = item.name
-                calclet = item.attrs['ACTIVE_PAPER_GENERATING_CODELET']
-                break
+            calclet = ascii(item.attrs['ACTIVE_PAPER_GENERATING_CODELET'])
+            if calclet in planned:
+                continue
+            if paper.is_dummy(item) or paper.is_stale(item) \
+               or any(owner(dep) in planned
+                      for dep in paper.iter_dependencies(item)):
+                # Items depending on the outputs of planned
+                # calclets will become stale.
+                plan.append((calclet, item.name))
+                planned.add(calclet)
+                if not complete:
+                    break
         # We must del item_set to prevent h5py from crashing when the
         # file is closed. Presumably there are HDF5 handles being freed
         # as a consequence of the del.
         del item_set
-        if calclet is not None:
+        if plan and not complete:
             break
     paper.close()
-    return calclet, item_name
+    return plan
+
+def _new_calclets(paper_name):
+    # Return the calclets that have never been run, in stages of
+    # calclets that can run at the same time according to their
+    # predicted dependencies.
+    paper = open_paper(paper_name, 'r')
+    new = [name for name in paper.calclets()
+           if not paper.owned_by(name)
+           and 'ACTIVE_PAPER_RUNTIME' not in paper.get_node(name).attrs]
+    try:
+        return activepapers.analysis.schedule(paper, new)
+    finally:
+        paper.close()
 
-def update(paper, verbose):
+def _run_new_calclets(paper_name, verbose, record_access, isolated, jobs):
+    pool = None
+    for stage in _new_calclets(paper_name):
+        if verbose:
+            sys.stdout.write("Running new calclets %s\n" % ", ".join(stage))
+            sys.stdout.flush()
+        paper = open_paper(paper_name, 'r+', record_access=record_access)
+        # The instances of parameter sweeps are run in parallel instead.
+        sweeps = [calclet for calclet in stage
+                  if paper.parameter_table(calclet) is not None]
+        others = [calclet for calclet in stage if calclet not in sweeps]
+        if jobs is not None and jobs > 1 and len(others) > 1:
+            if pool is None:
+                pool = activepapers.workers.WorkerPool(jobs)
+            errors = pool.run_codelets(paper, [c[6:] for c in others])
+        else:
+            errors = [paper.run_codelet(calclet, isolated=isolated)
+                      for calclet in others]
+        errors = dict(zip(others, errors))
+        for calclet in sweeps:
+            errors[calclet] = _run_sweep(paper, calclet, jobs)
+        for calclet in stage:
+            error = errors[calclet]
+            if error is None:
+                _report_mismatches(paper, calclet)
+            else:
+                sys.stderr.write(error)
+        paper.close()
+    if pool is not None:
+        pool.close()
+
+def update(paper, verbose, record_access, isolated=False, resume=False,
+           reuse_storage=False, cache_size=None, prefetch=None,
+           new=False, jobs=None):
     paper_name = get_paper(paper)
+    if new:
+        _run_new_calclets(paper_name, verbose, record_access, isolated, jobs)
+    # Inputs shared by several calclets are read only once.
+    array_cache = None
+    if cache_size:
+        array_cache = activepapers.arraycache.ArrayCache(
+                          int(cache_size*1024*1024))
+    # The inputs of the next calclet are read while the current one
+    # is running.
+    prefetcher = None
+    if prefetch:
+        prefetcher = activepapers.prefetch.Prefetcher(
+                         int(prefetch*1024*1024))
     while True:
-        calclet, item_name = _find_calclet_for_dummy_or_stale_item(paper_name)
-        if calclet is None:
+        plan = _update_plan(paper_name, prefetcher is not None)
+        if not plan:
             break
+        calclet, item_name = plan[0]
         if verbose:
             sys.stdout.write("Dataset %s is stale or dummy, running %s\n"
                              % (item_name, calclet))
             sys.stdout.flush()
-        paper = activepapers.storage.ActivePaper(paper_name, 'r+')
-        paper.run_codelet(calclet)
+        paper = open_paper(paper_name, 'r+', record_access=record_access,
+                           reuse_storage=reuse_storage,
+                           array_cache=array_cache)
+        if prefetcher is not None and len(plan) > 1:
+            prefetcher.prefetch(paper.file,
+                                activepapers.prefetch.input_datasets(
+                                    paper, plan[1][0], calclet))
+        if jobs is not None and paper.parameter_table(calclet) is not None:
+            error = _run_sweep(paper, calclet, jobs)
+            if error is not None:
+                sys.stderr.write(error)
+        else:
+            paper.run_codelet(calclet, isolated=isolated, resume=resume)
         paper.close()
+    if prefetcher is not None:
+        prefetcher.cancel()
+    if verbose and array_cache is not None:
+        stats = array_cache.statistics()
+        if stats['hit_rate'] is not None:
+            sys.stdout.write("Array cache: %d hits, %d misses (%.0f%%), "
+                             "%d evictions\n"
+                             % (stats['hits'], stats['misses'],
+                                100*stats['hit_rate'], stats['evictions']))
 
-def checkin(paper, type, file, force, dry_run):
+def checkin(paper, type, file, force, dry_run, incremental=False):
     paper = get_paper(paper)
-    paper = activepapers.storage.ActivePaper(paper, 'r+')
+    paper = open_paper(paper, 'r+')
     cwd = os.path.abspath(os.getcwd())
     for filename in file:
         filename = os.path.abspath(filename)
@@ -446,7 +892,8 @@ def checkin(paper, type, file, force, dry_run):
 
         def update(filename):
             try:
-                update_from_file(paper, filename, type, force, dry_run)
+                update_from_file(paper, filename, type, force, dry_run,
+                                 incremental=incremental)
             except ValueError as exc:
                 sys.stderr.write(exc.args[0] + '\n')
 
@@ -461,7 +908,7 @@ def checkin(paper, type, file, force, dry_run):
 
 def checkout(paper, type, pattern, dry_run):
     paper = get_paper(paper)
-    paper = activepapers.storage.ActivePaper(paper, 'r')
+    paper = open_paper(paper, 'r')
     pattern = process_patterns(pattern)
     for item in paper.iter_items():
         name = item.name[1:] # remove initial slash
@@ -500,6 +947,71 @@ def cp(paper, reference, name):
             ref_path = None
         paper.create_copy(name, ref_type + ':' + ref_name, ref_path)
 
+def deps(paper, predicted, calclet):
+    paper = get_paper(paper)
+    with open_paper(paper, 'r') as paper:
+        if calclet:
+            names = ['/code/' + name.lstrip('/') for name in calclet]
+            for name in names:
+                if datatype(paper.get_node(name)) != 'calclet':
+                    sys.stderr.write("Calclet %s does not exist\n" % name)
+                    raise CLIExit
+        else:
+            names = sorted(paper.calclets())
+        for name in names:
+            sys.stdout.write(name + '\n')
+            if predicted:
+                deps = activepapers.analysis.predict(paper, name)
+            else:
+                deps = activepapers.analysis.tracked(paper, name)
+                if deps is None:
+                    sys.stdout.write("  never run\n")
+                    continue
+            for path in sorted(deps.reads):
+                sys.stdout.write("  reads %s\n" % path)
+            for path in sorted(deps.writes):
+                sys.stdout.write("  writes %s\n" % path)
+            if not predicted:
+                continue
+            if not deps.complete:
+                sys.stdout.write("  (incomplete: some names are computed "
+                                 "at run time)\n")
+            diff = activepapers.analysis.mismatches(paper, name)
+            if diff is not None:
+                for key, text in [('unpredicted_reads', 'also read'),
+                                  ('unpredicted_writes', 'also wrote'),
+                                  ('unused_reads', 'did not read'),
+                                  ('unused_writes', 'did not write')]:
+                    for path in diff[key]:
+                        sys.stdout.write("  last run %s %s\n" % (text, path))
+
+def overlay(paper, action, overlay):
+    try:
+        if action == 'create':
+            paper = get_paper(paper)
+            if os.path.exists(overlay):
+                sys.stderr.write("File %s already exists\n" % overlay)
+                raise CLIExit
+            activepapers.overlay.create(paper, overlay)
+        elif action == 'status':
+            with activepapers.overlay.OverlayPaper(overlay) as paper:
+                written, removed = paper.changes()
+                sys.stdout.write("Base paper: %s\n" % paper.base_filename)
+            for name in written:
+                sys.stdout.write("written %s\n" % name)
+            for name in removed:
+                sys.stdout.write("removed %s\n" % name)
+            sys.stdout.write("Size of the overlay: %s\n"
+                             % _format_size(os.path.getsize(overlay)))
+        elif action == 'commit':
+            for name in activepapers.overlay.commit(overlay):
+                sys.stdout.write("%s\n" % name)
+        elif action == 'discard':
+            activepapers.overlay.discard(overlay)
+    except (IOError, OSError, ValueError) as exc:
+        sys.stderr.write(str(exc) + '\n')
+        raise CLIExit
+
 def refs(paper, verbose):
     paper = get_paper(paper)
     paper = activepapers.storage.ActivePaper(paper, 'r')
@@ -519,6 +1031,111 @@ def refs(paper, verbose):
                 for c in copies:
                     sys.stdout.write("    %s\n" % c)
 
+def du(paper, by, sort, reverse, as_json):
+    paper_name = get_paper(paper)
+    paper = activepapers.storage.ActivePaper(paper_name, 'r')
+    entries = storage_usage(paper, by)
+    file_size = paper.file.id.get_filesize()
+    free_space = paper.file.id.get_freespace()
+    paper.close()
+    if sort == 'name':
+        key = lambda e: e['name']
+    else:
+        key = lambda e: (e[sort] is not None, e[sort], e['name'])
+    entries.sort(key=key, reverse=reverse)
+    if as_json:
+        json.dump(dict(paper=paper_name, file_size=file_size,
+                       free_space=free_space, by=by, entries=entries),
+                  sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+        return
+    sys.stdout.write("%8s %8s %6s %7s %5s %8s  %s\n"
+                     % ("logical", "disk", "ratio", "chunks", "fill",
+                        "metadata", by))
+    for e in entries:
+        sys.stdout.write("%8s %8s %6s %7d %5s %8s  %s\n"
+                         % (_format_size(e['logical']),
+                            _format_size(e['disk']),
+                            '-' if e['ratio'] is None
+                                else "%.2f" % e['ratio'],
+                            e['chunks'],
+                            '-' if e['chunk_fill'] is None
+                                else "%3d%%" % (100*e['chunk_fill']),
+                            _format_size(e['metadata']),
+                            e['name']))
+    sys.stdout.write("file size %s, estimated free space %s\n"
+                     % (_format_size(file_size), _format_size(free_space)))
+
+def _rechunk_advice(paper, pattern):
+    advice = []
+    for path, per_codelet in sorted(paper.access_patterns().items()):
+        if pattern and not any(p.match(path[1:]) for p in pattern):
+            continue
+        ds = paper.file.get(path, None)
+        if not isinstance(ds, h5py.Dataset) or ds.chunks is None:
+            continue
+        selections = {}
+        for counts in per_codelet.values():
+            for selection, count in counts.items():
+                if len(selection) == len(ds.shape):
+                    selections[selection] = \
+                            selections.get(selection, 0) + count
+        selections = list(selections.items())
+        if not selections:
+            continue
+        itemsize = ds.dtype.itemsize
+        chunks = activepapers.chunking.advise_chunks(ds.shape, itemsize,
+                                                     selections, ds.chunks)
+        cost = lambda c: activepapers.chunking.total_read_bytes(c, itemsize,
+                                                               selections)
+        advice.append((path, ds.chunks, chunks,
+                       cost(ds.chunks), cost(chunks)))
+    return advice
+
+def rechunk(paper, advise, chunks, force, pattern):
+    paper_name = get_paper(paper)
+    pattern = process_patterns(pattern)
+    if chunks is not None:
+        chunks = tuple(int(n) for n in chunks.split(','))
+    paper = activepapers.storage.ActivePaper(paper_name, 'r')
+    if chunks is None:
+        advice = _rechunk_advice(paper, pattern)
+        if advise:
+            for path, old, new, old_cost, new_cost in advice:
+                sys.stdout.write("%s: chunks %s -> %s, "
+                                 "estimated reads %s -> %s\n"
+                                 % (path, str(old), str(new),
+                                    _format_size(old_cost),
+                                    _format_size(new_cost)))
+            paper.close()
+            return
+        todo = [(path, old, new)
+                for path, old, new, old_cost, new_cost in advice
+                if new != old]
+    else:
+        if not pattern:
+            sys.stderr.write("--chunks requires a dataset pattern\n")
+            raise CLIExit
+        todo = [(item.name, item.chunks, chunks)
+                for item in paper.iter_items()
+                if isinstance(item, h5py.Dataset)
+                and any(p.match(item.name[1:]) for p in pattern)]
+    paper.close()
+    if not todo:
+        return
+    if not force:
+        for path, old, new in todo:
+            sys.stdout.write("%s: %s -> %s\n" % (path, str(old), str(new)))
+        while True:
+            reply = raw_input("Rewrite datasets? (y/n) ")
+            if reply in "yn":
+                break
+        if reply == 'n':
+            return
+    with activepapers.storage.ActivePaper(paper_name, 'r+') as paper:
+        for path, old, new in todo:
+            paper.rechunk(path, new)
+
 def edit(paper, dataset):
     editor = os.getenv("EDITOR", "vi")
     paper_name = get_paper(paper)
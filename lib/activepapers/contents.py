@@ -37,6 +37,9 @@ def open(filename, mode='r'):
 def open_documentation(filename, mode='r'):
     return _open(filename, mode, '/documentation')
 
+from activepapers.lazy import wrap as lazy
+from activepapers.execution import parallel_map
+
 def exception_traceback():
     raise NotImplementedError()
 
@@ -1,20 +1,29 @@
 import imp
 import collections
+import itertools
 import os
 import sys
 import threading
-import traceback
+import time
 import weakref
 import logging
+import multiprocessing
+import multiprocessing.pool
 
 import h5py
 import numpy as np
 
+import activepapers.arraycache
+import activepapers.chunking
+import activepapers.codec
+import activepapers.lazy
+import activepapers.regions
 import activepapers.utility
 from activepapers.utility import ascii, utf8, isstring, execcode, \
                                  codepath, datapath, path_in_section, owner, \
-                                 datatype, language, \
-                                 timestamp, stamp, ms_since_epoch
+                                 datatype, language, mod_time, h5vstring, \
+                                 timestamp, stamp, ms_since_epoch, \
+                                 parameter_row_id
 import activepapers.standardlib
 
 #
@@ -33,10 +42,28 @@ import activepapers.standardlib
 
 class Codelet(object):
 
+    # The input rows processed by the previous run of an
+    # incremental calclet, see Calclet.
+    _previous_inputs = None
+    # The state stored by the checkpoint from which a run is resumed
+    _checkpoint_state = None
+    # The slots available for new datasets, see
+    # ActivePaper.retain_owned_by()
+    _slots = None
+    # The row of the parameter table for an instance of a parameter
+    # sweep, see ActivePaper.set_parameter_table()
+    row = None
+    _row_id = None
+
     def __init__(self, paper, node):
         self.paper = paper
         self.node = node
         self._dependencies = None
+        self._accesses = collections.Counter()
+        self._regions = {}
+        # Datasets are also read in threads other than the codelet's
+        # own, e.g. by iter_chunks and parallel_map.
+        self._record_lock = threading.Lock()
         assert node.name.startswith('/code/')
         self.path = node.name
 
@@ -47,12 +74,44 @@ class Codelet(object):
             deps = list(self._dependencies)
             deps.append(ascii(self.path))
             deps.sort()
-            return {'ACTIVE_PAPER_GENERATING_CODELET': self.path,
-                    'ACTIVE_PAPER_DEPENDENCIES': deps}
+            attributes = {'ACTIVE_PAPER_GENERATING_CODELET': self.path,
+                          'ACTIVE_PAPER_DEPENDENCIES': deps}
+            if self._row_id is not None:
+                attributes['ACTIVE_PAPER_PARAMETER_ROW'] = self._row_id
+            if self._regions:
+                attributes['ACTIVE_PAPER_DEPENDENCY_REGIONS'] = \
+                    activepapers.regions.encode_dependency_regions(
+                        self._regions)
+            return attributes
 
     def add_dependency(self, dependency):
         pass
 
+    def record_access(self, ds, item):
+        if self.paper.track_regions:
+            self.record_region(ds, item)
+        if not self.paper.record_access:
+            return
+        selection = activepapers.chunking.selection_shape(ds.shape, item)
+        if selection is not None:
+            with self._record_lock:
+                self._accesses[(ds.name, selection)] += 1
+
+    def record_region(self, ds, item=Ellipsis):
+        if not self.paper.track_regions or self._dependencies is None:
+            return
+        self.add_regions(ds.name,
+                         [activepapers.regions.read_region(ds.shape, item)])
+
+    def add_regions(self, path, regions):
+        with self._record_lock:
+            if self._regions is None:
+                return
+            recorded = self._regions.get(path, [])
+            for region in regions:
+                recorded = activepapers.regions.add_region(recorded, region)
+            self._regions[path] = recorded
+
     def owns(self, node):
         return owner(node) == self.path
 
@@ -61,6 +120,8 @@ class Codelet(object):
             # Catch obvious attempts to access real files
             # rather than internal ones.
             raise IOError((13, "Permission denied: '%s'" % path))
+        if mode[0] != 'r':
+            check_write_access()
         path = path_in_section(path, section)
         if not path.startswith('/'):
             path = section + '/' + path
@@ -84,10 +145,76 @@ class Codelet(object):
         paper_id, path = node.split(':')
         return CodeFile(self.paper, self.paper.file[path]), line, fn_name
 
-    def _run(self, environment):
+    def parallel_map(self, func, iterable, workers=None, backend=None):
+        """
+        Apply func to each element of iterable, using several worker
+        processes or threads. See parallel_map() for details.
+        """
+        return parallel_map(func, iterable, workers, backend, self)
+
+    def new_rows(self, path):
+        """
+        :param path: the path of a dataset
+        :type path: str
+        :return: the rows of the dataset that were added since the
+                 previous run of an incremental calclet, or all rows
+        :rtype: slice
+        """
+        ds = self.paper.data_group[datapath(path)]
+        start = 0
+        if self._previous_inputs is not None:
+            start = min(self._previous_inputs.get(ds.name, 0), len(ds))
+        return slice(start, len(ds))
+
+    def checkpoint(self, state):
+        """
+        Store a checkpoint, from which the run can be resumed
+        if it does not finish. The items generated so far are kept.
+
+        :param state: the information needed to continue, as a
+                      dictionary mapping names to arrays or numbers
+        :type state: dict
+        """
+        check_write_access()
+        if self.row is not None:
+            raise ValueError("instances of parameter sweeps "
+                             "cannot store checkpoints")
+        self.paper.store_checkpoint(self, state)
+
+    def resume(self):
+        """
+        :return: the state passed to checkpoint() by the run that is
+                 being resumed, or None for a run that starts from
+                 the beginning
+        :rtype: dict
+        """
+        return self._checkpoint_state
+
+    def _resume_checkpoint(self):
+        # Prepare the continuation of an unfinished run, if the
+        # paper has a valid checkpoint for it.
+        checkpoint = self.paper.load_checkpoint(self.path)
+        if checkpoint is None:
+            return False
+        self._checkpoint_state, dependencies, regions = checkpoint
+        if self._dependencies is not None:
+            self._dependencies = set(dependencies)
+            self._dependencies.discard(self.path)
+            if self._regions is not None:
+                self._regions = regions
+        logging.info("Resuming %s from its checkpoint" % self.path)
+        return True
+
+    def _run(self, environment, keep_outputs=False):
         logging.info("Running %s %s"
                      % (self.__class__.__name__.lower(), self.path))
-        self.paper.remove_owned_by(self.path)
+        self._slots = None
+        if self.row is not None:
+            self.paper.remove_row_outputs(self.path, self.row)
+        elif not keep_outputs:
+            if getattr(self.paper, 'reuse_storage', False):
+                self._slots = self.paper.retain_owned_by(self.path)
+            self.paper.remove_owned_by(self.path)
         # A string uniquely identifying the paper from which the
         # calclet is called. Used in Importer.
         script = utf8(self.node[...].flat[0])
@@ -100,27 +227,226 @@ class Codelet(object):
         self._contents_module.open = self.open_data_file
         self._contents_module.open_documentation = self.open_documentation_file
         self._contents_module.snapshot = self.paper.snapshot
+        self._contents_module.lazy = activepapers.lazy.wrap
+        self._contents_module.parallel_map = self.parallel_map
+        self._contents_module.new_rows = self.new_rows
+        self._contents_module.checkpoint = self.checkpoint
+        self._contents_module.resume = self.resume
+        self._contents_module.is_incremental_run = keep_outputs
         self._contents_module.exception_traceback = self.exception_traceback
+        self._contents_module.parameters = None
+        self._contents_module.output = self._contents_module.data
+        if self.row is not None:
+            self._contents_module.parameters = self._parameters()
+            self._contents_module.output = \
+                self._contents_module.data.create_group(
+                    self.paper.sweep_group_name(self.path, self.row)[5:])
+
+        # activepapers.contents and the modules stored in the paper are
+        # made available through a codelet-specific __import__ rather
+        # than through sys.modules, such that codelets of different papers
+        # can run at the same time in different threads.
+        self._contents_package = imp.new_module('activepapers')
+        self._contents_package.__dict__.update(activepapers.__dict__)
+        self._contents_package.contents = self._contents_module
+        builtins = dict(environment['__builtins__'])
+        builtins['__import__'] = self._import
+        environment['__builtins__'] = builtins
+        self.paper._importer.clear_cache()
+        previous = getattr(_thread_state, 'codelet', None)
+        _thread_state.codelet = self
+        _enter_codelet()
+        try:
+            execcode(script, environment)
+        finally:
+            _leave_codelet()
+            _thread_state.codelet = previous
+            if self._accesses:
+                self.paper.store_access_patterns(self.path,
+                                                 self._accesses)
+                self._accesses.clear()
+            self._contents_module = None
+            self._contents_package = None
+            if self._slots is not None:
+                self.paper.release_slots(self.path)
+                self._slots = None
+
+    def _parameters(self):
+        # The row of the parameter table, as a dictionary
+        # for tables with named fields.
+        table = self.paper.parameter_table(self.path)
+        self.add_dependency(table.name)
+        self.record_region(table, self.row)
+        value = table[self.row]
+        if table.dtype.names:
+            return dict((name, value[name]) for name in table.dtype.names)
+        return value
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level == 0:
+            self.track_and_check_import(name)
+        return self.paper._importer.import_module(name, globals, fromlist,
+                                                  level, self)
+
+#
+# The codelet being run by the current thread. Threads started by
+# parallel_map inherit the codelet of their caller.
+#
+
+_thread_state = threading.local()
+
+def current_codelet():
+    """
+    :return: the codelet being run by the current thread, or None
+    :rtype: Codelet
+    """
+    return getattr(_thread_state, 'codelet', None)
+
+# The number of codelets being run by each thread
+_codelet_threads = collections.Counter()
+_codelet_threads_lock = threading.Lock()
+
+def _enter_codelet():
+    with _codelet_threads_lock:
+        _codelet_threads[threading.current_thread().ident] += 1
+
+def _leave_codelet():
+    ident = threading.current_thread().ident
+    with _codelet_threads_lock:
+        _codelet_threads[ident] -= 1
+        if _codelet_threads[ident] == 0:
+            del _codelet_threads[ident]
+
+def _other_codelet_threads():
+    ident = threading.current_thread().ident
+    with _codelet_threads_lock:
+        return any(other != ident for other in _codelet_threads)
+
+#
+# Parallel execution of a function inside a codelet
+#
+# parallel_map is the only sanctioned way for codelets to use more
+# than one core. The workers may read from the paper, and the
+# datasets they read become dependencies of the calling codelet,
+# but they may not modify the paper. The results are returned in the
+# order of the input elements, independently of the scheduling.
+#
+# With the 'process' backend, the workers are created by fork(), so
+# they inherit the function to be applied, which therefore does not
+# need to be picklable. The elements of the input sequence and the
+# results must be picklable. The 'thread' backend has no such
+# restrictions, but is useful only for functions that spend most
+# of their time in code that releases the GIL, such as numpy.
+# While codelets are running in other threads, the thread backend
+# is used instead of the process backend, because a forked worker
+# would inherit the locks held by these threads, in particular
+# h5py's global lock, and could deadlock.
+#
+# Each call has its own task, which the process workers find in
+# _parallel_tasks under the id passed to their initializer.
+#
+
+_parallel_tasks = {}
+_parallel_task_ids = itertools.count()
 
-        # The remaining part of this method is not thread-safe because
-        # of the way the global state in sys.modules is modified.
-        with codelet_lock:
+def check_write_access():
+    """
+    Raise an exception if called from a parallel_map worker.
+    """
+    if getattr(_thread_state, 'read_only', False):
+        raise IOError("parallel_map workers cannot modify the paper")
+
+def _init_worker(codelet):
+    _thread_state.codelet = codelet
+    _thread_state.read_only = True
+
+def _init_process_worker(task_id):
+    _thread_state.task = _parallel_tasks[task_id]
+    _init_worker(_thread_state.task[0])
+
+def _run_in_process(item):
+    codelet, func = _thread_state.task
+    if codelet is not None and codelet._dependencies is not None:
+        codelet._dependencies = set()
+        if codelet._regions is not None:
+            codelet._regions = {}
+    result = func(item)
+    if codelet is None or codelet._dependencies is None:
+        return result, [], {}
+    return result, sorted(codelet._dependencies), codelet._regions or {}
+
+def parallel_map(func, iterable, workers=None, backend=None, codelet=None):
+    """
+    :param func: the function to be applied to each element
+    :param iterable: the input elements
+    :param workers: the number of workers (default: number of CPUs)
+    :type workers: int
+    :param backend: 'process' (the default on platforms with fork())
+                    or 'thread'
+    :type backend: str
+    :param codelet: the codelet on whose behalf the work is done
+    :type codelet: Codelet
+    :return: the list of the results, in the order of the inputs
+    :rtype: list
+    """
+    items = list(iterable)
+    if workers is None:
+        workers = activepapers.codec.default_workers()
+    if backend is None:
+        backend = 'process' if hasattr(os, 'fork') else 'thread'
+    if backend not in ['process', 'thread']:
+        raise ValueError("unknown backend %s" % backend)
+    if backend == 'process' and not hasattr(os, 'fork'):
+        raise ValueError("the process backend requires fork()")
+    if backend == 'process' and _other_codelet_threads():
+        logging.info("Codelets are running in other threads, "
+                     "using the thread backend of parallel_map")
+        backend = 'thread'
+    workers = max(1, min(workers, len(items)))
+
+    if backend == 'thread' or workers == 1:
+        def run(item):
+            previous = (getattr(_thread_state, 'codelet', None),
+                        getattr(_thread_state, 'read_only', False))
+            _init_worker(codelet)
             try:
-                codelet_registry[(self.paper._id(), self.path)] = self
-                for name, module in self.paper._local_modules.items():
-                    assert name not in sys.modules
-                    sys.modules[name] = module
-                sys.modules['activepapers.contents'] = self._contents_module
-                execcode(script, environment)
+                return func(item)
             finally:
-                del codelet_registry[(self.paper._id(), self.path)]
-                self._contents_module = None
-                if 'activepapers.contents' in sys.modules:
-                    del sys.modules['activepapers.contents']
-                for name, module in self.paper._local_modules.items():
-                    del sys.modules[name]
-
-codelet_lock = threading.Lock()
+                _thread_state.codelet, _thread_state.read_only = previous
+        pool = multiprocessing.pool.ThreadPool(workers)
+        try:
+            return pool.map(run, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    if codelet is not None and codelet.paper.writable:
+        # The workers must see everything the codelet has written.
+        codelet.paper.flush()
+    if getattr(_thread_state, 'task', None) is not None:
+        raise ValueError("parallel_map calls cannot be nested")
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing
+    task_id = next(_parallel_task_ids)
+    _parallel_tasks[task_id] = (codelet, func)
+    try:
+        pool = context.Pool(workers, initializer=_init_process_worker,
+                            initargs=(task_id,))
+        try:
+            results = pool.map(_run_in_process, items, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        del _parallel_tasks[task_id]
+    for result, dependencies, regions in results:
+        for dependency in dependencies:
+            codelet.add_dependency(dependency)
+        for path, per_path in regions.items():
+            codelet.add_regions(path, per_path)
+    return [result for result, dependencies, regions in results]
 
 #
 # Importlets are run in the normal Python environment, with in
@@ -135,9 +461,15 @@ codelet_lock = threading.Lock()
 
 class Importlet(Codelet):
 
-    def run(self):
+    def run(self, resume=False):
         environment = {'__builtins__': activepapers.utility.builtins.__dict__}
-        self._run(environment)
+        self._checkpoint_state = None
+        keep_outputs = resume and self._resume_checkpoint()
+        try:
+            self._run(environment, keep_outputs)
+        finally:
+            self._checkpoint_state = None
+        self.paper.remove_checkpoint(self.path)
 
     def track_and_check_import(self, module_name):
         return
@@ -154,11 +486,120 @@ class Importlet(Codelet):
 
 class Calclet(Codelet):
 
-    def run(self):
+    def run(self, resume=False, row=None):
+        if row is not None:
+            self._run_instance(row)
+            return
+        self._dependencies = set()
+        self._regions = {}
+        self._previous_inputs = None
+        self._checkpoint_state = None
+        if self.incremental:
+            # The outputs of incremental calclets depend on all rows
+            # of their inputs, including those processed earlier.
+            self._regions = None
+        resumed = resume and self._resume_checkpoint()
+        if self.incremental and not resumed:
+            self._previous_inputs = self._incremental_state()
+            if self._previous_inputs is not None:
+                self._dependencies = set(ascii(dep) for dep in
+                     self.node.attrs['ACTIVE_PAPER_INCREMENTAL_DEPENDENCIES'])
+                self._dependencies.discard(self.path)
+                # If the run fails, the next one starts from scratch.
+                clear_incremental_state(self.node)
+        environment = {'__builtins__':
+                       activepapers.utility.ap_builtins.__dict__}
+        keep_outputs = resumed or self._previous_inputs is not None
+        start = time.time()
+        try:
+            self._run(environment, keep_outputs)
+        finally:
+            self._previous_inputs = None
+            self._checkpoint_state = None
+        if not keep_outputs:
+            self.paper.store_runtime(self.path, time.time() - start)
+        self.paper.remove_checkpoint(self.path)
+        if self.incremental:
+            self._store_incremental_state()
+
+    def _run_instance(self, row):
+        # Run the instance of a parameter sweep for one row.
+        table = self.paper.parameter_table(self.path)
+        if table is None:
+            raise ValueError("%s has no parameter table" % self.path)
+        if not 0 <= row < len(table):
+            raise IndexError("row %d of parameter table %s does not exist"
+                             % (row, table.name))
+        self.row = row
+        self._row_id = parameter_row_id(table, row)
         self._dependencies = set()
+        self._regions = {}
         environment = {'__builtins__':
                        activepapers.utility.ap_builtins.__dict__}
-        self._run(environment)
+        try:
+            self._run(environment)
+            # The group holding the outputs records the complete
+            # dependencies of the instance.
+            group = self.paper.data_group[
+                        self.paper.sweep_group_name(self.path, row)[6:]]
+            stamp(group, "group", self.dependency_attributes())
+        except Exception:
+            # Incomplete outputs would not be recognized as stale.
+            self.paper.remove_row_outputs(self.path, row)
+            raise
+        finally:
+            self.row = None
+            self._row_id = None
+
+    @property
+    def incremental(self):
+        return bool(self.node.attrs.get('ACTIVE_PAPER_INCREMENTAL', False))
+
+    def _incremental_state(self):
+        # Return the number of rows of each input dataset at the end
+        # of the previous run, or None if the calclet must be run on
+        # all the data.
+        attrs = self.node.attrs
+        last_run = attrs.get('ACTIVE_PAPER_LAST_RUN', None)
+        if last_run is None or self.node.file.mode == 'r':
+            return None
+        last_run = last_run/1000.
+        inputs = {}
+        for entry in attrs['ACTIVE_PAPER_INPUT_ROWS']:
+            path, rows = ascii(entry).rsplit(' ', 1)
+            inputs[path] = int(rows)
+        for dep in attrs['ACTIVE_PAPER_INCREMENTAL_DEPENDENCIES']:
+            node = self.paper.file.get(ascii(dep), None)
+            if node is None:
+                return None
+            if node.name == self.path or mod_time(node) <= last_run:
+                continue
+            if node.name not in inputs or node.shape[0] < inputs[node.name]:
+                return None
+            # Rows that were processed before must not have changed.
+            modified = activepapers.regions.modified_since(node, last_run)
+            if modified is None \
+               or any(region[0][0] < inputs[node.name]
+                      for region in modified):
+                return None
+        return inputs
+
+    def _store_incremental_state(self):
+        if self.node.file.mode == 'r':
+            # Isolated runs: the codelet is in the read-only layer.
+            return
+        deps = sorted(self._dependencies)
+        rows = []
+        for dep in deps:
+            node = self.paper.file.get(dep, None)
+            if isinstance(node, h5py.Dataset) and len(node.shape) > 0:
+                rows.append(ascii('%s %d' % (dep, node.shape[0])))
+        attrs = self.node.attrs
+        for name, values in [('ACTIVE_PAPER_INPUT_ROWS', rows),
+                             ('ACTIVE_PAPER_INCREMENTAL_DEPENDENCIES', deps)]:
+            attrs.create(name, np.array(values, dtype=object),
+                         shape=(len(values),), dtype=h5vstring)
+        attrs['ACTIVE_PAPER_LAST_RUN'] = ms_since_epoch()
 
     def add_dependency(self, dependency):
         assert isinstance(self._dependencies, set)
@@ -181,6 +622,18 @@ class Calclet(Codelet):
                 self.add_dependency(node.name)
 
 
+def clear_incremental_state(node):
+    """
+    Make the next run of an incremental calclet a complete one.
+
+    :param node: the calclet
+    :type node: h5py.Dataset
+    """
+    for name in ['ACTIVE_PAPER_LAST_RUN', 'ACTIVE_PAPER_INPUT_ROWS',
+                 'ACTIVE_PAPER_INCREMENTAL_DEPENDENCIES']:
+        if name in node.attrs:
+            del node.attrs[name]
+
 #
 # The attrs attribute of datasets and groups is wrapped
 # by a class that makes the attributes used by ACTIVE_PAPERS
@@ -216,11 +669,13 @@ class AttrWrapper(collections.MutableMapping):
         return self._node.attrs[item]
 
     def __setitem__(self, item, value):
+        check_write_access()
         if AttrWrapper.forbidden(item):
             raise ValueError(item)
         self._node.attrs[item] = value
 
     def __delitem__(self, item):
+        check_write_access()
         if AttrWrapper.forbidden(item):
             raise KeyError(item)
         del self._node.attrs[item]
@@ -248,26 +703,124 @@ class DatasetWrapper(object):
         return len(self._node)
 
     def __getitem__(self, item):
+        if self._codelet is not None:
+            self._codelet.record_access(self._node, item)
+            cache = getattr(self._codelet.paper, 'array_cache', None)
+            if cache is not None \
+               and activepapers.arraycache.is_full_read(item):
+                return cache.read(self._node)
         return self._node[item]
 
     def __setitem__(self, item, value):
+        check_write_access()
+        self._log_modification(
+            activepapers.regions.selection_bounds(self._node.shape, item))
         self._node[item] = value
         stamp(self._node, "data", self._codelet.dependency_attributes())
 
     def __getattr__(self, attr):
+        if attr not in _metadata_attributes and self._codelet is not None:
+            # Anything else may read the complete dataset.
+            self._codelet.record_region(self._node)
         return getattr(self._node, attr)
 
-    def read_direct(dest, source_sel=None, dest_sel=None):
+    def _writable_node(self):
+        # The node to be modified by writes that bypass the methods
+        # of this class. Overridden by copy-on-write datasets, see
+        # activepapers.overlay.
+        return self._node
+
+    def _log_modification(self, region):
+        cache = getattr(self._codelet.paper, 'array_cache', None)
+        if cache is not None:
+            cache.invalidate(self._node)
+        if self._codelet.paper.track_regions:
+            activepapers.regions.log_modification(self._node, region)
+
+    def read_direct(self, dest, source_sel=None, dest_sel=None):
+        if self._codelet is not None:
+            self._codelet.record_region(self._node,
+                                        Ellipsis if source_sel is None
+                                        else source_sel)
         return self._node.read_direct(dest, source_sel, dest_sel)
 
     def resize(self, size, axis=None):
+        check_write_access()
+        old_shape = self._node.shape
         self._node.resize(size, axis)
+        new_shape = self._node.shape
+        changed = [i for i, (n_old, n_new) in enumerate(zip(old_shape,
+                                                            new_shape))
+                   if n_old != n_new]
+        if len(changed) == 1:
+            # The rows that were added or removed
+            i = changed[0]
+            region = list(activepapers.regions.full_region(new_shape))
+            region[i] = (min(old_shape[i], new_shape[i]),
+                         max(old_shape[i], new_shape[i]))
+            self._log_modification(tuple(region))
+        elif changed:
+            self._log_modification(activepapers.regions.full_region(
+                np.maximum(old_shape, new_shape)))
         stamp(self._node, "data", self._codelet.dependency_attributes())
 
-    def write_direct(source, source_sel=None, dest_sel=None):
+    def write_direct(self, source, source_sel=None, dest_sel=None):
+        check_write_access()
+        self._log_modification(
+            None if dest_sel is None
+            else activepapers.regions.selection_bounds(self._node.shape,
+                                                       dest_sel))
         self._node.write_direct(source, source_sel, dest_sel)
         stamp(self._node, "data", self._codelet.dependency_attributes())
 
+    def read_parallel(self, workers=None):
+        """
+        Read the complete dataset, decompressing chunks in parallel.
+        """
+        if self._codelet is not None:
+            self._codelet.record_region(self._node)
+        return activepapers.codec.read(self._node, workers)
+
+    def write_parallel(self, array, workers=None):
+        """
+        Write the complete dataset, compressing chunks in parallel.
+        """
+        check_write_access()
+        self._log_modification(None)
+        activepapers.codec.write(self._node, array, workers)
+        stamp(self._node, "data", self._codelet.dependency_attributes())
+
+    def iter_chunks(self, axis=0, size=None):
+        """
+        Iterate over the dataset in blocks along one axis, whose
+        boundaries coincide with chunk boundaries. The next block
+        is read in a background thread while the current one is
+        being processed.
+
+        :param axis: the axis along which the dataset is traversed
+        :type axis: int
+        :param size: the minimal number of elements of a block along axis
+        :type size: int
+        """
+        blocks = activepapers.codec.aligned_blocks(self._node.shape,
+                                                   self._node.chunks,
+                                                   self._node.dtype.itemsize,
+                                                   axis, size)
+        if not blocks:
+            return
+        pool = multiprocessing.pool.ThreadPool(1)
+        try:
+            pending = pool.apply_async(self.__getitem__, (blocks[0],))
+            for selection in blocks[1:] + [None]:
+                block = pending.get()
+                if selection is not None:
+                    pending = pool.apply_async(self.__getitem__,
+                                               (selection,))
+                yield block
+        finally:
+            pool.close()
+            pool.join()
+
     def __repr__(self):
         codelet = owner(self._node)
         if codelet is None:
@@ -283,6 +836,99 @@ class DatasetWrapper(object):
                          % (repr(self._node.shape), str(self._node.dtype)))
         return "\n".join(lines)
 
+# Attributes of h5py datasets that do not give access to the data
+_metadata_attributes = frozenset(['shape', 'dtype', 'size', 'ndim', 'chunks',
+                                  'maxshape', 'compression',
+                                  'compression_opts', 'shuffle', 'fletcher32',
+                                  'scaleoffset', 'fillvalue', 'name', 'file',
+                                  'id', 'nbytes', 'is_virtual', 'external',
+                                  'dims', 'regionref', 'track_times'])
+
+#
+# AppendableDataset builds a dataset whose length along the first
+# axis is not known in advance. Rows are collected until they fill
+# a chunk, so every chunk is written exactly once. The dataset is
+# stamped when it is created and again when the builder is closed,
+# but not for each append.
+#
+
+class AppendableDataset(object):
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        ds = dataset._writable_node()
+        self._node = ds
+        self._chunk_rows = ds.chunks[0]
+        self._buffer = np.empty((self._chunk_rows,) + ds.shape[1:],
+                                dtype=ds.dtype)
+        self._buffered = 0
+        self._length = ds.shape[0]
+        self.closed = False
+
+    def __len__(self):
+        return self._length + self._buffered
+
+    def append(self, batch):
+        """
+        Append rows to the dataset.
+
+        :param batch: an array whose shape is (n,) + the row shape
+        """
+        check_write_access()
+        if self.closed:
+            raise ValueError("appendable dataset %s has been closed"
+                             % self._node.name)
+        batch = np.asarray(batch, dtype=self._node.dtype)
+        if batch.shape[1:] != self._node.shape[1:]:
+            raise ValueError("row shape %s does not match dataset "
+                             "row shape %s"
+                             % (str(batch.shape[1:]),
+                                str(self._node.shape[1:])))
+        while len(batch) > 0:
+            if self._buffered == 0 and len(batch) >= self._chunk_rows:
+                # Write complete chunks without copying them.
+                n = (len(batch) // self._chunk_rows) * self._chunk_rows
+                self._write(batch[:n])
+            else:
+                n = min(len(batch), self._chunk_rows - self._buffered)
+                self._buffer[self._buffered:self._buffered+n] = batch[:n]
+                self._buffered += n
+                if self._buffered == self._chunk_rows:
+                    self._flush()
+            batch = batch[n:]
+
+    def _write(self, rows):
+        start = self._length
+        self._length += len(rows)
+        self.dataset._log_modification(
+            ((start, self._length),)
+            + activepapers.regions.full_region(self._node.shape[1:]))
+        self._node.resize(self._length, axis=0)
+        self._node[start:self._length] = rows
+
+    def _flush(self):
+        if self._buffered > 0:
+            self._write(self._buffer[:self._buffered])
+            self._buffered = 0
+
+    def close(self):
+        """
+        Write the remaining rows and stamp the dataset.
+        """
+        if not self.closed:
+            self._flush()
+            self._buffer = None
+            self.closed = True
+            codelet = self.dataset._codelet
+            stamp(self._node, "data", codelet.dependency_attributes())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
 #
 # DataGroup is a wrapper class for the "data" group in a paper.
 # The wrapper traces access and creation of subgroups and datasets
@@ -320,6 +966,8 @@ class DataGroup(object):
             else:
                 node = DatasetWrapper(None, node, None)
         else:
+            if node.attrs.get('ACTIVE_PAPER_DUMMY_DATASET', False):
+                node = self._paper.materialize(node)
             if self._codelet is not None:
                 if ap_type is not None and ap_type != "group":
                     self._codelet.add_dependency(node.name
@@ -333,7 +981,8 @@ class DataGroup(object):
                 node = DataGroup(self._paper, self, node,
                                  self._codelet, self._data_item)
             else:
-                node = DatasetWrapper(self, node, self._codelet)
+                node = self._paper.dataset_wrapper(self, node,
+                                                   self._codelet)
         return node
 
     def _stamp_new_node(self, node, ap_type):
@@ -378,18 +1027,26 @@ class DataGroup(object):
             return default
 
     def __setitem__(self, path, value):
+        check_write_access()
         path = datapath(path)
         needs_stamp = False
         if isinstance(value, (DataGroup, DatasetWrapper)):
             value = value._node
         else:
             needs_stamp = True
-        self._node[path] = value
+        if self._compact_layout(value):
+            # activepapers.storage imports this module.
+            from activepapers.storage import create_compact_dataset
+            create_compact_dataset(self._node, path, value)
+        elif not needs_stamp \
+             or self._reuse_storage(path, {'data': value}) is None:
+            self._node[path] = value
         if needs_stamp:
             node = self._node[path]
             stamp(node, "data", self._codelet.dependency_attributes())
 
     def __delitem__(self, path):
+        check_write_access()
         test = self._node[datapath(path)]
         if owner(test) == self._codelet.path:
             del self._node[datapath(path)]
@@ -398,28 +1055,130 @@ class DataGroup(object):
                              % (str(self._codelet.path), str(owner(test))))
 
     def create_group(self, path):
-        group = self._node.create_group(datapath(path))
+        check_write_access()
+        group = self._paper.create_group(self._node, datapath(path))
         self._stamp_new_node(group, "group")
         return DataGroup(self._paper, self, group,
                          self._codelet, self._data_item)
 
     def require_group(self, path):
-        group = self._node.require_group(datapath(path))
+        check_write_access()
+        path = datapath(path)
+        if path in self._node:
+            group = self._node.require_group(path)
+        else:
+            group = self._paper.create_group(self._node, path)
         self._stamp_new_node(group, "group")
         return DataGroup(self._paper, self, group,
                          self._codelet, self._data_item)
 
     def mark_as_data_item(self):
+        check_write_access()
         stamp(self._node, "data", self._codelet.dependency_attributes())
         self._data_item = self
 
+    def _compact_layout(self, data):
+        # Scalar values use compact storage if the paper asks for it.
+        if not getattr(self._paper, 'compact', False) \
+           or data is None \
+           or isinstance(data, (h5py.HLObject, h5py.Reference)):
+            return False
+        data = np.asarray(data)
+        return data.shape == () and data.dtype.kind in 'biufcS'
+
     def create_dataset(self, path, *args, **kwargs):
-        ds = self._node.create_dataset(datapath(path), *args, **kwargs)
+        check_write_access()
+        for name, value in zip(['shape', 'dtype', 'data'], args):
+            if name in kwargs:
+                raise TypeError("create_dataset() got multiple values "
+                                "for argument '%s'" % name)
+            kwargs[name] = value
+        if list(kwargs) == ['data'] \
+           and self._compact_layout(kwargs['data']):
+            from activepapers.storage import create_compact_dataset
+            ds = create_compact_dataset(self._node, datapath(path),
+                                        kwargs['data'])
+            self._stamp_new_node(ds, "data")
+            return DatasetWrapper(self, ds, self._codelet)
+        # With workers=N, the initial data is compressed by N threads.
+        workers = kwargs.pop('workers', None)
+        data = kwargs.get('data', None)
+        if workers is not None and data is not None:
+            data = np.asarray(kwargs.pop('data'))
+            kwargs.setdefault('shape', data.shape)
+            kwargs.setdefault('dtype', data.dtype)
+        else:
+            data = None
+        ds = self._reuse_storage(datapath(path), kwargs,
+                                 initialize=data is None)
+        if ds is None:
+            ds = self._node.create_dataset(datapath(path), **kwargs)
+        if data is not None:
+            activepapers.codec.write(ds, data, workers)
         self._stamp_new_node(ds, "data")
         return DatasetWrapper(self, ds, self._codelet)
 
+    def _reuse_storage(self, path, kwargs, initialize=True):
+        # Return a slot of the running codelet that has been turned
+        # into the requested dataset, or None.
+        slots = getattr(self._codelet, '_slots', None)
+        if not slots:
+            return None
+        return self._paper.reuse_slot(slots, self._node, path, kwargs,
+                                      initialize)
+
+    def create_appendable(self, path, dtype, chunk_rows, shape=(), **kwargs):
+        """
+        Create a dataset that grows along its first axis.
+
+        :param dtype: the element type
+        :param chunk_rows: the number of rows per chunk
+        :type chunk_rows: int
+        :param shape: the shape of a row
+        :type shape: tuple
+        :return: a builder whose append() method adds rows, and which
+                 must be closed after the last append
+        :rtype: AppendableDataset
+        """
+        shape = tuple(shape)
+        ds = self.create_dataset(path, shape=(0,) + shape, dtype=dtype,
+                                 chunks=(chunk_rows,) + shape,
+                                 maxshape=(None,) + shape, **kwargs)
+        return AppendableDataset(ds)
+
+    def require_appendable(self, path, dtype, chunk_rows, shape=(),
+                           **kwargs):
+        """
+        Like create_appendable(), but if the dataset exists already,
+        new rows are appended to it. This is how incremental calclets
+        extend their outputs.
+        """
+        check_write_access()
+        existing = self._node.get(datapath(path), None)
+        if existing is None:
+            return self.create_appendable(path, dtype, chunk_rows,
+                                          shape, **kwargs)
+        if existing.shape[1:] != tuple(shape) \
+           or existing.maxshape[0] is not None:
+            raise TypeError("%s is not an appendable dataset with rows "
+                            "of shape %s" % (existing.name, str(shape)))
+        if existing.dtype != np.dtype(dtype):
+            raise TypeError("%s has data type %s, not %s"
+                            % (existing.name, str(existing.dtype),
+                               str(np.dtype(dtype))))
+        return AppendableDataset(self._paper.dataset_wrapper(self, existing,
+                                                             self._codelet))
+
     def require_dataset(self, path, *args, **kwargs):
-        ds = self._node.require_dataset(datapath(path), *args, **kwargs)
+        check_write_access()
+        ds = None
+        if datapath(path) not in self._node:
+            options = dict(kwargs)
+            options.update(zip(['shape', 'dtype', 'exact'], args))
+            options.pop('exact', None)
+            ds = self._reuse_storage(datapath(path), options)
+        if ds is None:
+            ds = self._node.require_dataset(datapath(path), *args, **kwargs)
         self._stamp_new_node(ds, "data")
         return DatasetWrapper(self, ds, self._codelet)
 
@@ -497,12 +1256,10 @@ class CodeFile(object):
 
 #
 # Initialize a paper registry that permits finding a paper
-# object through a unique id stored in the codelet names,
-# and a codelet registry for retrieving active codelets.
+# object through a unique id stored in the codelet names.
 #
 
 paper_registry = weakref.WeakValueDictionary()
-codelet_registry = weakref.WeakValueDictionary()
 
 #
 # Identify calls from inside a codelet in order to apply
@@ -511,68 +1268,169 @@ codelet_registry = weakref.WeakValueDictionary()
 
 def get_codelet_and_paper():
     """
-    :returns: the codelet from which this function was called,
-              and the paper containing it. Both values are None
-              if there is no codelet in the call chain.
+    :returns: the codelet run by the current thread, and the paper
+              containing it. Both values are None if no codelet
+              is being run.
     """
-    # Get the name of the source code file of the current
-    # module, which is also the module containing the Codelet class.
-    this_module = __file__
-    if os.path.splitext(this_module)[1] in ['.pyc', '.pyo']:
-            this_module = this_module[:-1]
-    # Get call stack minus the last entry, which is the
-    # method find_module itself.
-    stack = traceback.extract_stack()[:-1]
-    # Look for the entry corresponding to Codelet.run()
-    in_codelet = False
-    for filename, line_no, fn_name, command in stack:
-        if filename == this_module \
-           and command == "execcode(script, environment)":
-            in_codelet = True
-    if not in_codelet:
+    codelet = current_codelet()
+    if codelet is None:
         return None, None
-    # Look for an entry corresponding to codelet code.
-    # Extract its paper_id and use it to look up the paper
-    # in the registry.
-    for item in stack:
-        module_ref = item[0].split(':')
-        if len(module_ref) != 2:
-            # module_ref is a real filename
-            continue
-        paper_id, codelet = module_ref
-        if not codelet.startswith('/code'):
-            # module_ref is something other than a paper:codelet combo
-            return None, None
-        return codelet_registry.get((paper_id, codelet), None), \
-               paper_registry.get(paper_id, None)
-    return None, None
+    return codelet, codelet.paper
+
+#
+# Python modules stored in papers
+#
+
+def _module_node(paper, fullname):
+    # Return the node containing the code of a module stored in
+    # the paper and a flag indicating a package, or None.
+    node = paper.get_local_module(fullname)
+    if node is None:
+        return None
+    is_package = False
+    if node.is_group():
+        # Node is a group, so this should be a package
+        if '__init__' not in node:
+            # Not a package
+            return None
+        is_package = True
+        node = node['__init__']
+    if datatype(node) != "module" \
+       or ascii(node.attrs.get("ACTIVE_PAPER_LANGUAGE", "")) != "python":
+        # Node found but is not a Python module
+        return None
+    return node, is_package
+
+def _new_module(paper, fullname, node, is_package):
+    code = compile(ascii(node[...].flat[0]),
+                   ':'.join([paper._id(), node.name]),
+                   'exec')
+    module = imp.new_module(fullname)
+    module.__file__ = os.path.abspath(node.file.filename) + ':' + node.name
+    if is_package:
+        module.__path__ = []
+        module.__package__ = fullname
+    else:
+        module.__package__ = fullname.rpartition('.')[0]
+    return module, code
+
+#
+# Codelets, and the modules they import from the paper, use a
+# paper-specific import function that keeps the modules stored in the
+# paper in paper._local_modules instead of sys.modules. Nothing is
+# shared between papers, so no lock is required while a codelet runs.
+#
+
+class LocalImporter(object):
+
+    def __init__(self, paper):
+        self.paper = paper
+        self.modules = paper._local_modules
+        self.lock = threading.RLock()
+        # The builtins of modules loaded from the paper
+        self.builtins = dict(activepapers.utility.builtins.__dict__)
+        self.builtins['__import__'] = self
+        self._not_local = set()
+
+    def clear_cache(self):
+        """
+        Forget which names were found not to be modules in the paper.
+        """
+        self._not_local = set()
+
+    def is_local(self, name):
+        top_level = name.split('.')[0]
+        if top_level in self.modules:
+            return True
+        if top_level in self._not_local:
+            return False
+        if _module_node(self.paper, top_level) is not None:
+            return True
+        self._not_local.add(top_level)
+        return False
+
+    def __call__(self, name, globals=None, locals=None, fromlist=(), level=0):
+        return self.import_module(name, globals, fromlist, level,
+                                  current_codelet())
+
+    def import_module(self, name, globals=None, fromlist=(), level=0,
+                      codelet=None):
+        """
+        Import a module in the way of __import__.
+
+        :param codelet: the codelet that performs the import, whose
+                        activepapers.contents module is used
+        :type codelet: Codelet
+        """
+        if level > 0:
+            package = (globals or {}).get('__package__', None)
+            if not package or package.split('.')[0] not in self.modules:
+                return standard__import__(name, globals, None,
+                                          fromlist, level)
+            base = package.rsplit('.', level-1)[0]
+            name = base + '.' + name if name else base
+        if name == 'activepapers.contents' and codelet is not None \
+           and codelet._contents_module is not None:
+            if fromlist:
+                return codelet._contents_module
+            return codelet._contents_package
+        if self.is_local(name):
+            return self._import_local(name, fromlist)
+        return standard__import__(name, globals, None, fromlist, 0)
+
+    def _import_local(self, name, fromlist):
+        with self.lock:
+            parts = name.split('.')
+            for i in range(len(parts)):
+                module = self._load('.'.join(parts[:i+1]))
+            if not fromlist:
+                return self.modules[parts[0]]
+            if hasattr(module, '__path__'):
+                # Submodules named in fromlist are imported as well.
+                for item in fromlist:
+                    submodule = name + '.' + item
+                    if item != '*' and not hasattr(module, item) \
+                       and _module_node(self.paper, submodule) is not None:
+                        self._load(submodule)
+            return module
+
+    def _load(self, fullname):
+        module = self.modules.get(fullname, None)
+        if module is not None:
+            return module
+        found = _module_node(self.paper, fullname)
+        if found is None:
+            raise ImportError("No module named %s" % fullname)
+        module, code = _new_module(self.paper, fullname, *found)
+        module.__builtins__ = self.builtins
+        self.modules[fullname] = module
+        try:
+            execcode(code, module.__dict__)
+        except:
+            del self.modules[fullname]
+            raise
+        parent, _, child = fullname.rpartition('.')
+        if parent:
+            setattr(self.modules[parent], child, module)
+        return module
 
 #
 # Install an importer for accessing Python modules inside papers
+# from standard Python scripts (see activepapers.contents and
+# activepapers.exploration).
 #
 
 class Importer(object):
 
     def find_module(self, fullname, path=None):
         codelet, paper = get_codelet_and_paper()
-        if paper is None:
-            return None
-        node = paper.get_local_module(fullname)
-        if node is None:
-            # No corresponding node found
+        if paper is None or codelet is not None:
+            # Codelets import modules through LocalImporter.
             return None
-        is_package = False
-        if node.is_group():
-            # Node is a group, so this should be a package
-            if '__init__' not in node:
-                # Not a package
-                return None
-            is_package = True
-            node = node['__init__']
-        if datatype(node) != "module" \
-           or ascii(node.attrs.get("ACTIVE_PAPER_LANGUAGE", "")) != "python":
-            # Node found but is not a Python module
+        found = _module_node(paper, fullname)
+        if found is None:
             return None
+        node, is_package = found
         return ModuleLoader(paper, fullname, node, is_package)
 
 
@@ -594,18 +1452,9 @@ class ModuleLoader(object):
             if isinstance(loader, ModuleLoader):
                 assert loader.paper is self.paper
             return module
-        code = compile(ascii(self.node[...].flat[0]),
-                       ':'.join([self.paper._id(), self.node.name]),
-                       'exec')
-        module = imp.new_module(fullname)
-        module.__file__ = os.path.abspath(self.node.file.filename) + ':' + \
-                          self.node.name
+        module, code = _new_module(self.paper, fullname,
+                                   self.node, self._is_package)
         module.__loader__ = self
-        if self._is_package:
-            module.__path__ = []
-            module.__package__ = fullname
-        else:
-            module.__package__ = fullname.rpartition('.')[0]
         sys.modules[fullname] = module
         self.paper._local_modules[fullname] = module
         try:
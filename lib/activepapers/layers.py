@@ -0,0 +1,337 @@
+# Layered views of papers.
+#
+# A LayeredPaper combines a paper opened read-only (the lower layer)
+# with a writable HDF5 file (the upper layer), which by default lives
+# only in memory. Reads see the union of both layers, with the upper
+# layer taking precedence. All modifications go to the upper layer.
+# Groups of the lower layer are copied to the upper layer, with their
+# attributes but without their contents, as soon as they are accessed
+# ("copy-up"), such that new items can be added to them. Items of the
+# lower layer that are removed are hidden rather than deleted.
+#
+# The upper layer can later be merged into the writable paper with
+# merge_upper(). This is how codelets run in worker processes, see
+# activepapers.workers.
+
+import posixpath
+
+import h5py
+
+from activepapers.utility import owner, datatype
+from activepapers.execution import DataGroup
+import activepapers.storage
+
+
+def copy_attributes(source, dest):
+    """
+    Copy all attributes of an HDF5 node, keeping their data types.
+    """
+    for name in source.attrs:
+        dest.attrs.create(name, source.attrs[name],
+                          dtype=source.attrs.get_id(name).dtype)
+
+def _copy_up(upper_file, lower_file, path, track_order=False):
+    # Make sure that all groups along path exist in the upper layer.
+    group = upper_file['/']
+    for name in [n for n in path.split('/') if n]:
+        if name not in group:
+            new = activepapers.storage.create_group(group, name, track_order)
+            lower = lower_file.get(new.name, None)
+            if lower is not None:
+                copy_attributes(lower, new)
+        group = group[name]
+        if not isinstance(group, h5py.Group):
+            raise ValueError("%s is not a group" % group.name)
+    return group
+
+#
+# MergedGroup is a group in the upper layer that also shows the members
+# of the group with the same path in the lower layer. It is a subclass
+# of h5py.Group in order to be usable anywhere a group is expected,
+# in particular as the node of a DataGroup.
+#
+
+class MergedGroup(h5py.Group):
+
+    def __init__(self, upper, lower_file, track_order=False, hidden=None):
+        h5py.Group.__init__(self, upper.id)
+        self._upper = upper
+        self._lower_file = lower_file
+        self._track_order = track_order
+        # The paths of the hidden items of the lower layer,
+        # shared by all merged groups of a layered paper
+        self._hidden = set() if hidden is None else hidden
+
+    def _path(self, name):
+        if name.startswith('/'):
+            return posixpath.normpath(name)
+        return posixpath.normpath(posixpath.join(self._upper.name, name))
+
+    def _is_hidden(self, path):
+        while path != '/':
+            if path in self._hidden:
+                return True
+            path = posixpath.dirname(path)
+        return False
+
+    def _layers(self, path):
+        lower = None
+        if not self._is_hidden(path):
+            lower = self._lower_file.get(path, None)
+        return self._upper.file.get(path, None), lower
+
+    def _wrap(self, group):
+        return self.__class__(group, self._lower_file, self._track_order,
+                              self._hidden)
+
+    def merged_root(self):
+        return self._wrap(self._upper.file['/'])
+
+    def __getitem__(self, name):
+        if isinstance(name, h5py.Reference):
+            try:
+                return self._lower_file[name]
+            except ValueError:
+                return self._upper[name]
+        path = self._path(name)
+        upper, lower = self._layers(path)
+        if upper is None and lower is None:
+            raise KeyError("Unable to open object (object '%s' doesn't exist)"
+                           % name)
+        if isinstance(upper, h5py.Group) \
+           or (upper is None and isinstance(lower, h5py.Group)):
+            return self._wrap(_copy_up(self._upper.file, self._lower_file,
+                                       path, self._track_order))
+        return lower if upper is None else upper
+
+    def get(self, name, default=None, getclass=False, getlink=False):
+        if getclass or getlink:
+            raise NotImplementedError("getclass and getlink are not "
+                                      "supported for merged groups")
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        upper, lower = self._layers(self._path(name))
+        return upper is not None or lower is not None
+
+    def keys(self):
+        names = list(self._upper.keys())
+        lower = self._layers(self._upper.name)[1]
+        if isinstance(lower, h5py.Group):
+            present = set(names)
+            names.extend(name for name in lower
+                         if name not in present and not self._is_hidden(
+                             posixpath.join(lower.name, name)))
+        return names
+
+    def __iter__(self):
+        for name in self.keys():
+            yield name
+
+    def __len__(self):
+        return len(self.keys())
+
+    def values(self):
+        return [self[name] for name in self.keys()]
+
+    def items(self):
+        return [(name, self[name]) for name in self.keys()]
+
+    def visititems(self, func):
+        for name, node in self.items():
+            result = func(name, node)
+            if result is not None:
+                return result
+            if isinstance(node, h5py.Group):
+                result = node.visititems(lambda n, o: func(name + '/' + n, o))
+                if result is not None:
+                    return result
+
+    def visit(self, func):
+        return self.visititems(lambda name, node: func(name))
+
+    def _parent_for_new(self, name):
+        path = self._path(name)
+        if path in self:
+            raise ValueError("Unable to create %s (name already exists)"
+                             % path)
+        parent = _copy_up(self._upper.file, self._lower_file,
+                          posixpath.dirname(path), self._track_order)
+        return parent, posixpath.basename(path)
+
+    def create_group(self, name, track_order=None):
+        parent, name = self._parent_for_new(name)
+        group = parent.create_group(name, track_order=track_order)
+        return self._wrap(group)
+
+    def require_group(self, name):
+        if name in self:
+            group = self[name]
+            if not isinstance(group, h5py.Group):
+                raise TypeError("Incompatible object (%s) already exists"
+                                % group.__class__.__name__)
+            return group
+        return self.create_group(name, track_order=self._track_order)
+
+    def create_dataset(self, name, *args, **kwargs):
+        parent, name = self._parent_for_new(name)
+        return parent.create_dataset(name, *args, **kwargs)
+
+    def require_dataset(self, name, shape, dtype, exact=False, **kwargs):
+        if name in self:
+            ds = self[name]
+            if not isinstance(ds, h5py.Dataset):
+                raise TypeError("Incompatible object (%s) already exists"
+                                % ds.__class__.__name__)
+            if tuple(shape) != ds.shape:
+                raise TypeError("Shapes do not match (existing %s vs new %s)"
+                                % (ds.shape, shape))
+            return ds
+        return self.create_dataset(name, shape, dtype, **kwargs)
+
+    def __setitem__(self, name, obj):
+        parent, name = self._parent_for_new(name)
+        parent[name] = obj
+
+    def __delitem__(self, name):
+        path = self._path(name)
+        upper, lower = self._layers(path)
+        if lower is not None:
+            raise ValueError("%s is read-only" % path)
+        if upper is None:
+            raise KeyError(name)
+        del self._upper.file[path]
+
+    def __repr__(self):
+        return "<Merged HDF5 group %s>" % self._upper.name
+
+#
+# A read-only paper with a writable layer on top
+#
+
+class LayeredPaper(activepapers.storage.ActivePaper):
+
+    group_class = MergedGroup
+
+    def __init__(self, filename, upper=None, **kwargs):
+        """
+        :param filename: the name of the paper, which is opened read-only
+        :type filename: str
+        :param upper: the upper layer (default: a new in-memory file)
+        :type upper: h5py.File
+        :param kwargs: additional arguments to ActivePaper
+        """
+        activepapers.storage.ActivePaper.__init__(self, filename, 'r',
+                                                  **kwargs)
+        if upper is None:
+            upper = h5py.File('%s-upper-%x' % (filename, id(self)), 'w',
+                              driver='core', backing_store=False)
+        self.upper = upper
+        self.root = self.group_class(upper['/'], self.file,
+                                     self.track_order, set())
+        self.data_group = self.root['data']
+        self.documentation_group = self.root['documentation']
+        self.data = DataGroup(self, None, self.data_group,
+                              activepapers.storage.ExternalCode(self))
+        self.accesses = {}
+        self.runtimes = {}
+
+    def _internal_root(self):
+        return self.root
+
+    def create_group(self, parent, name):
+        if isinstance(parent, MergedGroup):
+            return parent.create_group(name, track_order=self.track_order)
+        return activepapers.storage.ActivePaper.create_group(self,
+                                                             parent, name)
+
+    def remove_owned_by(self, codelet):
+        # The lower layer is read-only, so its items are hidden.
+        for name in self.owned_by(codelet):
+            if name in self.upper:
+                del self.upper[name]
+            if name in self.file:
+                self.root._hidden.add(name)
+
+    def remove_row_outputs(self, calclet, row):
+        name = self.sweep_group_name(calclet, row)
+        if name in self.upper:
+            del self.upper[name]
+        if name in self.file:
+            self.root._hidden.add(name)
+
+    def _materialization_target(self):
+        # Recomputed items go to the upper layer.
+        return self
+
+    def store_runtime(self, codelet, seconds):
+        # Codelets of the lower layer are read-only.
+        node = self.upper.get(codelet, None)
+        if node is None:
+            self.runtimes[codelet] = seconds
+        else:
+            node.attrs['ACTIVE_PAPER_RUNTIME'] = seconds
+
+    def store_access_patterns(self, codelet, accesses):
+        for key, count in accesses.items():
+            per_codelet = self.accesses.setdefault(codelet, {})
+            per_codelet[key] = per_codelet.get(key, 0) + count
+
+    def store_checkpoint(self, codelet, state):
+        # The upper layer does not survive a crash of the process,
+        # so there is no point in keeping checkpoints.
+        pass
+
+    def remove_checkpoint(self, codelet):
+        pass
+
+    def upper_image(self):
+        """
+        :return: the contents of the upper layer as an HDF5 file image
+        :rtype: bytes
+        """
+        self.upper.flush()
+        return self.upper.id.get_file_image()
+
+    def close(self):
+        if self.open:
+            activepapers.storage.ActivePaper.close(self)
+            self.upper.close()
+
+#
+# Merging an upper layer into a paper
+#
+
+def merge_upper(upper, paper):
+    """
+    Add everything in the upper layer to a writable paper.
+
+    :param upper: the upper layer of a LayeredPaper
+    :type upper: h5py.File
+    :param paper: the paper that was the lower layer
+    :type paper: activepapers.storage.ActivePaper
+    :return: the names of the new items
+    :rtype: list
+    """
+    new_items = []
+    def merge(source, dest):
+        for name in source:
+            node = source[name]
+            existing = dest.get(name, None)
+            if isinstance(node, h5py.Group) \
+               and isinstance(existing, h5py.Group):
+                # A group that was copied up from the lower layer.
+                copy_attributes(node, existing)
+                merge(node, existing)
+            else:
+                if existing is not None:
+                    del dest[name]
+                dest.copy(node, dest, name)
+                new_items.append(dest[name].name)
+    for section in ['code', 'data', 'documentation']:
+        if section in upper:
+            merge(upper[section], paper.file[section])
+    return new_items
@@ -0,0 +1,312 @@
+# Lazy evaluation of array expressions over datasets.
+#
+# Calclets cannot use dask or similar libraries, so this module
+# provides a small replacement that is available as
+# activepapers.contents.lazy. Arithmetic on a LazyArray, including
+# numpy ufuncs and broadcasting, builds an expression graph. Nothing
+# is read until the expression is stored into a dataset, evaluated
+# with compute(), or reduced. Evaluation proceeds block by block along
+# the first axis, computing the complete expression for one block
+# before moving to the next one, such that intermediate results never
+# exist for more than one block at a time. Blocks can be evaluated
+# by several threads.
+#
+# Datasets are read through DatasetWrapper.__getitem__, so
+# dependencies and access patterns are recorded in the same way
+# as for direct reads.
+
+import multiprocessing.pool
+
+import numpy as np
+import h5py
+
+import activepapers.codec
+from activepapers.utility import stamp
+
+
+def wrap(array):
+    """
+    :param array: a dataset, an array, or a scalar
+    :return: a lazy array representing the same data
+    :rtype: LazyArray
+    """
+    if isinstance(array, LazyArray):
+        return array
+    if isinstance(array, h5py.Dataset) or hasattr(array, '_node'):
+        # h5py datasets and DatasetWrappers are read when needed.
+        return Source(array)
+    return Constant(array)
+
+#
+# The nodes of the expression graph
+#
+
+class LazyArray(object):
+
+    # Make binary operators on numpy arrays defer to lazy arrays.
+    __array_priority__ = 100
+
+    ndim = property(lambda self: len(self.shape))
+    size = property(lambda self: int(np.prod(self.shape)))
+
+    def __len__(self):
+        if not self.shape:
+            raise TypeError("len() of unsized object")
+        return self.shape[0]
+
+    def __repr__(self):
+        return "<%s shape %s, dtype %s>" % (self.__class__.__name__,
+                                            repr(self.shape),
+                                            str(self.dtype))
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != '__call__' or kwargs or ufunc.nout != 1:
+            return NotImplemented
+        return Elementwise(ufunc, [wrap(arg) for arg in inputs])
+
+    def astype(self, dtype):
+        return Elementwise(_Cast(dtype), [self])
+
+    def sum(self, axis=None, workers=None):
+        return self._reduce(np.add, axis, workers)
+
+    def prod(self, axis=None, workers=None):
+        return self._reduce(np.multiply, axis, workers)
+
+    def min(self, axis=None, workers=None):
+        return self._reduce(np.minimum, axis, workers)
+
+    def max(self, axis=None, workers=None):
+        return self._reduce(np.maximum, axis, workers)
+
+    def mean(self, axis=None, workers=None):
+        if axis is None:
+            n = self.size
+        else:
+            n = self.shape[axis]
+        total = self.astype(np.float64)._reduce(np.add, axis, workers)
+        return total / n
+
+    def _reduce(self, ufunc, axis, workers=None):
+        if axis is not None and axis < 0:
+            axis += self.ndim
+        if axis is not None and axis > 0:
+            return Reduction(ufunc, self, axis)
+        # Reductions along the first axis are evaluated immediately.
+        partials = [ufunc.reduce(block, axis=axis)
+                    for block in self._blocks(workers)]
+        return ufunc.reduce(np.array(partials), axis=0)
+
+    def _rows(self, start, stop, cache):
+        # Return the rows start:stop of the array, or all of it
+        # if start is None.
+        key = (id(self), start, stop)
+        if key not in cache:
+            cache[key] = self._evaluate(start, stop, cache)
+        return cache[key]
+
+    def _operand(self, ndim, start, stop, cache):
+        # Return the part of the array needed for rows start:stop of
+        # an expression of dimension ndim. Arrays that are broadcast
+        # along the first axis are needed completely.
+        if self.ndim == ndim and self.shape[0] != 1:
+            return self._rows(start, stop, cache)
+        return self._rows(None, None, cache)
+
+    def _selections(self, size=None, chunks=None):
+        return activepapers.codec.aligned_blocks(self.shape, chunks,
+                                                 self.dtype.itemsize,
+                                                 0, size)
+
+    def _blocks(self, workers=None, selections=None):
+        # Yield the values of the expression block by block, in order.
+        if self.ndim == 0:
+            yield self._rows(None, None, {})
+            return
+        if selections is None:
+            selections = self._selections()
+
+        def evaluate(selection):
+            rows = selection[0]
+            return self._rows(rows.start, rows.stop, {})
+
+        if workers is None or workers <= 1:
+            for selection in selections:
+                yield evaluate(selection)
+            return
+        # Blocks are evaluated in batches in order to keep
+        # the memory used by results waiting to be consumed bounded.
+        pool = multiprocessing.pool.ThreadPool(workers)
+        try:
+            for i in range(0, len(selections), 2*workers):
+                for block in pool.map(evaluate, selections[i:i+2*workers]):
+                    yield block
+        finally:
+            pool.close()
+            pool.join()
+
+    def compute(self, workers=None):
+        """
+        Evaluate the expression.
+
+        :param workers: the number of threads (default: no threads)
+        :type workers: int
+        :rtype: numpy.ndarray
+        """
+        if self.ndim == 0:
+            return next(self._blocks())
+        out = np.empty(self.shape, dtype=self.dtype)
+        start = 0
+        for block in self._blocks(workers):
+            out[start:start+len(block)] = block
+            start += len(block)
+        return out
+
+    def store(self, group, path, workers=None, size=None, **kwargs):
+        """
+        Evaluate the expression and store the result in a new dataset.
+
+        :param group: the group in which the dataset is created
+        :type group: activepapers.execution.DataGroup
+        :param path: the path of the new dataset relative to group
+        :type path: str
+        :param workers: the number of threads (default: no threads)
+        :type workers: int
+        :param size: the minimal number of rows evaluated at a time
+        :type size: int
+        :param kwargs: additional arguments to create_dataset,
+                       e.g. chunks or compression
+        :return: the new dataset
+        :rtype: activepapers.execution.DatasetWrapper
+        """
+        out = group.create_dataset(path, shape=self.shape,
+                                   dtype=self.dtype, **kwargs)
+        node = out._node
+        if self.ndim == 0:
+            node[()] = self.compute()
+        else:
+            # Blocks coincide with the chunks of the output dataset.
+            selections = self._selections(size, node.chunks)
+            for selection, block in zip(selections,
+                                        self._blocks(workers, selections)):
+                node[selection] = block
+        stamp(node, "data", out._codelet.dependency_attributes())
+        return out
+
+# Python operators are implemented through the corresponding ufuncs.
+for _name, _ufunc in [('add', np.add), ('sub', np.subtract),
+                      ('mul', np.multiply), ('truediv', np.true_divide),
+                      ('floordiv', np.floor_divide), ('mod', np.remainder),
+                      ('pow', np.power), ('and', np.bitwise_and),
+                      ('or', np.bitwise_or), ('xor', np.bitwise_xor)]:
+    def _make_operators(ufunc):
+        def op(self, other):
+            return Elementwise(ufunc, [self, wrap(other)])
+        def rop(self, other):
+            return Elementwise(ufunc, [wrap(other), self])
+        return op, rop
+    _op, _rop = _make_operators(_ufunc)
+    setattr(LazyArray, '__%s__' % _name, _op)
+    setattr(LazyArray, '__r%s__' % _name, _rop)
+for _name, _ufunc in [('lt', np.less), ('le', np.less_equal),
+                      ('gt', np.greater), ('ge', np.greater_equal),
+                      ('eq', np.equal), ('ne', np.not_equal)]:
+    setattr(LazyArray, '__%s__' % _name,
+            lambda self, other, ufunc=_ufunc:
+                Elementwise(ufunc, [self, wrap(other)]))
+for _name, _ufunc in [('neg', np.negative), ('pos', np.positive),
+                      ('abs', np.absolute), ('invert', np.invert)]:
+    setattr(LazyArray, '__%s__' % _name,
+            lambda self, ufunc=_ufunc: Elementwise(ufunc, [self]))
+LazyArray.__div__ = LazyArray.__truediv__
+LazyArray.__rdiv__ = LazyArray.__rtruediv__
+LazyArray.__hash__ = object.__hash__
+del _name, _ufunc, _op, _rop, _make_operators
+
+
+class Source(LazyArray):
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.shape = tuple(dataset.shape)
+        self.dtype = dataset.dtype
+
+    def _evaluate(self, start, stop, cache):
+        if start is None:
+            return np.asarray(self.dataset[...])
+        return self.dataset[start:stop]
+
+
+class Constant(LazyArray):
+
+    def __init__(self, value):
+        self.value = np.asarray(value)
+        self.shape = self.value.shape
+        self.dtype = self.value.dtype
+
+    def _evaluate(self, start, stop, cache):
+        if start is None:
+            return self.value
+        return self.value[start:stop]
+
+
+class _Cast(object):
+
+    nout = 1
+
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+
+    def __call__(self, array):
+        return np.asarray(array).astype(self.dtype)
+
+
+class Elementwise(LazyArray):
+
+    def __init__(self, ufunc, args):
+        self.ufunc = ufunc
+        self.args = args
+        self.shape = np.broadcast(*[np.empty(arg.shape, dtype=np.int8)
+                                    for arg in args]).shape
+        self.dtype = self._result_type()
+
+    def _result_type(self):
+        # Apply the ufunc to one element of each argument, keeping
+        # the distinction between arrays and scalars.
+        samples = []
+        for arg in self.args:
+            if isinstance(arg, Constant) and arg.ndim == 0:
+                samples.append(arg.value)
+            else:
+                samples.append(np.ones((1,) if arg.ndim else (),
+                                       dtype=arg.dtype))
+        with np.errstate(all='ignore'):
+            return np.asarray(self.ufunc(*samples)).dtype
+
+    def _evaluate(self, start, stop, cache):
+        ndim = self.ndim
+        if start is None:
+            operands = [arg._rows(None, None, cache) for arg in self.args]
+        else:
+            operands = [arg._operand(ndim, start, stop, cache)
+                        for arg in self.args]
+        return self.ufunc(*operands)
+
+
+class Reduction(LazyArray):
+
+    # A reduction along an axis other than the first one, which
+    # can be evaluated block by block.
+
+    def __init__(self, ufunc, arg, axis):
+        self.ufunc = ufunc
+        self.arg = arg
+        self.axis = axis
+        self.shape = arg.shape[:axis] + arg.shape[axis+1:]
+        self.dtype = np.asarray(ufunc.reduce(np.ones((1,)+(1,)*axis,
+                                                     dtype=arg.dtype),
+                                             axis=axis)).dtype
+
+    def _evaluate(self, start, stop, cache):
+        return self.ufunc.reduce(self.arg._rows(start, stop, cache),
+                                 axis=self.axis)
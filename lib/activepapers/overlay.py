@@ -0,0 +1,279 @@
+# Copy-on-write overlays of papers.
+#
+# An overlay is a small HDF5 file that refers to a paper (the base
+# paper) and stores only what was changed with respect to it. Opened
+# as an OverlayPaper, it presents the merged view of a LayeredPaper
+# (see activepapers.layers) whose upper layer is the overlay file:
+# items written in the overlay take precedence, items of the base
+# paper that were removed are hidden, and everything else is read from
+# the base paper, which is never modified. Datasets of the base paper
+# are copied into the overlay when they are first modified, and code
+# can be checked in as well. Experimenting with a large paper thus
+# costs only the storage for the items that actually change.
+#
+# An overlay is valid only as long as its base paper is unchanged,
+# because its items may depend on the contents of the base paper.
+# commit() applies the changes to the base paper and deletes the
+# overlay, discard() just deletes the overlay.
+
+import os
+import posixpath
+
+import numpy as np
+import h5py
+
+from activepapers.utility import ascii, h5vstring
+from activepapers.execution import AttrWrapper, DatasetWrapper, \
+                                   check_write_access
+from activepapers.layers import LayeredPaper, MergedGroup, merge_upper, \
+                                _copy_up
+import activepapers.storage
+
+_data_model = 'active-papers-overlay'
+
+# The paths of the hidden items of the base paper
+_hidden_name = 'overlay-hidden'
+
+
+def _base_version(filename):
+    # Any modification of the base paper changes its
+    # modification time or its size.
+    st = os.stat(filename)
+    return np.array([st.st_mtime, st.st_size], dtype=np.float64)
+
+def is_overlay(filename):
+    """
+    :param filename: the name of an HDF5 file
+    :type filename: str
+    :return: True if the file is an overlay
+    :rtype: bool
+    """
+    try:
+        with h5py.File(filename, 'r') as f:
+            return ascii(f.attrs.get('DATA_MODEL', '')) == _data_model
+    except (IOError, OSError):
+        return False
+
+def _base_paper(filename, overlay_file):
+    # The name of the base paper, after checking that it is unchanged.
+    if ascii(overlay_file.attrs.get('DATA_MODEL', '')) != _data_model:
+        raise ValueError("%s is not an overlay" % filename)
+    base = os.path.join(os.path.dirname(os.path.abspath(filename)),
+                        ascii(overlay_file.attrs['OVERLAY_BASE']))
+    if not os.path.exists(base):
+        raise ValueError("base paper %s of overlay %s does not exist"
+                         % (base, filename))
+    if not np.array_equal(_base_version(base),
+                          overlay_file.attrs['OVERLAY_BASE_VERSION']):
+        raise ValueError("base paper %s has changed since overlay %s "
+                         "was created" % (base, filename))
+    return base
+
+def _hidden_paths(overlay_file):
+    if _hidden_name not in overlay_file:
+        return []
+    return [ascii(path) for path in overlay_file[_hidden_name][...]]
+
+def create(base, filename):
+    """
+    Create an overlay for a paper.
+
+    :param base: the name of the base paper
+    :type base: str
+    :param filename: the name of the new overlay, which must not exist
+    :type filename: str
+    """
+    # Make sure that base is a paper.
+    activepapers.storage.ActivePaper(base, 'r').close()
+    base_path = os.path.relpath(os.path.abspath(base),
+                                os.path.dirname(os.path.abspath(filename)))
+    with h5py.File(filename, 'w-') as f:
+        f.attrs['DATA_MODEL'] = ascii(_data_model)
+        f.attrs['OVERLAY_BASE'] = ascii(base_path)
+        f.attrs['OVERLAY_BASE_VERSION'] = _base_version(base)
+
+def commit(filename):
+    """
+    Apply the changes in an overlay to its base paper,
+    and delete the overlay.
+
+    :param filename: the name of the overlay
+    :type filename: str
+    :return: the names of the items written to the base paper
+    :rtype: list
+    """
+    with h5py.File(filename, 'r') as upper:
+        base = _base_paper(filename, upper)
+        with activepapers.storage.ActivePaper(base, 'r+') as paper:
+            for path in sorted(_hidden_paths(upper)):
+                if path in paper.file:
+                    del paper.file[path]
+            written = merge_upper(upper, paper)
+    os.remove(filename)
+    return written
+
+def discard(filename):
+    """
+    Delete an overlay, leaving its base paper unchanged.
+
+    :param filename: the name of the overlay
+    :type filename: str
+    """
+    if not is_overlay(filename):
+        raise ValueError("%s is not an overlay" % filename)
+    os.remove(filename)
+
+#
+# Copy-on-write access to the base paper
+#
+
+class OverlayGroup(MergedGroup):
+
+    def copy_up(self, name):
+        """
+        :param name: the name of a dataset
+        :type name: str
+        :return: the dataset in the overlay, after copying it
+                 from the base paper if necessary
+        :rtype: h5py.Dataset
+        """
+        path = self._path(name)
+        upper, lower = self._layers(path)
+        if upper is not None or not isinstance(lower, h5py.Dataset):
+            return self[name]
+        parent = _copy_up(self._upper.file, self._lower_file,
+                          posixpath.dirname(path), self._track_order)
+        name = posixpath.basename(path)
+        parent.copy(lower, parent, name)
+        return parent[name]
+
+    def require_dataset(self, name, shape, dtype, exact=False, **kwargs):
+        if name in self:
+            self.copy_up(name)
+        return MergedGroup.require_dataset(self, name, shape, dtype,
+                                           exact, **kwargs)
+
+    def __delitem__(self, name):
+        path = self._path(name)
+        upper, lower = self._layers(path)
+        if upper is None and lower is None:
+            raise KeyError(name)
+        if upper is not None:
+            del self._upper.file[path]
+        if lower is not None:
+            self._hidden.add(path)
+
+class CopyOnWriteAttrs(AttrWrapper):
+
+    def __init__(self, dataset):
+        AttrWrapper.__init__(self, dataset._node)
+        self._dataset = dataset
+
+    def __setitem__(self, item, value):
+        if not AttrWrapper.forbidden(item):
+            self._dataset._writable_node()
+        AttrWrapper.__setitem__(self, item, value)
+
+    def __delitem__(self, item):
+        if not AttrWrapper.forbidden(item):
+            self._dataset._writable_node()
+        AttrWrapper.__delitem__(self, item)
+
+class CopyOnWriteDataset(DatasetWrapper):
+
+    """
+    A dataset that is copied from the base paper into the overlay
+    before its first modification, including that of an attribute.
+    """
+
+    def __init__(self, parent, ds, codelet, paper):
+        DatasetWrapper.__init__(self, parent, ds, codelet)
+        self._paper = paper
+        self.attrs = CopyOnWriteAttrs(self)
+
+    def _writable_node(self):
+        check_write_access()
+        if self._node.file == self._paper.file:
+            self._node = self._paper.root.copy_up(self._node.name)
+            self.attrs._node = self._node
+            self.ref = self._node.ref
+        return self._node
+
+    def __setitem__(self, item, value):
+        self._writable_node()
+        DatasetWrapper.__setitem__(self, item, value)
+
+    def resize(self, size, axis=None):
+        self._writable_node()
+        DatasetWrapper.resize(self, size, axis)
+
+    def write_direct(self, source, source_sel=None, dest_sel=None):
+        self._writable_node()
+        DatasetWrapper.write_direct(self, source, source_sel, dest_sel)
+
+    def write_parallel(self, array, workers=None):
+        self._writable_node()
+        DatasetWrapper.write_parallel(self, array, workers)
+
+class OverlayPaper(LayeredPaper):
+
+    group_class = OverlayGroup
+
+    def __init__(self, filename, **kwargs):
+        """
+        :param filename: the name of the overlay
+        :type filename: str
+        :param kwargs: additional arguments to ActivePaper
+        """
+        upper = h5py.File(filename, 'r+')
+        try:
+            base = _base_paper(filename, upper)
+        except ValueError:
+            upper.close()
+            raise
+        LayeredPaper.__init__(self, base, upper, **kwargs)
+        self.overlay_filename = filename
+        self.base_filename = base
+        self.root._hidden.update(_hidden_paths(upper))
+        # Code can be modified in the overlay as well.
+        self.code_group = self.root['code']
+
+    def dataset_wrapper(self, parent, ds, codelet):
+        return CopyOnWriteDataset(parent, ds, codelet, self)
+
+    def item_metadata(self):
+        # The metadata image of the base paper does not
+        # reflect the changes in the overlay.
+        node_metadata = activepapers.storage.node_metadata
+        return [node_metadata(node, True) for node in self.iter_items()] \
+               + [node_metadata(node, False) for node in self.iter_groups()]
+
+    def changes(self):
+        """
+        :return: the names of the datasets written in the overlay,
+                 and the names of the items of the base paper that
+                 were removed and not written again
+        :rtype: tuple of two lists
+        """
+        written = []
+        def collect(name, node):
+            if isinstance(node, h5py.Dataset):
+                written.append(node.name)
+        for section in ['code', 'data', 'documentation']:
+            if section in self.upper:
+                self.upper[section].visititems(collect)
+        removed = [path for path in self.root._hidden
+                   if path not in self.upper]
+        return sorted(written), sorted(removed)
+
+    def close(self):
+        if self.open:
+            if _hidden_name in self.upper:
+                del self.upper[_hidden_name]
+            hidden = sorted(self.root._hidden)
+            if hidden:
+                self.upper.create_dataset(_hidden_name,
+                                          data=np.array(hidden,
+                                                        dtype=object),
+                                          dtype=h5vstring)
+            LayeredPaper.close(self)
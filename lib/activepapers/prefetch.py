@@ -0,0 +1,179 @@
+# Prefetching of calclet inputs.
+#
+# The items generated by a calclet record the datasets it has read in
+# ACTIVE_PAPER_DEPENDENCIES. When calclets are run in sequence, as by
+# "aptool update" or ActivePaper.rebuild(), the inputs of the next
+# calclet can therefore be read while the current one is running.
+# A Prefetcher reads the file regions that contain the data of these
+# datasets in a background thread, through a file descriptor of its
+# own and in file order, which brings them into the operating system's
+# page cache. This does not use HDF5, so it does not compete with the
+# running calclet for h5py's global lock, and it does not keep any
+# data in memory beyond a single block. The total number of bytes
+# read for each calclet is bounded, such that prefetching does not
+# evict data that the current calclet still needs.
+
+import os
+import threading
+
+import h5py
+
+from activepapers.utility import ascii, owner
+
+
+def input_datasets(paper, calclet, running=None):
+    """
+    :param paper: an open ActivePaper
+    :param calclet: the path of a calclet
+    :type calclet: str
+    :param running: the path of a calclet that runs before, whose
+                    outputs will be replaced and are not included
+    :type running: str
+    :return: the paths of the existing datasets read by the calclet
+             during its last run, excluding those generated by the
+             calclet itself
+    :rtype: list
+    """
+    paths = set()
+    for name in paper.owned_by(calclet):
+        for dep in paper.get_node(name).attrs.get(
+                       'ACTIVE_PAPER_DEPENDENCIES', []):
+            dep = ascii(dep)
+            if dep.startswith('/data/'):
+                paths.add(dep)
+    skip = set([calclet])
+    if running is not None:
+        skip.add(running)
+    inputs = []
+    for path in sorted(paths):
+        ds = paper.file.get(path, None)
+        if isinstance(ds, h5py.Dataset) and owner(ds) not in skip:
+            inputs.append(path)
+    return inputs
+
+def storage_ranges(ds):
+    """
+    :param ds: an HDF5 dataset
+    :type ds: h5py.Dataset
+    :return: the (offset, size) pairs of the file regions
+             containing the data of the dataset
+    :rtype: list
+    """
+    dsid = ds.id
+    layout = dsid.get_create_plist().get_layout()
+    if layout == h5py.h5d.CONTIGUOUS:
+        offset = dsid.get_offset()
+        if offset is None:
+            return []
+        return [(offset, dsid.get_storage_size())]
+    if layout != h5py.h5d.CHUNKED:
+        # Compact data is stored with the metadata, and external
+        # or virtual data is not in the file.
+        return []
+    ranges = []
+    if hasattr(dsid, 'chunk_iter'):
+        dsid.chunk_iter(lambda info: ranges.append((info.byte_offset,
+                                                    info.size)))
+    elif hasattr(dsid, 'get_num_chunks'):
+        for i in range(dsid.get_num_chunks()):
+            info = dsid.get_chunk_info(i)
+            ranges.append((info.byte_offset, info.size))
+    return ranges
+
+def _merge(ranges):
+    # Sort the ranges by offset and combine adjacent ones.
+    merged = []
+    for offset, size in sorted(ranges):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            start, length = merged[-1]
+            merged[-1] = (start, max(length, offset + size - start))
+        else:
+            merged.append((offset, size))
+    return merged
+
+def _pread(fd, size, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+class Prefetcher(object):
+
+    def __init__(self, max_bytes=256*2**20, block_size=4*2**20):
+        """
+        :param max_bytes: the maximal number of bytes read
+                          for one calclet
+        :type max_bytes: int
+        :param block_size: the number of bytes read at a time
+        :type block_size: int
+        """
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.bytes_read = 0
+        self._thread = None
+        self._cancelled = None
+
+    def prefetch(self, h5file, paths):
+        """
+        Start reading the data of datasets, after cancelling
+        the previous prefetch.
+
+        :param h5file: the HDF5 file containing the datasets
+        :type h5file: h5py.File
+        :param paths: the paths of the datasets
+        :type paths: list
+        """
+        self.cancel()
+        ranges = []
+        for path in paths:
+            ds = h5file.get(path, None)
+            if isinstance(ds, h5py.Dataset):
+                ranges.extend(storage_ranges(ds))
+        ranges = _merge(ranges)
+        if not ranges:
+            return
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._read,
+                                        args=(h5file.filename, ranges,
+                                              self._cancelled))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self, filename, ranges, cancelled):
+        try:
+            fd = os.open(filename, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        except OSError:
+            return
+        try:
+            remaining = self.max_bytes
+            for offset, size in ranges:
+                end = offset + min(size, remaining)
+                remaining -= end - offset
+                while offset < end and not cancelled.is_set():
+                    n = len(_pread(fd, min(self.block_size, end - offset),
+                                   offset))
+                    if n == 0:
+                        return
+                    offset += n
+                    self.bytes_read += n
+                if remaining <= 0 or cancelled.is_set():
+                    return
+        finally:
+            os.close(fd)
+
+    def wait(self):
+        """
+        Wait until the current prefetch has finished.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def cancel(self):
+        """
+        Stop the current prefetch.
+        """
+        if self._cancelled is not None:
+            self._cancelled.set()
+        self.wait()
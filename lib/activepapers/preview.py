@@ -0,0 +1,171 @@
+# Preview runs of codelets on downsampled inputs.
+#
+# A PreviewPaper is a LayeredPaper (see activepapers.layers) in which
+# codelets see a subset of the rows of each dataset stored in the
+# paper: rows taken with a constant stride, or at random. The subset
+# is read only when a codelet first accesses the data, and it depends
+# only on the length of the dataset, so datasets of the same length
+# are sampled at the same rows. Everything a codelet writes goes to
+# the in-memory upper layer and disappears when the preview paper is
+# closed. The paper itself is opened read-only, so neither its data
+# nor its provenance change. This is meant for trying out a calclet
+# under development without waiting for a full run ("aptool run
+# --preview"), not for producing results.
+
+import numpy as np
+import h5py
+
+from activepapers.execution import DatasetWrapper
+from activepapers.layers import LayeredPaper
+
+
+def sample_rows(n, fraction, sampling='stride', seed=0):
+    """
+    :param n: the number of rows
+    :type n: int
+    :param fraction: the fraction of the rows to select
+    :type fraction: float
+    :param sampling: 'stride' or 'random'
+    :type sampling: str
+    :param seed: the seed for random sampling
+    :type seed: int
+    :return: the selected rows, as a slice or a sorted integer array
+    """
+    if not 0. < fraction <= 1.:
+        raise ValueError("the fraction must be between 0 and 1")
+    count = max(1, int(round(n*fraction)))
+    if sampling == 'stride':
+        step = max(1, n // count)
+        return slice(0, step*count, step)
+    if sampling == 'random':
+        rng = np.random.RandomState(seed)
+        return np.sort(rng.choice(n, count, replace=False))
+    raise ValueError("unknown sampling method %s" % sampling)
+
+
+class SampledDataset(DatasetWrapper):
+
+    """
+    A read-only view of a subset of the rows of a dataset.
+    """
+
+    def __init__(self, parent, ds, codelet, rows):
+        DatasetWrapper.__init__(self, parent, ds, codelet)
+        self._rows = rows
+        self._sample = None
+        if isinstance(rows, slice):
+            n = len(range(*rows.indices(ds.shape[0])))
+        else:
+            n = len(rows)
+        self.shape = (n,) + ds.shape[1:]
+        self.size = int(np.prod(self.shape))
+        self.nbytes = self.size*ds.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _data(self):
+        if self._sample is None:
+            if self._codelet is not None:
+                self._codelet.record_region(self._node)
+            self._sample = self._node[self._rows]
+        return self._sample
+
+    def __getitem__(self, item):
+        value = self._data()[item]
+        if isinstance(value, np.ndarray):
+            # Like h5py, return a new array.
+            value = value.copy()
+        return value
+
+    def _read_only(self, *args, **kwargs):
+        raise IOError("%s is a preview sample and cannot be modified"
+                      % self._node.name)
+
+    __setitem__ = resize = write_direct = write_parallel = _read_only
+
+    def read_direct(self, dest, source_sel=None, dest_sel=None):
+        if source_sel is None:
+            source_sel = Ellipsis
+        if dest_sel is None:
+            dest_sel = Ellipsis
+        dest[dest_sel] = self._data()[source_sel]
+
+    def read_parallel(self, workers=None):
+        return self[...]
+
+    def iter_chunks(self, axis=0, size=None):
+        data = self._data()
+        if size is None:
+            chunks = self._node.chunks
+            size = chunks[axis] if chunks is not None else data.shape[axis]
+        size = max(1, size)
+        index = [slice(None)]*data.ndim
+        for start in range(0, data.shape[axis], size):
+            index[axis] = slice(start, start+size)
+            yield data[tuple(index)].copy()
+
+    def __repr__(self):
+        return "Preview sample of dataset %s, shape %s, dtype %s" \
+               % (self._node.name, repr(self.shape), str(self.dtype))
+
+
+class PreviewPaper(LayeredPaper):
+
+    def __init__(self, filename, fraction, sampling='stride', seed=0,
+                 **kwargs):
+        """
+        :param filename: the name of the paper, which is opened read-only
+        :type filename: str
+        :param fraction: the fraction of the rows of each dataset
+                         that codelets see
+        :type fraction: float
+        :param sampling: 'stride' or 'random', see sample_rows()
+        :type sampling: str
+        :param seed: the seed for random sampling
+        :type seed: int
+        :param kwargs: additional arguments to LayeredPaper
+        """
+        # Check the arguments before opening the file.
+        sample_rows(1, fraction, sampling, seed)
+        LayeredPaper.__init__(self, filename, **kwargs)
+        self.fraction = fraction
+        self.sampling = sampling
+        self.seed = seed
+
+    def dataset_wrapper(self, parent, ds, codelet):
+        # Datasets written during the preview are not sampled.
+        if ds.file != self.file or len(ds.shape) == 0 or ds.shape[0] < 2:
+            return LayeredPaper.dataset_wrapper(self, parent, ds, codelet)
+        rows = sample_rows(ds.shape[0], self.fraction, self.sampling,
+                           self.seed)
+        return SampledDataset(parent, ds, codelet, rows)
+
+    def run_codelet(self, path, debug=False, isolated=False, resume=False,
+                    row=None):
+        if isolated:
+            raise ValueError("preview runs cannot be isolated")
+        full_path = path if path.startswith('/') else '/code/' + path
+        table = self.parameter_table(full_path)
+        if table is None or row is not None:
+            return LayeredPaper.run_codelet(self, path, debug, False,
+                                            resume, row)
+        # All instances of a parameter sweep
+        errors = [LayeredPaper.run_codelet(self, path, debug, row=row)
+                  for row in range(len(table))]
+        errors = [error for error in errors if error is not None]
+        return ''.join(errors) if errors else None
+
+    def outputs(self):
+        """
+        :return: the datasets written during the preview
+        :rtype: list
+        """
+        datasets = []
+        def collect(name, node):
+            if isinstance(node, h5py.Dataset):
+                datasets.append(node)
+        for section in ['data', 'documentation']:
+            if section in self.upper:
+                self.upper[section].visititems(collect)
+        return datasets
@@ -0,0 +1,277 @@
+# Region-level dependency tracking.
+#
+# In papers created with track_regions=True, calclets record the
+# regions they read from each dataset, and every partial modification
+# of a dataset is recorded in a log stored with the dataset. An item
+# that depends on a modified dataset is then stale only if one of the
+# regions modified after its creation overlaps a region it has read.
+# Whenever the information is incomplete, the decision falls back to
+# the comparison of modification times of whole datasets.
+#
+# A region is a bounding box, given as a tuple of (start, stop) pairs,
+# one per axis. Reads and modifications of arbitrary shape are
+# represented by their bounding boxes, which is conservative.
+# A read that extends to the end of an axis, such as ds[...] or
+# ds[-10:], also depends on the length of the dataset, so its region
+# is open-ended: it overlaps everything appended to the dataset.
+#
+# The modification log of a dataset is stored in two attributes:
+#  - ACTIVE_PAPER_MODIFIED_REGIONS is an integer array in which each
+#    row contains the modification time (in ms since the epoch)
+#    followed by the start and stop of the region along each axis.
+#  - ACTIVE_PAPER_REGIONS_SINCE is the time after which the log is
+#    complete. Modifications before this time are not recorded.
+#
+# The regions an item depends on are stored in its attribute
+# ACTIVE_PAPER_DEPENDENCY_REGIONS as strings of the form
+# "/data/path 0:100,0:3".
+
+import numpy as np
+
+from activepapers.utility import ascii, isstring, ms_since_epoch
+
+# The maximal number of regions recorded per dataset, both in
+# modification logs and for the reads of a calclet. Beyond this
+# limit, regions are merged into their bounding boxes.
+max_regions = 32
+
+# The stop value of open-ended regions
+unbounded = 2**62
+
+
+def selection_bounds(shape, item):
+    """
+    :param shape: the shape of a dataset
+    :type shape: tuple
+    :param item: an index expression as passed to __getitem__
+    :return: the bounding box of the selected elements,
+             or None if the index expression is not understood
+    :rtype: tuple
+    """
+    if not isinstance(item, tuple):
+        item = (item,)
+    # Field names select parts of each element.
+    item = tuple(i for i in item if not isstring(i))
+    if any(i is Ellipsis for i in item):
+        n = item.index(Ellipsis)
+        item = item[:n] + (len(shape)-len(item)+1)*(slice(None),) \
+               + item[n+1:]
+    item = item + (len(shape)-len(item))*(slice(None),)
+    if len(item) != len(shape):
+        return None
+    bounds = []
+    for index, n in zip(item, shape):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(n)
+            count = len(range(start, stop, step))
+            if count == 0:
+                bounds.append((0, 0))
+            elif step > 0:
+                bounds.append((start, start+(count-1)*step+1))
+            else:
+                bounds.append((start+(count-1)*step, start+1))
+        elif isinstance(index, (int, np.integer)):
+            index = int(index)
+            if index < 0:
+                index += n
+            bounds.append((index, index+1))
+        else:
+            try:
+                index = np.asarray(index)
+            except Exception:
+                return None
+            if index.dtype == np.bool_:
+                selected = np.nonzero(index)[0]
+            elif index.dtype.kind in 'iu':
+                selected = index.ravel() % max(n, 1)
+            else:
+                return None
+            if len(selected) == 0:
+                bounds.append((0, 0))
+            else:
+                bounds.append((int(selected.min()), int(selected.max())+1))
+    return tuple(bounds)
+
+def full_region(shape):
+    """
+    :return: the region covering a complete dataset of the given shape
+    :rtype: tuple
+    """
+    return tuple((0, n) for n in shape)
+
+def read_region(shape, item):
+    """
+    :param shape: the shape of a dataset
+    :type shape: tuple
+    :param item: an index expression as passed to __getitem__
+    :return: the region that a read of the selection depends on
+    :rtype: tuple
+    """
+    bounds = selection_bounds(shape, item)
+    if bounds is None:
+        bounds = full_region(shape)
+    return tuple((start, unbounded if stop >= n else stop)
+                 for (start, stop), n in zip(bounds, shape))
+
+def is_empty(region):
+    return any(start >= stop for start, stop in region)
+
+def overlap(region1, region2):
+    """
+    :return: True if the two regions have an element in common
+    :rtype: bool
+    """
+    if len(region1) != len(region2):
+        # The rank of the dataset has changed.
+        return True
+    if is_empty(region1) or is_empty(region2):
+        return False
+    return all(start1 < stop2 and start2 < stop1
+               for (start1, stop1), (start2, stop2) in zip(region1, region2))
+
+def bounding_box(region1, region2):
+    return tuple((min(start1, start2), max(stop1, stop2))
+                 for (start1, stop1), (start2, stop2)
+                 in zip(region1, region2))
+
+def _union_is_box(region1, region2):
+    # The union of two boxes is a box if they are identical along
+    # all axes but one, along which they touch or overlap.
+    different = [(a, b) for a, b in zip(region1, region2) if a != b]
+    if len(different) > 1:
+        return False
+    if not different:
+        return True
+    (start1, stop1), (start2, stop2) = different[0]
+    return start1 <= stop2 and start2 <= stop1
+
+def add_region(regions, region):
+    """
+    Add a region to a list of regions, merging regions where this is
+    possible without loss of precision, and into bounding boxes when
+    the list would otherwise grow beyond max_regions.
+
+    :return: the new list of regions
+    :rtype: list
+    """
+    if is_empty(region):
+        return regions
+    regions = list(regions)
+    for i, other in enumerate(regions):
+        if len(other) == len(region) and _union_is_box(other, region):
+            regions[i] = bounding_box(other, region)
+            return regions
+    regions.append(region)
+    if len(regions) > max_regions:
+        regions[:2] = [bounding_box(regions[0], regions[1])]
+    return regions
+
+def format_region(region):
+    """
+    :return: the region in slice notation, e.g. "0:100,0:3"
+    :rtype: str
+    """
+    return ','.join('%d:' % start if stop >= unbounded
+                    else '%d:%d' % (start, stop)
+                    for start, stop in region)
+
+def parse_region(text):
+    if not text:
+        return ()
+    region = []
+    for bounds in text.split(','):
+        start, stop = bounds.split(':')
+        region.append((int(start), int(stop) if stop else unbounded))
+    return tuple(region)
+
+#
+# Modification logs of datasets
+#
+
+def log_modification(node, region):
+    """
+    Record the modification of a region of a dataset. This must
+    be done before the dataset is stamped.
+
+    :param node: an HDF5 dataset
+    :type node: h5py.Dataset
+    :param region: the modified region, or None for the whole dataset
+    :type region: tuple
+    """
+    if region is None:
+        region = full_region(node.shape)
+    if len(region) == 0 or is_empty(region):
+        return
+    attrs = node.attrs
+    now = ms_since_epoch()
+    log = attrs.get('ACTIVE_PAPER_MODIFIED_REGIONS', None)
+    if log is None or log.shape[1] != 1+2*len(region):
+        # Everything that happened up to the previous modification
+        # is summarized by the dataset's timestamp.
+        attrs['ACTIVE_PAPER_REGIONS_SINCE'] = \
+                 attrs.get('ACTIVE_PAPER_TIMESTAMP', now)
+        entries = []
+    else:
+        entries = [(int(row[0]), tuple(zip(row[1::2], row[2::2])))
+                   for row in log]
+    if entries and _union_is_box(entries[-1][1], region):
+        # Successive modifications of adjacent regions,
+        # typically appends, are combined.
+        entries[-1] = (now, bounding_box(entries[-1][1], region))
+    else:
+        entries.append((now, tuple(region)))
+    if len(entries) > max_regions:
+        (t1, r1), (t2, r2) = entries[:2]
+        entries[:2] = [(max(t1, t2), bounding_box(r1, r2))]
+    attrs['ACTIVE_PAPER_MODIFIED_REGIONS'] = \
+        np.array([[t] + [n for bounds in r for n in bounds]
+                  for t, r in entries], dtype=np.int64)
+
+def modified_since(node, time):
+    """
+    :param node: an HDF5 dataset
+    :type node: h5py.Dataset
+    :param time: a time in seconds since the epoch
+    :type time: float
+    :return: the regions of the dataset modified after time,
+             or None if the modification log does not cover this time
+    :rtype: list
+    """
+    since = node.attrs.get('ACTIVE_PAPER_REGIONS_SINCE', None)
+    log = node.attrs.get('ACTIVE_PAPER_MODIFIED_REGIONS', None)
+    if since is None or log is None or since/1000. > time:
+        return None
+    return [tuple(zip((int(n) for n in row[1::2]),
+                      (int(n) for n in row[2::2])))
+            for row in log if row[0]/1000. > time]
+
+#
+# Regions read by a calclet
+#
+
+def encode_dependency_regions(regions):
+    """
+    :param regions: a dictionary mapping dataset paths to lists
+                    of regions
+    :type regions: dict
+    :return: the strings stored in ACTIVE_PAPER_DEPENDENCY_REGIONS
+    :rtype: list
+    """
+    return [ascii('%s %s' % (path, format_region(region)))
+            for path in sorted(regions)
+            for region in regions[path]]
+
+def dependency_regions(node):
+    """
+    :param node: an item in a paper
+    :type node: h5py.Node
+    :return: a dictionary mapping dataset paths to the list of regions
+             of the dataset that the item depends on. Dependencies that
+             are not in the dictionary are on complete datasets.
+    :rtype: dict
+    """
+    regions = {}
+    for entry in node.attrs.get('ACTIVE_PAPER_DEPENDENCY_REGIONS', []):
+        path, _, region = ascii(entry).partition(' ')
+        regions.setdefault(path, []).append(parse_region(region))
+    return regions
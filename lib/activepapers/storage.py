@@ -5,6 +5,7 @@ import importlib
 import io
 import itertools as it
 import os
+import posixpath
 import socket
 import sys
 import weakref
@@ -14,9 +15,14 @@ import h5py
 
 from activepapers.utility import ascii, utf8, h5vstring, isstring, execcode, \
                                  codepath, datapath, owner, mod_time, \
-                                 datatype, timestamp, stamp, ms_since_epoch
-from activepapers.execution import Calclet, Importlet, DataGroup, paper_registry
+                                 datatype, timestamp, stamp, ms_since_epoch, \
+                                 parameter_row_id
+from activepapers.execution import Calclet, Importlet, DataGroup, \
+                                   LocalImporter, paper_registry, \
+                                   clear_incremental_state, DatasetWrapper
 from activepapers.library import find_in_library
+import activepapers.codec
+import activepapers.regions
 import activepapers.version
 
 readme_text = """
@@ -28,6 +34,386 @@ For more information about ActivePapers see:
 """
 
 
+#
+# HDF5 file format
+#
+# By default, papers are created with h5py's default format bounds,
+# which are the earliest format versions that can represent the
+# contents. This maximizes compatibility with old software.
+# Papers created with a newer format (libver='latest' or one of the
+# explicit versions accepted by h5py) use compact or indexed link
+# storage for groups, which is much faster for groups with many
+# members, dense attribute storage, creation order tracking, and
+# persistent free-space tracking.
+#
+
+def file_format_options(mode, libver):
+    """
+    :return: keyword arguments for h5py.File
+    :rtype: dict
+    """
+    options = {}
+    if libver is None:
+        return options
+    options['libver'] = libver
+    if mode[0] == 'w' and libver != 'earliest':
+        options['track_order'] = True
+        options['fs_strategy'] = 'fsm'
+        options['fs_persist'] = True
+    return options
+
+#
+# HDF5 cache configuration
+#
+# The settings are
+#  - rdcc_nbytes, rdcc_nslots, rdcc_w0: the raw data chunk cache,
+#    see h5py.File
+#  - mdc_initial_size, mdc_min_size, mdc_max_size: the metadata cache
+#  - page_buf_size: the size of the page buffer, which is used only
+#    for papers created with paged file space aggregation
+#  - page_size: the file space page size for newly created papers.
+#    Setting it enables paged aggregation.
+#
+# Settings come from a preset, from environment variables, and from
+# the cache argument of ActivePaper, in increasing order of priority.
+# The preset is the value of the environment variable
+# ACTIVEPAPERS_CACHE, unless specified explicitly as cache='name' or
+# cache={'preset': 'name', ...}. Individual settings are taken from
+# environment variables such as ACTIVEPAPERS_CACHE_RDCC_NBYTES.
+#
+
+MB = 1024*1024
+
+cache_presets = {
+    # HDF5's defaults
+    'default': {},
+    # Many small metadata reads, e.g. "aptool ls -l" or
+    # dependency analysis on papers with many items.
+    'metadata': dict(mdc_initial_size=16*MB, mdc_min_size=4*MB,
+                     mdc_max_size=64*MB, page_buf_size=16*MB,
+                     page_size=64*1024),
+    # Random slicing in large chunked datasets
+    'random-access': dict(rdcc_nbytes=256*MB, rdcc_nslots=100003,
+                          rdcc_w0=0.75),
+    # Reading or writing datasets from beginning to end
+    'sequential': dict(rdcc_nbytes=64*MB, rdcc_nslots=12421, rdcc_w0=1.),
+    # Small metadata reads interleaved with large array reads
+    'mixed': dict(mdc_initial_size=8*MB, mdc_min_size=2*MB,
+                  mdc_max_size=32*MB, rdcc_nbytes=128*MB,
+                  rdcc_nslots=50021, rdcc_w0=0.75,
+                  page_buf_size=8*MB, page_size=64*1024),
+}
+
+cache_setting_types = dict(rdcc_nbytes=int, rdcc_nslots=int, rdcc_w0=float,
+                           mdc_initial_size=int, mdc_min_size=int,
+                           mdc_max_size=int, page_buf_size=int,
+                           page_size=int)
+
+def cache_settings(cache=None):
+    """
+    :param cache: a preset name, or a dictionary of settings, which
+                  may contain a preset name under the key 'preset'
+    :return: the complete cache settings
+    :rtype: dict
+    """
+    if cache is None:
+        cache = {}
+    elif isstring(cache):
+        cache = {'preset': cache}
+    cache = dict(cache)
+    preset = cache.pop('preset', None)
+    if preset is None:
+        preset = os.environ.get('ACTIVEPAPERS_CACHE', 'default')
+    if preset not in cache_presets:
+        raise ValueError("unknown cache preset %s" % preset)
+    settings = dict(cache_presets[preset])
+    for name, type_ in cache_setting_types.items():
+        value = os.environ.get('ACTIVEPAPERS_CACHE_' + name.upper(), None)
+        if value is not None:
+            settings[name] = type_(value)
+    for name, value in cache.items():
+        if name not in cache_setting_types:
+            raise ValueError("unknown cache setting %s" % name)
+        settings[name] = value
+    return settings
+
+def cache_options(mode, settings):
+    """
+    :return: keyword arguments for h5py.File
+    :rtype: dict
+    """
+    # HDF5 ignores the page buffer size for files that were not
+    # created with paged aggregation.
+    options = dict((name, settings[name])
+                   for name in ['rdcc_nbytes', 'rdcc_nslots', 'rdcc_w0',
+                                'page_buf_size']
+                   if name in settings)
+    if mode[0] == 'w' and 'page_size' in settings:
+        options['fs_strategy'] = 'page'
+        options['fs_persist'] = True
+        options['fs_page_size'] = settings['page_size']
+    return options
+
+def configure_metadata_cache(h5file, settings):
+    if not any(name.startswith('mdc_') for name in settings):
+        return
+    config = h5file.id.get_mdc_config()
+    max_size = settings.get('mdc_max_size', config.max_size)
+    min_size = min(settings.get('mdc_min_size', config.min_size), max_size)
+    initial_size = settings.get('mdc_initial_size', config.initial_size)
+    config.max_size = max_size
+    config.min_size = min_size
+    config.initial_size = max(min_size, min(initial_size, max_size))
+    config.set_initial_size = True
+    h5file.id.set_mdc_config(config)
+
+#
+# Compact storage for small items
+#
+# In papers created with compact=True, code items, references, and
+# scalar datasets use HDF5's compact layout, which keeps the data
+# inside the object header, so that reading such an item requires
+# a single metadata read. Code and references are stored as
+# fixed-length strings for this purpose, because variable-length
+# strings would still live in the global heap. Items too large for
+# compact storage are stored in the standard way.
+#
+
+compact_size_limit = 60000
+
+def compact_dcpl():
+    """
+    :return: a dataset creation property list for compact storage
+    :rtype: h5py.h5p.PropDCID
+    """
+    dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+    dcpl.set_layout(h5py.h5d.COMPACT)
+    return dcpl
+
+def create_compact_dataset(group, name, data):
+    """
+    Create a scalar dataset with compact layout. h5py ignores
+    the dataset creation property list for scalar datasets,
+    so the dataset is created through the low-level interface.
+
+    :param group: the parent group
+    :type group: h5py.Group
+    :param name: the name of the new dataset
+    :type name: str
+    :param data: the scalar value
+    :type data: numpy.ndarray
+    :rtype: h5py.Dataset
+    """
+    data = np.asarray(data)
+    lcpl = h5py.h5p.create(h5py.h5p.LINK_CREATE)
+    lcpl.set_create_intermediate_group(True)
+    lcpl.set_char_encoding(h5py.h5t.CSET_UTF8)
+    h5py.h5d.create(group.id, name.encode('utf-8'),
+                    h5py.h5t.py_create(data.dtype, logical=True),
+                    h5py.h5s.create(h5py.h5s.SCALAR),
+                    dcpl=compact_dcpl(), lcpl=lcpl)
+    ds = group[name]
+    ds[...] = data
+    return ds
+
+# The options of create_dataset that are taken into account when
+# looking for a reusable slot. Datasets created with any other
+# option get new storage.
+_slot_options = frozenset(['chunks', 'maxshape', 'compression',
+                           'compression_opts', 'shuffle', 'fletcher32',
+                           'scaleoffset', 'fillvalue'])
+
+def _slot_matches(ds, shape, dtype, kwargs):
+    # Return True if the dataset ds has the storage layout that
+    # create_dataset would give to a new dataset.
+    if set(kwargs) - _slot_options:
+        return False
+    if ds.shape != shape or ds.dtype != dtype \
+       or ds.id.get_create_plist().get_layout() == h5py.h5d.COMPACT:
+        return False
+    maxshape = kwargs.get('maxshape', None)
+    if maxshape is None:
+        maxshape = shape
+    if tuple(ds.maxshape) != tuple(maxshape):
+        return False
+    compression = kwargs.get('compression', None)
+    compression_opts = kwargs.get('compression_opts', None)
+    if isinstance(compression, (int, np.integer)) \
+       and not isinstance(compression, bool):
+        compression, compression_opts = 'gzip', int(compression)
+    if compression == 'gzip' and compression_opts is None:
+        compression_opts = 4
+    if ds.compression != compression \
+       or (compression is not None
+           and ds.compression_opts != compression_opts):
+        return False
+    shuffle = bool(kwargs.get('shuffle', False))
+    fletcher32 = bool(kwargs.get('fletcher32', False))
+    scaleoffset = kwargs.get('scaleoffset', None)
+    if ds.shuffle != shuffle or ds.fletcher32 != fletcher32 \
+       or ds.scaleoffset != scaleoffset:
+        return False
+    chunks = kwargs.get('chunks', None)
+    if isinstance(chunks, (tuple, list)):
+        if ds.chunks != tuple(chunks):
+            return False
+    elif chunks or compression is not None or shuffle or fletcher32 \
+         or scaleoffset is not None or tuple(maxshape) != shape:
+        # Any chunk shape is acceptable where h5py would choose one.
+        if ds.chunks is None:
+            return False
+    elif ds.chunks is not None:
+        return False
+    fillvalue = kwargs.get('fillvalue', None)
+    if fillvalue is None:
+        fillvalue = 0
+    return bool(np.all(ds.fillvalue == np.asarray(fillvalue, dtype=dtype)))
+
+def _as_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+def _fixed_length_value(value, dtype):
+    if dtype.names is None:
+        value = _as_bytes(value)
+        fixed = np.dtype('S%d' % max(1, len(value)))
+    else:
+        value = tuple(_as_bytes(v) for v in value)
+        fixed = np.dtype([(name, 'S%d' % max(1, len(v)))
+                          for name, v in zip(dtype.names, value)])
+    return np.array(value, dtype=fixed)
+
+def create_group(parent, name, track_order=False):
+    if track_order:
+        return parent.create_group(name, track_order=True)
+    else:
+        return parent.create_group(name)
+
+def _copy_group_contents(source, dest, track_order):
+    for attr_name in source.attrs:
+        attr_id = source.attrs.get_id(attr_name)
+        dest.attrs.create(attr_name, source.attrs[attr_name],
+                          dtype=attr_id.dtype)
+    for name in source:
+        link = source.get(name, getlink=True)
+        if isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+            dest[name] = link
+            continue
+        node = source[name]
+        if isinstance(node, h5py.Group):
+            _copy_group_contents(node, create_group(dest, name, track_order),
+                                 track_order)
+        else:
+            dest.copy(node, name, expand_refs=True)
+
+def upgrade(filename, libver='latest'):
+    """
+    Rewrite a paper with a different HDF5 file format. Groups are
+    re-created in the new format, datasets are copied unchanged
+    with all their attributes, including timestamps.
+
+    :param filename: the name of the paper's file
+    :type filename: str
+    :param libver: the new format, as accepted by h5py.File
+    :type libver: str
+    """
+    repack(filename, libver)
+
+def repack(filename, libver=None):
+    """
+    Rewrite a paper into a new file, which releases the space of
+    deleted items. HDF5 cannot shrink a file otherwise.
+
+    :param filename: the name of the paper's file
+    :type filename: str
+    :param libver: the new format, as accepted by h5py.File
+                   (default: the paper's current format)
+    :type libver: str
+    """
+    directory, name = os.path.split(os.path.abspath(filename))
+    tmp_filename = os.path.join(directory, '.' + name + '.repack')
+    with h5py.File(filename, 'r') as source:
+        if ascii(source.attrs.get('DATA_MODEL', '')) != 'active-papers-py':
+            raise ValueError("File %s is not an ActivePaper" % filename)
+        if libver is None and 'HDF5_LIBVER' in source.attrs:
+            libver = ascii(source.attrs['HDF5_LIBVER'])
+        with h5py.File(tmp_filename, 'w',
+                       **file_format_options('w', libver)) as dest:
+            _copy_group_contents(source, dest,
+                                 libver not in [None, 'earliest'])
+            if libver is not None:
+                dest.attrs['HDF5_LIBVER'] = ascii(libver)
+    os.rename(tmp_filename, filename)
+
+#
+# The table of dataset access statistics
+#
+access_dtype = np.dtype([('dataset', h5vstring),
+                         ('codelet', h5vstring),
+                         ('selection', h5vstring),
+                         ('count', np.int64)])
+
+#
+# The metadata image
+#
+# Listing the items of a paper, or finding their dependencies, requires
+# reading the object header and attributes of every item, which for
+# a large paper means many small reads scattered over the file.
+# A paper can therefore store a copy of this metadata in a single
+# table, the metadata image, which is written when a writable paper
+# is closed. Opening a paper for writing deletes the image, and the
+# image records the length of the history table, which grows with
+# every writable open, so an outdated image is never used.
+#
+# The image is enabled per paper (ActivePaper(..., metadata_image=True),
+# which is remembered in the paper) or for all papers by setting the
+# environment variable ACTIVEPAPERS_METADATA_IMAGE to 1.
+#
+
+ItemMetadata = collections.namedtuple('ItemMetadata',
+                                      ['name', 'is_item', 'datatype',
+                                       'timestamp', 'owner',
+                                       'dependencies', 'dummy',
+                                       'parameter_row'])
+
+metadata_image_dtype = np.dtype([('name', h5vstring),
+                                 ('is_item', np.bool_),
+                                 ('datatype', h5vstring),
+                                 ('timestamp', np.float64),
+                                 ('owner', h5vstring),
+                                 ('dependencies', h5vstring),
+                                 ('dummy', np.bool_),
+                                 ('parameter_row', h5vstring)])
+
+def node_metadata(node, is_item):
+    """
+    :param node: an item or a group in a paper
+    :type node: h5py.Node
+    :param is_item: True if node is an item, False if it is a group
+                    containing items
+    :type is_item: bool
+    :rtype: ItemMetadata
+    """
+    attrs = node.attrs
+    t = attrs.get('ACTIVE_PAPER_TIMESTAMP', None)
+    deps = attrs.get('ACTIVE_PAPER_DEPENDENCIES', [])
+    row_id = attrs.get('ACTIVE_PAPER_PARAMETER_ROW', None)
+    return ItemMetadata(node.name, is_item, datatype(node),
+                        None if t is None else t/1000.,
+                        owner(node),
+                        tuple(ascii(dep) for dep in deps),
+                        bool(attrs.get('ACTIVE_PAPER_DUMMY_DATASET', False)),
+                        None if row_id is None else ascii(row_id))
+
+def _metadata_image_enabled(h5file, metadata_image):
+    if metadata_image is not None:
+        return metadata_image
+    if h5file.attrs.get('METADATA_IMAGE', False):
+        return True
+    return os.environ.get('ACTIVEPAPERS_METADATA_IMAGE', '0') \
+             not in ['', '0']
+
 #
 # The ActivePaper class is the only one in this library
 # meant to be used directly by client code.
@@ -35,9 +421,76 @@ For more information about ActivePapers see:
 
 class ActivePaper(object):
 
-    def __init__(self, filename, mode="r", dependencies=None):
+    def __init__(self, filename, mode="r", dependencies=None,
+                 record_access=False, libver=None, cache=None,
+                 compact=False, metadata_image=None, track_regions=False,
+                 reuse_storage=False, array_cache=None, in_memory=False,
+                 write_back=False):
+        """
+        :param in_memory: if True, the paper is kept in memory using
+                          HDF5's core driver. An existing paper is read
+                          completely when opened. For a new paper, the
+                          filename can be None.
+        :type in_memory: bool
+        :param write_back: if True, an in-memory paper is written to
+                           its file when it is closed. Otherwise all
+                           changes are lost, unless the paper is saved
+                           with save_as().
+        :type write_back: bool
+        """
+        if write_back and not in_memory:
+            raise ValueError("write_back requires in_memory")
+        if write_back and (filename is None or mode == 'r'):
+            raise ValueError("write_back requires a file name "
+                             "and a writable paper")
+        if filename is None:
+            if not in_memory:
+                raise ValueError("a file name is required")
+            filename = 'in-memory-%x.ap' % id(self)
         self.filename = filename
-        self.file = h5py.File(filename, mode)
+        self.in_memory = in_memory
+        self.write_back = write_back
+        # If True, calclets record the shape of all dataset reads,
+        # see store_access_patterns().
+        self.record_access = record_access
+        # If True, calclets write new outputs into the storage of
+        # their previous outputs, see retain_owned_by().
+        self.reuse_storage = reuse_storage
+        # An activepapers.arraycache.ArrayCache for complete reads
+        # of datasets, which can be shared with other papers.
+        self.array_cache = array_cache
+        self.cache_settings = cache_settings(cache)
+        options = cache_options(mode, self.cache_settings)
+        options.update(file_format_options(mode, libver))
+        if mode[0] == 'w' and 'fs_page_size' in options:
+            # Paged aggregation replaces the free-space strategy
+            # chosen by file_format_options.
+            options['fs_strategy'] = 'page'
+        if in_memory:
+            options['driver'] = 'core'
+            options['backing_store'] = write_back
+        self.file = h5py.File(filename, mode, **options)
+        if mode[0] == 'r' and libver is None:
+            libver = ascii(self.file.attrs.get('HDF5_LIBVER', 'earliest'))
+            if '+' in mode and libver != 'earliest':
+                # Reopen with the same format bounds as at creation time,
+                # to make sure that new groups use the same format.
+                self.file.close()
+                options['libver'] = libver
+                self.file = h5py.File(filename, mode, **options)
+        configure_metadata_cache(self.file, self.cache_settings)
+        self.libver = libver
+        self.compact = compact \
+                       or bool(self.file.attrs.get('COMPACT_STORAGE', False))
+        if self.compact and h5py.version.version_tuple[:2] < (3, 0):
+            raise ValueError("compact storage requires h5py 3.0 or later")
+        # If True, dependencies are tracked at the level of dataset
+        # regions, see activepapers.regions.
+        self.track_regions = track_regions \
+                       or bool(self.file.attrs.get('TRACK_REGIONS', False))
+        # Groups created in papers using the newer file format
+        # keep track of the creation order of their members.
+        self.track_order = libver not in [None, 'earliest']
         self.open = True
         self.writable = False
         if mode[0] == 'r':
@@ -61,9 +514,16 @@ class ActivePaper(object):
             self.file.attrs['DATA_MODEL'] = ascii('active-papers-py')
             self.file.attrs['DATA_MODEL_MAJOR_VERSION'] = 0
             self.file.attrs['DATA_MODEL_MINOR_VERSION'] = 1
-            self.code_group = self.file.create_group("code")
-            self.data_group = self.file.create_group("data")
-            self.documentation_group = self.file.create_group("documentation")
+            if libver is not None:
+                self.file.attrs['HDF5_LIBVER'] = ascii(libver)
+            if compact:
+                self.file.attrs['COMPACT_STORAGE'] = True
+            if track_regions:
+                self.file.attrs['TRACK_REGIONS'] = True
+            self.code_group = self.create_group(self.file, "code")
+            self.data_group = self.create_group(self.file, "data")
+            self.documentation_group = self.create_group(self.file,
+                                                         "documentation")
             deps = self.file.create_group('external-dependencies')
             if dependencies is None:
                 self.dependencies = []
@@ -96,18 +556,35 @@ class ActivePaper(object):
 
         if self.writable:
             self.update_history(close=False)
+            if 'metadata-image' in self.file:
+                del self.file['metadata-image']
+            if metadata_image:
+                self.file.attrs['METADATA_IMAGE'] = True
+            elif metadata_image is not None \
+                 and 'METADATA_IMAGE' in self.file.attrs:
+                del self.file.attrs['METADATA_IMAGE']
+        self.metadata_image = _metadata_image_enabled(self.file,
+                                                      metadata_image)
+        self._item_metadata = None
 
         import activepapers.utility
         self.data = DataGroup(self, None, self.data_group, ExternalCode(self))
         self.imported_modules = {}
 
         self._local_modules = {}
+        self._importer = LocalImporter(self)
 
         paper_registry[self._id()] = self
 
     def _id(self):
         return hex(id(self))[2:]
 
+    def create_group(self, parent, name):
+        """
+        Create an HDF5 group using the file format conventions of the paper.
+        """
+        return create_group(parent, name, self.track_order)
+
     def update_history(self, close):
         if close:
             entry = tuple(self.history[-1])
@@ -134,7 +611,14 @@ class ActivePaper(object):
         if self.open:
             if self.writable:
                 self.update_history(close=True)
+                if self.metadata_image:
+                    self.store_metadata_image()
             del self._local_modules
+            del self._importer
+            sidecar = getattr(self, '_sidecar', None)
+            if sidecar is not None:
+                sidecar.close()
+                self._sidecar = None
             self.open = False
             try:
                 self.file.close()
@@ -146,6 +630,26 @@ class ActivePaper(object):
             except KeyError:
                 pass
 
+    def save_as(self, filename):
+        """
+        Write a copy of the paper in its current state to a file,
+        which is in particular the way to keep an in-memory paper.
+        The paper remains open.
+
+        :param filename: the name of the new file
+        :type filename: str
+        """
+        self.assert_is_open()
+        if self.writable:
+            # The copy must look like a paper that has been closed.
+            self.update_history(close=True)
+            if self.metadata_image:
+                self.store_metadata_image()
+        self.file.flush()
+        image = self.file.id.get_file_image()
+        with open(filename, 'wb') as f:
+            f.write(image)
+
     def assert_is_open(self):
         if not self.open:
             raise ValueError("ActivePaper %s has been closed" % self.filename)
@@ -160,6 +664,33 @@ class ActivePaper(object):
     def flush(self):
         self.file.flush()
 
+    def release_file(self):
+        """
+        Close the HDF5 file of a writable paper temporarily, e.g.
+        to let another process open it. All h5py objects obtained
+        from the paper become invalid.
+        """
+        assert self.writable
+        if self.in_memory:
+            raise ValueError("the file of an in-memory paper "
+                             "cannot be released")
+        self.file.close()
+
+    def reacquire_file(self):
+        """
+        Reopen the HDF5 file after release_file().
+        """
+        options = cache_options('r+', self.cache_settings)
+        if self.libver not in [None, 'earliest']:
+            options['libver'] = self.libver
+        self.file = h5py.File(self.filename, 'r+', **options)
+        configure_metadata_cache(self.file, self.cache_settings)
+        self.code_group = self.file["code"]
+        self.data_group = self.file["data"]
+        self.documentation_group = self.file["documentation"]
+        self.history = self.file['history']
+        self.data = DataGroup(self, None, self.data_group, ExternalCode(self))
+
     def _create_ref(self, path, paper_ref, ref_path, group, prefix):
         if ref_path is None:
             ref_path = path
@@ -173,9 +704,9 @@ class ActivePaper(object):
         # Access the item to make sure it exists
         item = getattr(paper, group)[ref_path]
         ref_dtype = np.dtype([('paper_ref', h5vstring), ('path', h5vstring)])
-        ds = getattr(self, group).require_dataset(path, shape=(),
-                                                  dtype=ref_dtype)
-        ds[...] = (paper_ref, prefix + ref_path)
+        ds = self._store_small_item(getattr(self, group), path,
+                                    (paper_ref, prefix + ref_path),
+                                    ref_dtype)
         stamp(ds, 'reference', {})
         return ds
 
@@ -225,12 +756,34 @@ class ActivePaper(object):
         if not isstring(code):
             raise TypeError("Python code must be a string (is %s)"
                             % str(type(code)))
-        ds = self.code_group.require_dataset(path,
-                                             dtype=h5vstring, shape = ())
-        ds[...] = code.encode('utf-8')
+        ds = self._store_small_item(self.code_group, path,
+                                    code.encode('utf-8'), h5vstring)
         ds.attrs['ACTIVE_PAPER_LANGUAGE'] = "python"
         return ds
 
+    def _store_small_item(self, group, path, value, dtype):
+        """
+        Store a scalar string or string tuple, replacing any previous
+        value but keeping the attributes of the dataset.
+        """
+        if self.compact:
+            fixed = _fixed_length_value(value, dtype)
+            if fixed.dtype.itemsize <= compact_size_limit:
+                attrs = []
+                previous = group.get(path, None)
+                if previous is not None:
+                    attrs = [(name, previous.attrs[name],
+                              previous.attrs.get_id(name).dtype)
+                             for name in previous.attrs]
+                    del group[path]
+                ds = create_compact_dataset(group, path, fixed)
+                for name, attr_value, attr_dtype in attrs:
+                    ds.attrs.create(name, attr_value, dtype=attr_dtype)
+                return ds
+        ds = group.require_dataset(path, shape=(), dtype=dtype)
+        ds[...] = value
+        return ds
+
     def add_module(self, name, module_code):
         path = codepath('/'.join(['', 'python-packages'] + name.split('.')))
         ds = self.store_python_code(path, module_code)
@@ -268,14 +821,199 @@ class ActivePaper(object):
         path = codepath('/'.join(['', 'python-packages'] + name.split('.')))
         return APNode(self.code_group).get(path, None)
         
-    def create_calclet(self, path, script):
+    def create_calclet(self, path, script, incremental=False,
+                       parameters=None):
+        """
+        :param incremental: if True, the calclet keeps its outputs from
+                            one run to the next and processes only the
+                            rows added to its inputs in the meantime,
+                            see mark_incremental()
+        :type incremental: bool
+        :param parameters: the name of a dataset whose rows are the
+                           parameters of the calclet's instances,
+                           see set_parameter_table()
+        :type parameters: str
+        """
         path = codepath(path)
         if not path.startswith('/'):
             path = '/'.join([self.code_group.name, path])
         ds = self.store_python_code(path, script)
         stamp(ds, "calclet", {})
+        if incremental:
+            self.mark_incremental(ds)
+        if parameters is not None:
+            self.set_parameter_table(ds, parameters)
         return Calclet(self, ds)
 
+    def mark_incremental(self, node):
+        """
+        Declare a calclet incremental. When an incremental calclet is
+        run again, the items it generated are not removed, and
+        activepapers.contents.new_rows(path) returns the rows of a
+        dataset that were added since the previous run. The calclet
+        is expected to append the results for these rows to its
+        outputs. If anything else has changed, in particular rows
+        processed earlier, the calclet is run on all the data, as
+        indicated by activepapers.contents.is_incremental_run.
+
+        The detection of modified rows requires region tracking,
+        which is therefore enabled for the paper.
+
+        :param node: the calclet
+        :type node: h5py.Dataset
+        """
+        if datatype(node) != 'calclet':
+            raise ValueError("%s is not a calclet" % node.name)
+        node.attrs['ACTIVE_PAPER_INCREMENTAL'] = True
+        if not self.track_regions:
+            self.track_regions = True
+            self.file.attrs['TRACK_REGIONS'] = True
+
+    #
+    # Parameter sweeps
+    #
+    # A calclet with a parameter table is run once for each row of
+    # the table. Each instance sees its row as
+    # activepapers.contents.parameters and stores its results in
+    # activepapers.contents.output, the group /data/<calclet>/<row>,
+    # where <calclet> is the calclet's path relative to /code. The
+    # outputs record the row and a hash of its contents, which replace
+    # the modification time of the table in staleness checks, so that
+    # changing a row makes only the outputs of that row stale.
+    #
+
+    def set_parameter_table(self, node, parameters):
+        """
+        Make a calclet a parameter sweep.
+
+        :param node: the calclet
+        :type node: h5py.Dataset
+        :param parameters: the name of the parameter table, a dataset
+                           in /data with one row per instance
+        :type parameters: str
+        """
+        if datatype(node) != 'calclet':
+            raise ValueError("%s is not a calclet" % node.name)
+        if node.attrs.get('ACTIVE_PAPER_INCREMENTAL', False):
+            raise ValueError("incremental calclets cannot have parameters")
+        parameters = datapath(parameters)
+        if not parameters.startswith('/'):
+            parameters = '/data/' + parameters
+        node.attrs['ACTIVE_PAPER_PARAMETERS'] = parameters
+
+    def parameter_table(self, calclet):
+        """
+        :param calclet: the path of a calclet
+        :type calclet: str
+        :return: the parameter table of the calclet, or None
+        :rtype: h5py.Dataset
+        """
+        root = self._internal_root()
+        node = root.get(calclet, None)
+        if node is None or 'ACTIVE_PAPER_PARAMETERS' not in node.attrs:
+            return None
+        name = ascii(node.attrs['ACTIVE_PAPER_PARAMETERS'])
+        table = root.get(name, None)
+        if not isinstance(table, h5py.Dataset) or table.shape == ():
+            raise ValueError("parameter table %s of %s is not an array"
+                             % (name, calclet))
+        return table
+
+    def sweep_group_name(self, calclet, row=None):
+        """
+        :param calclet: the path of a calclet with a parameter table
+        :type calclet: str
+        :param row: a row of the parameter table
+        :type row: int
+        :return: the name of the group containing the outputs of
+                 all instances, or of the instance for row
+        :rtype: str
+        """
+        assert calclet.startswith('/code/')
+        name = '/data/' + calclet[6:]
+        if row is not None:
+            name = '%s/%d' % (name, row)
+        return name
+
+    def stale_rows(self, calclet):
+        """
+        :param calclet: the path of a calclet with a parameter table
+        :type calclet: str
+        :return: the rows whose instances have no outputs, dummy
+                 outputs, or stale outputs
+        :rtype: list
+        """
+        table = self.parameter_table(calclet)
+        root = self._internal_root()
+        rows = []
+        for row in range(len(table)):
+            group = root.get(self.sweep_group_name(calclet, row), None)
+            if group is None or owner(group) != calclet \
+               or self.is_stale(group):
+                rows.append(row)
+                continue
+            items = []
+            group.visititems(lambda name, node: items.append(node))
+            if any(self.is_dummy(item) or self.is_stale(item)
+                   for item in items if owner(item) is not None):
+                rows.append(row)
+        return rows
+
+    def remove_row_outputs(self, calclet, row):
+        """
+        Remove the outputs of one instance of a calclet
+        with a parameter table.
+        """
+        name = self.sweep_group_name(calclet, row)
+        if name in self.file:
+            del self.file[name]
+
+    def run_sweep(self, path, rows=None, processes=None):
+        """
+        Run instances of a calclet with a parameter table.
+
+        :param path: the path of the calclet, relative to /code
+        :type path: str
+        :param rows: the rows of the parameter table for which the
+                     calclet is run (default: those returned by
+                     stale_rows())
+        :type rows: list
+        :param processes: the number of worker processes running
+                          the instances at the same time (default:
+                          run the instances in this process)
+        :type processes: int
+        :return: a dictionary mapping each row to None, or to the
+                 traceback if an exception occurred
+        :rtype: dict
+        """
+        if path.startswith('/'):
+            assert path.startswith('/code/')
+            path = path[6:]
+        calclet = '/code/' + path
+        table = self.parameter_table(calclet)
+        if table is None:
+            raise ValueError("%s has no parameter table" % calclet)
+        # Remove the outputs of rows that no longer exist.
+        name = self.sweep_group_name(calclet)
+        group = self._internal_root().get(name, None)
+        for row in (list(group) if group is not None else []):
+            if not row.isdigit() or int(row) >= len(table):
+                if owner(group[row]) == calclet:
+                    del group[row]
+        if rows is None:
+            rows = self.stale_rows(calclet)
+        rows = list(rows)
+        if processes is None:
+            return dict((row, self.run_codelet(path, row=row))
+                        for row in rows)
+        import activepapers.workers
+        pool = activepapers.workers.WorkerPool(processes)
+        try:
+            errors = pool.run_codelets(self, len(rows)*[path], rows)
+        finally:
+            pool.close()
+        return dict(zip(rows, errors))
+
     def create_importlet(self, path, script):
         path = codepath(path)
         if not path.startswith('/'):
@@ -284,14 +1022,56 @@ class ActivePaper(object):
         stamp(ds, "importlet", {})
         return Importlet(self, ds)
 
-    def run_codelet(self, path, debug=False):
+    def run_codelet(self, path, debug=False, isolated=False, resume=False,
+                    row=None):
+        """
+        Run a codelet. For a calclet with a parameter table, this runs
+        the instances whose outputs are stale, see run_sweep().
+
+        :param path: the path of the codelet, relative to /code
+        :type path: str
+        :param debug: if True, start the debugger when an exception occurs
+        :type debug: bool
+        :param isolated: if True, run the codelet in a worker process
+                         (see activepapers.workers)
+        :type isolated: bool
+        :param resume: if True, continue an unfinished run from its
+                       last checkpoint, if there is a valid one
+        :type resume: bool
+        :param row: for a calclet with a parameter table, run only
+                    the instance for this row
+        :type row: int
+        :return: None, or the traceback if an exception occurred
+        :rtype: str
+        """
         if path.startswith('/'):
             assert path.startswith('/code/')
             path = path[6:]
+        if row is None and self.parameter_table('/code/' + path) is not None:
+            if debug or resume:
+                raise ValueError("parameter sweeps cannot be debugged "
+                                 "or resumed")
+            errors = self.run_sweep(path, processes=1 if isolated else None)
+            errors = [errors[row] for row in sorted(errors)
+                      if errors[row] is not None]
+            return ''.join(errors) if errors else None
+        if isolated:
+            if debug:
+                raise ValueError("isolated codelets cannot be debugged")
+            if resume:
+                raise ValueError("isolated codelets cannot be resumed")
+            import activepapers.workers
+            return activepapers.workers.default_pool().run_codelet(self, path,
+                                                                   row)
         node = APNode(self.code_group)[path]
         class_ = {'calclet': Calclet, 'importlet': Importlet}[datatype(node)]
         try:
-            class_(self, node).run()
+            if row is None:
+                class_(self, node).run(resume)
+            elif class_ is Calclet:
+                class_(self, node).run(resume, row)
+            else:
+                raise ValueError("importlets cannot have parameters")
             return None
         except Exception:
             # TODO: preprocess traceback to show only the stack frames
@@ -333,13 +1113,27 @@ class ActivePaper(object):
             else:
                 return tb_text
 
+    def dataset_wrapper(self, parent, ds, codelet):
+        """
+        :return: the object through which codelets access a dataset,
+                 see activepapers.preview for an alternative
+        :rtype: DatasetWrapper
+        """
+        return DatasetWrapper(parent, ds, codelet)
+
     def calclets(self):
         return dict((item.name,
                      Calclet(self, item))
                     for item in self.iter_items()
                     if datatype(item) == 'calclet')
 
-    def remove_owned_by(self, codelet):
+    def owned_by(self, codelet):
+        """
+        :param codelet: the path of a codelet
+        :type codelet: str
+        :return: the names of the items generated by the codelet
+        :rtype: list
+        """
         def owned(group):
             nodes = []
             for node in group.values():
@@ -349,11 +1143,284 @@ class ActivePaper(object):
                    and datatype(node) != 'data':
                     nodes.extend(owned(node))
             return nodes
-        for group in [self.code_group,
-                      self.data_group,
-                      self.documentation_group]:
-            for node_name in owned(group):
-                del self.file[node_name]
+        return sum((owned(group) for group in [self.code_group,
+                                               self.data_group,
+                                               self.documentation_group]),
+                   [])
+
+    def remove_owned_by(self, codelet):
+        for node_name in self.owned_by(codelet):
+            del self.file[node_name]
+        node = self.file.get(codelet, None)
+        if node is not None and self.writable:
+            # An incremental calclet whose outputs are gone
+            # must process all the data again.
+            clear_incremental_state(node)
+            self.remove_checkpoint(codelet)
+
+    #
+    # Reuse of dataset storage
+    #
+    # In papers opened with reuse_storage=True, the datasets generated
+    # by a calclet are not deleted before it is run again. They are
+    # moved to /reusable-storage, where the calclet cannot see them,
+    # and kept as slots. When the calclet creates a dataset whose
+    # shape, data type, and storage options match those of a slot,
+    # the slot is moved back and overwritten in place, so that the
+    # new dataset occupies the storage of the old one. Slots that
+    # have not been reused at the end of the run are deleted.
+    # Only datasets at the top level of the calclet's outputs are
+    # retained, groups and their contents are deleted as usual.
+    #
+
+    def _slot_group_name(self, codelet):
+        return 'reusable-storage/' + codelet[1:].replace('/', ':')
+
+    def retain_owned_by(self, codelet):
+        """
+        Move the datasets generated by a codelet to its slots,
+        including slots left over from an interrupted run.
+
+        :param codelet: the path of a codelet
+        :type codelet: str
+        :return: the names of the slots
+        :rtype: list
+        """
+        name = self._slot_group_name(codelet)
+        group = self.file.get(name, None)
+        if group is None:
+            if 'reusable-storage' not in self.file:
+                self.create_group(self.file, 'reusable-storage')
+            group = self.create_group(self.file['reusable-storage'],
+                                      posixpath.basename(name))
+        n = len(group)
+        for node_name in self.owned_by(codelet):
+            node = self.file[node_name]
+            if node_name.startswith('/data/') \
+               and isinstance(node, h5py.Dataset) \
+               and not self.is_dummy(node):
+                while str(n) in group:
+                    n += 1
+                self.file.move(node_name, '/%s/%d' % (name, n))
+        return [node.name for node in group.values()]
+
+    def reuse_slot(self, slots, group, path, kwargs, initialize=True):
+        """
+        Look for a slot that can hold a new dataset, and if there is one,
+        move it to the dataset's place and fill it with the initial data.
+
+        :param slots: the names of the available slots, from which the
+                      slot that is used is removed
+        :type slots: list
+        :param group: the group in which the dataset is created
+        :type group: h5py.Group
+        :param path: the path of the new dataset relative to group
+        :type path: str
+        :param kwargs: the keyword arguments to create_dataset
+        :type kwargs: dict
+        :param initialize: if False, the caller writes the complete
+                           dataset, so the slot is not filled
+        :type initialize: bool
+        :return: the new dataset, or None if no slot is suitable
+        :rtype: h5py.Dataset
+        """
+        kwargs = dict(kwargs)
+        data = kwargs.pop('data', None)
+        shape = kwargs.pop('shape', None)
+        dtype = kwargs.pop('dtype', None)
+        if data is not None:
+            if isinstance(data, (h5py.HLObject, h5py.Reference)):
+                return None
+            data = np.asarray(data)
+            if shape is None:
+                shape = data.shape
+            if dtype is None:
+                dtype = data.dtype
+        if shape is None:
+            return None
+        if isinstance(shape, (int, np.integer)):
+            shape = (shape,)
+        shape = tuple(int(n) for n in shape)
+        # The default data type is the one used by h5py.
+        dtype = np.dtype('f4' if dtype is None else dtype)
+        if dtype.kind not in 'biufc' \
+           or (data is not None and data.shape != shape):
+            return None
+        parent = posixpath.dirname(path)
+        if parent and not isinstance(group.get(parent, None), h5py.Group):
+            return None
+        for name in slots:
+            ds = self.file[name]
+            if _slot_matches(ds, shape, dtype, kwargs):
+                break
+        else:
+            return None
+        slots.remove(name)
+        target = posixpath.join(group.name, path)
+        self.file.move(name, target)
+        ds = self.file[target]
+        for attr in list(ds.attrs):
+            del ds.attrs[attr]
+        if data is not None:
+            ds[...] = data
+        elif not initialize:
+            pass
+        elif ds.shape == ():
+            ds[()] = ds.fillvalue
+        else:
+            fill = None
+            for selection in activepapers.codec.aligned_blocks(
+                                 ds.shape, ds.chunks, ds.dtype.itemsize):
+                rows = selection[0]
+                n = rows.stop - rows.start
+                if fill is None or len(fill) != n:
+                    fill = np.full((n,) + ds.shape[1:], ds.fillvalue,
+                                   dtype=ds.dtype)
+                ds[selection] = fill
+        return ds
+
+    def release_slots(self, codelet):
+        """
+        Delete the slots of a codelet that have not been reused.
+
+        :param codelet: the path of a codelet
+        :type codelet: str
+        """
+        name = self._slot_group_name(codelet)
+        if name in self.file:
+            del self.file[name]
+            if len(self.file['reusable-storage']) == 0:
+                del self.file['reusable-storage']
+
+    #
+    # Checkpoints of long-running codelets
+    #
+    # A checkpoint contains the state passed to
+    # activepapers.contents.checkpoint(), together with what is needed
+    # to continue the run later: the dependencies of the codelet up to
+    # that point, with their timestamps, and the items the codelet has
+    # generated so far. A run can be resumed from its checkpoint only
+    # if neither the codelet nor any of these dependencies has changed
+    # since. Items generated after the checkpoint are removed when the
+    # run is resumed, and datasets that were extended after the
+    # checkpoint are truncated to their length at the checkpoint.
+    #
+
+    def _checkpoint_name(self, codelet):
+        return 'checkpoints/' + codelet[1:].replace('/', ':')
+
+    def checkpoints(self):
+        """
+        :return: the paths of the codelets that have a checkpoint
+                 of an unfinished run
+        :rtype: list
+        """
+        group = self.file.get('checkpoints', None)
+        if group is None:
+            return []
+        return ['/' + name.replace(':', '/') for name in group]
+
+    def has_checkpoint(self, codelet):
+        return codelet is not None \
+               and self._checkpoint_name(codelet) in self.file
+
+    def store_checkpoint(self, codelet, state):
+        """
+        Store a checkpoint for a running codelet.
+
+        :param codelet: the running codelet
+        :type codelet: activepapers.execution.Codelet
+        :param state: a dictionary mapping names to arrays or numbers
+        :type state: dict
+        """
+        self.remove_checkpoint(codelet.path)
+        if 'checkpoints' not in self.file:
+            self.create_group(self.file, 'checkpoints')
+        group = self.create_group(self.file['checkpoints'],
+                                  codelet.path[1:].replace('/', ':'))
+        for name, value in state.items():
+            if not isstring(name) or '/' in name:
+                raise ValueError("invalid checkpoint variable name %s"
+                                 % repr(name))
+            group.create_dataset(name, data=value)
+        attrs = group.attrs
+        attrs['CODELET_TIMESTAMP'] = \
+            codelet.node.attrs.get('ACTIVE_PAPER_TIMESTAMP', np.nan)
+        deps = sorted(codelet._dependencies or [])
+        attrs.create('DEPENDENCIES', np.array(deps, dtype=object),
+                     shape=(len(deps),), dtype=h5vstring)
+        attrs['DEPENDENCY_TIMESTAMPS'] = \
+            np.array([self.file[dep].attrs.get('ACTIVE_PAPER_TIMESTAMP',
+                                               np.nan)
+                      for dep in deps], dtype=np.float64)
+        if codelet._regions:
+            regions = activepapers.regions.encode_dependency_regions(
+                          codelet._regions)
+            attrs.create('ACTIVE_PAPER_DEPENDENCY_REGIONS',
+                         np.array(regions, dtype=object),
+                         shape=(len(regions),), dtype=h5vstring)
+        outputs = self.owned_by(codelet.path)
+        attrs.create('OUTPUTS', np.array(outputs, dtype=object),
+                     shape=(len(outputs),), dtype=h5vstring)
+        attrs['OUTPUT_ROWS'] = \
+            np.array([self._resizable_length(self.file[name])
+                      for name in outputs], dtype=np.int64)
+        attrs['TIME'] = ms_since_epoch()
+        # Make the checkpoint survive a crash of the process.
+        self.file.flush()
+
+    def _resizable_length(self, node):
+        if isinstance(node, h5py.Dataset) and len(node.shape) > 0 \
+           and node.maxshape[0] is None:
+            return node.shape[0]
+        return -1
+
+    def load_checkpoint(self, codelet):
+        """
+        Prepare the paper for resuming the run of a codelet from its
+        checkpoint, if there is a valid one.
+
+        :param codelet: the path of the codelet
+        :type codelet: str
+        :return: None, or the state stored in the checkpoint, the
+                 dependencies of the codelet, and the regions of
+                 datasets it has read
+        :rtype: tuple
+        """
+        group = self.file.get(self._checkpoint_name(codelet), None)
+        node = self.file.get(codelet, None)
+        if group is None or node is None:
+            return None
+        attrs = group.attrs
+        if node.attrs.get('ACTIVE_PAPER_TIMESTAMP', np.nan) \
+           != attrs['CODELET_TIMESTAMP']:
+            return None
+        deps = [ascii(dep) for dep in attrs['DEPENDENCIES']]
+        for dep, t in zip(deps, attrs['DEPENDENCY_TIMESTAMPS']):
+            dep = self.file.get(dep, None)
+            if dep is None \
+               or dep.attrs.get('ACTIVE_PAPER_TIMESTAMP', np.nan) != t:
+                return None
+        outputs = [ascii(name) for name in attrs['OUTPUTS']]
+        if any(name not in self.file for name in outputs):
+            return None
+        for name in self.owned_by(codelet):
+            if name not in outputs:
+                del self.file[name]
+        for name, rows in zip(outputs, attrs['OUTPUT_ROWS']):
+            output = self.file[name]
+            if rows >= 0 and output.shape[0] > rows:
+                output.resize(rows, axis=0)
+        state = dict((name, ds[()]) for name, ds in group.items())
+        regions = activepapers.regions.dependency_regions(group)
+        return state, deps, regions
+
+    def remove_checkpoint(self, codelet):
+        name = self._checkpoint_name(codelet)
+        if name in self.file:
+            del self.file[name]
+            if len(self.file['checkpoints']) == 0:
+                del self.file['checkpoints']
 
     def replace_by_dummy(self, item_name):
         item = self.file[item_name]
@@ -364,7 +1431,7 @@ class ActivePaper(object):
         deps = item.attrs.get('ACTIVE_PAPER_DEPENDENCIES')
         del self.file[item_name]
         ds = self.file.create_dataset(item_name,
-                                      data=np.zeros((), dtype=np.int))
+                                      data=np.zeros((), dtype=np.int64))
         stamp(ds, dtype,
               dict(ACTIVE_PAPER_GENERATING_CODELET=codelet,
                    ACTIVE_PAPER_DEPENDENCIES=list(deps)))
@@ -374,6 +1441,110 @@ class ActivePaper(object):
     def is_dummy(self, item):
         return item.attrs.get('ACTIVE_PAPER_DUMMY_DATASET', False)
 
+    #
+    # Recomputation of dummy items on access
+    #
+    # When a dummy item is accessed through a DataGroup, the codelet
+    # that generated it is run again, after the codelets generating
+    # the dummy items it depends on. In a writable paper, the results
+    # replace the dummies. A read-only paper is not modified. The
+    # codelets are run in a LayeredPaper whose upper layer is stored
+    # in a sidecar file next to the paper (see sidecar_filename), so
+    # that the results are available the next time the paper is
+    # opened. The sidecar file is discarded when the paper changes.
+    #
+
+    def materialization_plan(self, item):
+        """
+        :param item: a dummy item
+        :type item: h5py.Node
+        :return: the paths of the codelets that must be run to
+                 recompute the item, in the order in which they
+                 must be run
+        :rtype: list
+        """
+        plan = []
+        def add(item, pending):
+            codelet = owner(item)
+            if codelet is None:
+                raise ValueError("%s cannot be recomputed" % item.name)
+            if codelet in plan:
+                return
+            if codelet in pending:
+                raise ValueError("cyclic dependencies")
+            pending = pending | set([codelet])
+            for dep in self.iter_dependencies(item):
+                if self.is_dummy(dep):
+                    add(dep, pending)
+            plan.append(codelet)
+        add(item, set())
+        return plan
+
+    def materialize(self, item):
+        """
+        Recompute a dummy item.
+
+        :param item: a dummy item
+        :type item: h5py.Node
+        :return: the recomputed item
+        :rtype: h5py.Node
+        """
+        name = item.name
+        target = self._materialization_target()
+        if target is not self:
+            node = target.upper.get(name, None)
+            if node is not None:
+                return node
+        # Running the codelets deletes item.
+        for codelet in self.materialization_plan(item):
+            error = target.run_codelet(codelet)
+            if error is not None:
+                raise ValueError("Recomputation of %s failed:\n%s"
+                                 % (name, error))
+        if target is not self:
+            target.upper.flush()
+        return target._internal_root()[name]
+
+    def sidecar_filename(self):
+        """
+        :return: the name of the file in which the items recomputed
+                 for a read-only paper are stored
+        :rtype: str
+        """
+        return self.filename + '.cache'
+
+    def _materialization_target(self):
+        if self.writable:
+            return self
+        sidecar = getattr(self, '_sidecar', None)
+        if sidecar is None and self.in_memory:
+            # Recomputed items stay in memory as well.
+            import activepapers.layers
+            sidecar = activepapers.layers.LayeredPaper(self.filename,
+                                                       in_memory=True)
+            self._sidecar = sidecar
+        if sidecar is None:
+            import activepapers.layers
+            stat = os.stat(self.filename)
+            version = np.array([stat.st_mtime, stat.st_size],
+                               dtype=np.float64)
+            try:
+                upper = h5py.File(self.sidecar_filename(), 'a')
+            except (IOError, OSError):
+                upper = None
+            if upper is not None \
+               and not np.array_equal(upper.attrs.get('PAPER_VERSION', []),
+                                      version):
+                # The paper has changed since the sidecar was written.
+                upper.close()
+                upper = h5py.File(self.sidecar_filename(), 'w')
+                upper.attrs['PAPER_VERSION'] = version
+            # If no sidecar file can be written, the results
+            # are kept in memory.
+            sidecar = activepapers.layers.LayeredPaper(self.filename, upper)
+            self._sidecar = sidecar
+        return sidecar
+
     def iter_items(self):
         """
         Iterate over the items in a paper.
@@ -409,21 +1580,149 @@ class ActivePaper(object):
             for node in walk(group):
                 yield node
 
+    def item_metadata(self):
+        """
+        :return: the metadata of all items and of the groups that
+                 are not items, taken from the metadata image if
+                 the paper has a valid one
+        :rtype: list of ItemMetadata
+        """
+        if self.writable:
+            return [node_metadata(node, True) for node in self.iter_items()] \
+                   + [node_metadata(node, False)
+                      for node in self.iter_groups()]
+        if self._item_metadata is None:
+            self._item_metadata = self._load_metadata_image()
+        if self._item_metadata is None:
+            self._item_metadata = \
+                [node_metadata(node, True) for node in self.iter_items()] \
+                + [node_metadata(node, False) for node in self.iter_groups()]
+        return self._item_metadata
+
+    def _load_metadata_image(self):
+        image = self.file.get('metadata-image', None)
+        if image is None \
+           or image.attrs.get('HISTORY_LENGTH', -1) != len(self.history) \
+           or image.dtype.names != metadata_image_dtype.names:
+            # Images written by earlier versions lack fields.
+            return None
+        return [ItemMetadata(ascii(name), bool(is_item),
+                             ascii(dtype) or None,
+                             None if np.isnan(t) else float(t),
+                             ascii(item_owner) or None,
+                             tuple(ascii(deps).split('\n')) if deps else (),
+                             bool(dummy), ascii(row_id) or None)
+                for name, is_item, dtype, t, item_owner, deps, dummy, row_id
+                in image[...]]
+
+    def store_metadata_image(self):
+        """
+        Store the metadata of all items in a single table,
+        which is used by item_metadata() when the paper is
+        opened for reading.
+        """
+        rows = [(m.name, m.is_item, m.datatype or '',
+                 np.nan if m.timestamp is None else m.timestamp,
+                 m.owner or '', '\n'.join(m.dependencies), m.dummy,
+                 m.parameter_row or '')
+                for m in self.item_metadata()]
+        if 'metadata-image' in self.file:
+            del self.file['metadata-image']
+        image = self.file.create_dataset('metadata-image',
+                                         data=np.array(rows,
+                                                 dtype=metadata_image_dtype))
+        image.attrs['HISTORY_LENGTH'] = len(self.history)
+
     def iter_dependencies(self, item):
         """
         Iterate over the dependencies of a given item in a paper.
         """
         if 'ACTIVE_PAPER_DEPENDENCIES' in item.attrs:
+            root = self._internal_root()
             for dep in item.attrs['ACTIVE_PAPER_DEPENDENCIES']:
-                yield self.file[dep]
+                yield root[dep]
 
     def is_stale(self, item):
+        if self.has_checkpoint(owner(item)):
+            # The codelet generating the item has not finished.
+            return True
+        table = None
+        row_id = item.attrs.get('ACTIVE_PAPER_PARAMETER_ROW', None)
+        if row_id is not None:
+            table, changed = self.check_parameter_row(owner(item),
+                                                      ascii(row_id))
+            if changed:
+                return True
         t = mod_time(item)
         for dep in self.iter_dependencies(item):
+            if dep.name == table:
+                continue
             if mod_time(dep) > t:
-                return True
+                # With region tracking, the modification
+                # may not concern the item.
+                if not self.track_regions:
+                    return True
+                dirty = self.dirty_regions(item)
+                dirty.pop(table, None)
+                return len(dirty) > 0
         return False
 
+    def check_parameter_row(self, calclet, row_id):
+        """
+        An instance of a parameter sweep depends only on its own row
+        of the parameter table. The table is therefore not treated as
+        an ordinary dependency of the instance's outputs.
+
+        :param calclet: the path of a calclet with a parameter table
+        :type calclet: str
+        :param row_id: the row id stored with the outputs of an
+                       instance (ACTIVE_PAPER_PARAMETER_ROW)
+        :type row_id: str
+        :return: the name of the parameter table (or None), and True
+                 if the row has changed or no longer exists
+        :rtype: tuple
+        """
+        row = int(row_id.split()[0])
+        try:
+            table = self.parameter_table(calclet)
+        except ValueError:
+            return None, True
+        if table is None:
+            return None, True
+        changed = row >= len(table) or parameter_row_id(table, row) != row_id
+        return table.name, changed
+
+    def dirty_regions(self, item):
+        """
+        :param item: an item in a paper
+        :type item: h5py.Node
+        :return: a dictionary mapping the path of each dependency that
+                 was modified after the item to the list of modified
+                 regions that the item has read, or to None if the
+                 modification cannot be narrowed down to regions.
+                 Dependencies whose modifications do not affect the
+                 item are not included.
+        :rtype: dict
+        """
+        t = mod_time(item)
+        read = activepapers.regions.dependency_regions(item)
+        dirty = {}
+        for dep in self.iter_dependencies(item):
+            if mod_time(dep) <= t:
+                continue
+            modified = None
+            if dep.name in read:
+                modified = activepapers.regions.modified_since(dep, t)
+            if modified is None:
+                dirty[dep.name] = None
+                continue
+            overlapping = [region for region in modified
+                           if any(activepapers.regions.overlap(region, r)
+                                  for r in read[dep.name])]
+            if overlapping:
+                dirty[dep.name] = overlapping
+        return dirty
+
     def external_references(self):
         def process(node, refs):
             if datatype(node) == 'reference':
@@ -465,9 +1764,9 @@ class ActivePaper(object):
         :rtype: dict
         """
         graph = collections.defaultdict(set)
-        for item in it.chain(self.iter_items(), self.iter_groups()):
-            for dep in self.iter_dependencies(item):
-                graph[dep.name].add(item.name)
+        for item in self.item_metadata():
+            for dep in item.dependencies:
+                graph[dep].add(item.name)
         return graph
 
     def dependency_hierarchy(self):
@@ -478,51 +1777,95 @@ class ActivePaper(object):
         """
         known = set()
         unknown = set()
-        for item in self.iter_items():
-            d = (item.name,
-                 frozenset(dep.name for dep in self.iter_dependencies(item)))
+        for item in self.item_metadata():
+            if not item.is_item:
+                continue
+            d = (item.name, frozenset(item.dependencies))
             if len(d[1]) > 0:
                 unknown.add(d)
             else:
                 known.add(d[0])
-        yield set(self.file[p] for p in known)
+        root = self._internal_root()
+        yield set(root[p] for p in known)
         while len(unknown) > 0:
             next = set(p for p, d in unknown if d <= known)
             if len(next) == 0:
                 raise ValueError("cyclic dependencies")
             known |= next
             unknown = set((p, d) for p, d in unknown if p not in next)
-            yield set(self.file[p] for p in next)
+            yield set(root[p] for p in next)
 
-    def rebuild(self, filename):
+    def rebuild(self, filename, prefetch_bytes=None):
         """
         Rebuild all the dependent items in the paper in a new file.
         First all items without dependencies are copied to the new
         file, then all the calclets are run in the new file in the
         order determined by the dependency graph in the original file.
+
+        :param filename: the name of the new file, or a new paper
+                         (e.g. one in memory, for checking that the
+                         paper can be rebuilt without writing a file),
+                         which is filled but not closed
+        :type filename: str or ActivePaper
+        :param prefetch_bytes: if given, the inputs of each calclet,
+                               up to this number of bytes, are read
+                               while the preceding one is running
+                               (see activepapers.prefetch)
+        :type prefetch_bytes: int
         """
+        if isinstance(filename, ActivePaper):
+            if not filename.writable or len(filename.data_group) > 0:
+                raise ValueError("the target of rebuild() must be "
+                                 "a new paper")
+            self._rebuild_into(filename, prefetch_bytes)
+            return
+        metadata_image = bool(self.file.attrs.get('METADATA_IMAGE', False))
+        with ActivePaper(filename, 'w', libver=self.libver,
+                         cache=self.cache_settings,
+                         metadata_image=metadata_image or None,
+                         track_regions=self.track_regions,
+                         array_cache=self.array_cache) as clone:
+            self._rebuild_into(clone, prefetch_bytes)
+
+    def _rebuild_into(self, clone, prefetch_bytes):
         deps = self.dependency_hierarchy()
-        with ActivePaper(filename, 'w') as clone:
-            for item in next(deps):
-                # Make sure all the groups in the path exist
-                path = item.name.split('/')
-                name = path[-1]
-                groups = path[:-1]
-                dest = clone.file
-                while groups:
-                    group_name = groups[0]
-                    if len(group_name) > 0:
-                        if group_name not in dest:
-                            dest.create_group(group_name)
-                        dest = dest[group_name]
-                    del groups[0]
-                clone.file.copy(item, item.name, expand_refs=True)
-                timestamp(clone.file[item.name])
-            for items in deps:
-                calclets = set(item.attrs['ACTIVE_PAPER_GENERATING_CODELET']
-                               for item in items)
-                for calclet in calclets:
-                    clone.run_codelet(calclet)
+        for item in next(deps):
+            # Make sure all the groups in the path exist
+            path = item.name.split('/')
+            name = path[-1]
+            groups = path[:-1]
+            dest = clone.file
+            while groups:
+                group_name = groups[0]
+                if len(group_name) > 0:
+                    if group_name not in dest:
+                        clone.create_group(dest, group_name)
+                    dest = dest[group_name]
+                del groups[0]
+            clone.file.copy(item, item.name, expand_refs=True)
+            timestamp(clone.file[item.name])
+        order = []
+        for items in deps:
+            calclets = set(item.attrs['ACTIVE_PAPER_GENERATING_CODELET']
+                           for item in items)
+            order.extend(calclets)
+        prefetcher = None
+        if prefetch_bytes and not clone.in_memory:
+            import activepapers.prefetch
+            prefetcher = activepapers.prefetch.Prefetcher(prefetch_bytes)
+        try:
+            for i, calclet in enumerate(order):
+                if prefetcher is not None and i+1 < len(order):
+                    # The dependencies are known from the
+                    # original paper.
+                    inputs = activepapers.prefetch.input_datasets(
+                                 self, order[i+1], calclet)
+                    clone.flush()
+                    prefetcher.prefetch(clone.file, inputs)
+                clone.run_codelet(calclet)
+        finally:
+            if prefetcher is not None:
+                prefetcher.cancel()
 
     def snapshot(self, filename):
         """
@@ -540,8 +1883,120 @@ class ActivePaper(object):
             clone.attrs[attr_name] = self.file.attrs[attr_name]
         clone.close()
 
+    def store_runtime(self, codelet, seconds):
+        """
+        Record the duration of a complete run of a codelet, which is
+        the time needed to recompute its outputs, see
+        activepapers.cli.slim_plan(). Read-only papers don't keep it.
+
+        :param codelet: the path of the codelet
+        :type codelet: str
+        :param seconds: the duration of the run
+        :type seconds: float
+        """
+        if self.writable:
+            self.file[codelet].attrs['ACTIVE_PAPER_RUNTIME'] = seconds
+
+    def store_access_patterns(self, codelet, accesses):
+        """
+        Add dataset access statistics to the paper.
+
+        :param codelet: the path of the codelet that made the accesses
+        :type codelet: str
+        :param accesses: a mapping from (dataset path, selection shape)
+                         to the number of accesses
+        :type accesses: dict
+        """
+        patterns = self.access_patterns()
+        for (path, selection), count in accesses.items():
+            per_codelet = patterns.setdefault(path, {}) \
+                                  .setdefault(codelet, {})
+            per_codelet[selection] = per_codelet.get(selection, 0) + count
+        rows = [(path, codelet, 'x'.join(str(n) for n in selection), count)
+                for path, per_path in sorted(patterns.items())
+                for codelet, per_codelet in sorted(per_path.items())
+                for selection, count in sorted(per_codelet.items())]
+        if 'access-patterns' in self.file:
+            del self.file['access-patterns']
+        self.file.create_dataset('access-patterns',
+                                 data=np.array(rows, dtype=access_dtype))
+
+    def access_patterns(self):
+        """
+        :return: the access statistics recorded in the paper, as a
+                 dictionary mapping dataset paths to dictionaries mapping
+                 codelet paths to dictionaries mapping selection shapes
+                 to access counts
+        :rtype: dict
+        """
+        patterns = {}
+        table = self.file.get('access-patterns', None)
+        if table is None:
+            return patterns
+        for path, codelet, selection, count in table[...]:
+            selection = tuple(int(n) for n in ascii(selection).split('x')
+                              if n)
+            patterns.setdefault(ascii(path), {}) \
+                    .setdefault(ascii(codelet), {})[selection] = int(count)
+        return patterns
+
+    def rechunk(self, path, chunks):
+        """
+        Rewrite a dataset with a different chunk shape. The dataset
+        keeps all its attributes, including its timestamp, so items
+        depending on it do not become stale. HDF5 object references
+        to the dataset become invalid.
+
+        :param path: the path of the dataset
+        :type path: str
+        :param chunks: the new chunk shape
+        :type chunks: tuple
+        """
+        ds = self.file[path]
+        parent = ds.parent
+        name = ds.name.split('/')[-1]
+        tmp_name = name + '.rechunk'
+        chunks = tuple(chunks)
+        options = dict(shape=ds.shape, dtype=ds.dtype, chunks=chunks,
+                       maxshape=ds.maxshape, fillvalue=ds.fillvalue,
+                       compression=ds.compression,
+                       compression_opts=ds.compression_opts,
+                       shuffle=ds.shuffle, fletcher32=ds.fletcher32,
+                       scaleoffset=ds.scaleoffset)
+        new = parent.create_dataset(tmp_name, **options)
+        # Copy blocks of complete chunks along the first axis,
+        # about 64 MB at a time.
+        row_bytes = ds.dtype.itemsize * int(np.prod(ds.shape[1:]))
+        block = max(1, (64*1024*1024)//max(1, row_bytes*chunks[0]))*chunks[0]
+        for start in range(0, ds.shape[0], block):
+            new[start:start+block] = ds[start:start+block]
+        for attr_name in ds.attrs:
+            attr_id = ds.attrs.get_id(attr_name)
+            new.attrs.create(attr_name, ds.attrs[attr_name],
+                             dtype=attr_id.dtype)
+        del parent[name]
+        parent.move(tmp_name, name)
+        return parent[name]
+
+    def get_node(self, path, default=None):
+        """
+        :param path: the absolute path of an HDF5 node in the paper
+        :type path: str
+        :return: the node, which for layered papers may come from
+                 any layer, or default if there is none
+        :rtype: h5py.Group or h5py.Dataset
+        """
+        return self._internal_root().get(path, default)
+
+    def _internal_root(self):
+        # The root group for internal files and for looking up items
+        # by their path, which differs from self.file for layered
+        # papers (see activepapers.layers).
+        return self.file
+
     def open_internal_file(self, path, mode='r', encoding=None, creator=None):
         # path is always relative to the root group
+        root = self._internal_root()
         if path.startswith('/'):
             path = path[1:]
         if not path.startswith('data/') \
@@ -550,16 +2005,16 @@ class ActivePaper(object):
         if creator is None:
             creator = ExternalCode(self)
         if mode[0] in ['r', 'a']:
-            ds = self.file[path]
+            ds = root[path]
         elif mode[0] == 'w':
-            test = self.file.get(path, None)
+            test = root.get(path, None)
             if test is not None:
                 if not creator.owns(test):
                     raise ValueError("%s trying to overwrite data"
                                      " created by %s"
                                      % (creator.path, owner(test)))
-                del self.file[path]
-            ds = self.file.create_dataset(
+                del root[path]
+            ds = root.create_dataset(
                        path, shape = (0,), dtype = np.uint8,
                        chunks = (100,), maxshape = (None,))
         else:
@@ -580,6 +2035,12 @@ class ExternalCode(object):
     def add_dependency(self, dependency):
         pass
 
+    def record_access(self, ds, item):
+        pass
+
+    def record_region(self, ds, item=Ellipsis):
+        pass
+
     def dependency_attributes(self):
         return {}
 
@@ -765,7 +2226,7 @@ class APNode(object):
         if isinstance(self._h5node, h5py.Group):
             path = item.split('/')
             if path[0] == '':
-                node = APNode(self._h5node.file)
+                node = APNode(_root_group(self._h5node))
                 path = path[1:]
             else:
                 node = self
@@ -797,7 +2258,16 @@ class APNode(object):
         return getattr(self._h5node, attrname)
 
     def in_paper(self, paper):
-        return paper.file.id == self._h5node.file.id
+        file_id = self._h5node.file.id
+        upper = getattr(paper, 'upper', None)
+        return file_id == paper.file.id \
+               or (upper is not None and file_id == upper.id)
+
+def _root_group(node):
+    # Merged groups (see activepapers.layers) know the merged
+    # root group, which h5py's file attribute does not give.
+    root = getattr(node, 'merged_root', None)
+    return node.file if root is None else root()
 
 #
 # A global dictionary mapping paper_refs to papers.
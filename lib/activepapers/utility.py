@@ -1,3 +1,4 @@
+import hashlib
 import sys
 import time
 
@@ -33,6 +34,13 @@ def language(node):
     else:
         return ascii(s)
 
+def parameter_row_id(table, row):
+    # Identifies a row of the parameter table of a calclet and its
+    # contents, see ActivePaper.set_parameter_table().
+    value = np.asarray(table[row])
+    digest = hashlib.sha1(str(value.dtype).encode('ascii') + value.tobytes())
+    return '%d %s' % (row, digest.hexdigest())
+
 def mod_time(node):
     s = node.attrs.get('ACTIVE_PAPER_TIMESTAMP', None)
     if s is None:
@@ -73,7 +81,8 @@ def stamp(node, ap_type, attributes):
                     else:
                         raise ValueError("%s: %s != %s"
                                          % (key, value, previous))
-        elif key == 'ACTIVE_PAPER_DEPENDENCIES':
+        elif key in ['ACTIVE_PAPER_DEPENDENCIES',
+                     'ACTIVE_PAPER_DEPENDENCY_REGIONS']:
             node.attrs.create(key, np.array(value, dtype=object),
                               shape = (len(value),), dtype=h5vstring)
         else:
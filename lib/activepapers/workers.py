@@ -0,0 +1,257 @@
+# Process-isolated execution of codelets.
+#
+# A WorkerPool runs codelets in worker processes, which protects the
+# calling process from codelets that exhaust memory or crash. The
+# workers are started once by a fork server that has numpy, h5py and
+# activepapers already imported, and are reused for all subsequent runs.
+#
+# A run proceeds as follows:
+#  1. The parent removes the items owned by the codelet, as for an
+#     in-process run, and closes the paper's HDF5 file.
+#  2. A worker opens the paper read-only as a LayeredPaper, whose
+#     upper layer is an in-memory HDF5 file, and runs the codelet.
+#  3. The worker places the image of the upper layer in shared memory.
+#  4. The parent reopens the paper and copies the new items from the
+#     image into it. The items carry the provenance attributes set
+#     during the run. Access statistics and the runtimes of calclets
+#     are stored by the parent.
+#
+# This module requires Python 3.8 or later.
+
+import atexit
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import traceback
+
+import h5py
+
+import activepapers.layers
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+def _init_worker(memory_limit):
+    if memory_limit is not None:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+def _run_in_worker(filename, path, record_access, row=None):
+    paper = activepapers.layers.LayeredPaper(filename,
+                                             record_access=record_access)
+    try:
+        error = paper.run_codelet(path, row=row)
+        if error is not None:
+            return error, None, None, None
+        return None, _to_shared_memory(paper.upper_image()), \
+               paper.accesses, paper.runtimes
+    finally:
+        paper.close()
+
+#
+# Transfer of file images through shared memory
+#
+
+def _to_shared_memory(image):
+    try:
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(image)),
+                                         track=False)
+    except TypeError:
+        # Python < 3.13 registers the block with the worker's resource
+        # tracker, which would delete it when the worker exits.
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(image)))
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    shm.buf[:len(image)] = image
+    shm.close()
+    return shm.name, len(image)
+
+def _from_shared_memory(name, size):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+        fapl.set_fapl_core(backing_store=False)
+        image = shm.buf[:size]
+        fapl.set_file_image(image)
+        # HDF5 has made a copy of the image.
+        image.release()
+        fid = h5py.h5f.open(('image-' + name).encode('ascii'),
+                            h5py.h5f.ACC_RDONLY, fapl=fapl)
+    finally:
+        shm.close()
+        shm.unlink()
+    return h5py.File(fid)
+
+def _release_shared_memory(name):
+    # Delete a block whose image is not used.
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+#
+# The worker pool
+#
+
+class WorkerPool(object):
+
+    def __init__(self, processes=1, memory_limit=None):
+        """
+        :param processes: the number of worker processes
+        :type processes: int
+        :param memory_limit: the maximal address space of a worker,
+                             in bytes (default: no limit)
+        :type memory_limit: int
+        """
+        if shared_memory is None:
+            raise ValueError("isolated execution requires Python 3.8")
+        self.processes = processes
+        self.memory_limit = memory_limit
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['numpy', 'h5py',
+                                            'activepapers.layers'])
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                                 self.processes, mp_context=context,
+                                 initializer=_init_worker,
+                                 initargs=(self.memory_limit,))
+        return self._executor
+
+    def run_codelet(self, paper, path, row=None):
+        """
+        Run a codelet in a worker process and add its results
+        to the paper.
+
+        :param paper: a writable paper
+        :type paper: activepapers.storage.ActivePaper
+        :param path: the path of the codelet, relative to /code
+        :type path: str
+        :param row: for a calclet with a parameter table, the row
+                    of the instance to run
+        :type row: int
+        :return: None, or the traceback if an exception occurred
+        :rtype: str
+        """
+        return self.run_codelets(paper, [path], [row])[0]
+
+    def run_codelets(self, paper, paths, rows=None):
+        """
+        Run independent codelets at the same time, each in a worker
+        process, and add their results to the paper. The codelets
+        must not read each other's outputs nor create the same items.
+
+        :param paper: a writable paper
+        :type paper: activepapers.storage.ActivePaper
+        :param paths: the paths of the codelets, relative to /code
+        :type paths: list
+        :param rows: for calclets with a parameter table, the row
+                     of the instance to run, and None for the others
+        :type rows: list
+        :return: for each codelet, None, or the traceback if an
+                 exception occurred
+        :rtype: list
+        """
+        if getattr(paper, 'in_memory', False):
+            # The workers read the paper from its file.
+            raise ValueError("codelets of in-memory papers cannot be run "
+                             "in worker processes")
+        if not paper.writable:
+            # Including overlays, whose changes are not in that file.
+            raise ValueError("codelets of read-only papers and overlays "
+                             "cannot be run in worker processes")
+        if rows is None:
+            rows = len(paths)*[None]
+        for path, row in zip(paths, rows):
+            codelet = '/code/' + path
+            if row is None:
+                logging.info("Running %s in a worker process" % codelet)
+                paper.remove_owned_by(codelet)
+            else:
+                logging.info("Running %s for row %d in a worker process"
+                             % (codelet, row))
+                paper.remove_row_outputs(codelet, row)
+        paper.release_file()
+        futures = []
+        try:
+            filename = os.path.abspath(paper.filename)
+            executor = self._get_executor()
+            for path, row in zip(paths, rows):
+                futures.append(executor.submit(_run_in_worker, filename,
+                                               path, paper.record_access,
+                                               row))
+        finally:
+            # The workers must be done with the file before it is
+            # reopened for writing.
+            concurrent.futures.wait(futures)
+            paper.reacquire_file()
+        # The shared memory blocks holding the images, which must
+        # be released even if merging fails
+        images = [future.result()[1] for future in futures
+                  if future.exception() is None
+                  and future.result()[1] is not None]
+        errors = []
+        try:
+            for path, future in zip(paths, futures):
+                try:
+                    error, image, accesses, runtimes = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    self._discard_executor()
+                    errors.append("Worker process for /code/%s "
+                                  "terminated abnormally\n" % path)
+                    continue
+                except Exception:
+                    # The worker failed outside of the codelet, e.g.
+                    # when opening the paper or transferring the result.
+                    errors.append(traceback.format_exc())
+                    continue
+                errors.append(error)
+                if error is not None:
+                    continue
+                images.remove(image)
+                upper = _from_shared_memory(*image)
+                try:
+                    activepapers.layers.merge_upper(upper, paper)
+                finally:
+                    upper.close()
+                for codelet_path, per_codelet in accesses.items():
+                    paper.store_access_patterns(codelet_path, per_codelet)
+                for codelet_path, seconds in runtimes.items():
+                    paper.store_runtime(codelet_path, seconds)
+        finally:
+            for name, size in images:
+                _release_shared_memory(name)
+        return errors
+
+    def _discard_executor(self):
+        # A broken pool cannot be used any more.
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+_default_pool = None
+
+def default_pool():
+    """
+    :return: the pool used by ActivePaper.run_codelet(isolated=True),
+             which has one worker process
+    :rtype: WorkerPool
+    """
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = WorkerPool()
+        atexit.register(_default_pool.close)
+    return _default_pool
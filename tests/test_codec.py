@@ -0,0 +1,98 @@
+# Test the parallel chunk codec
+
+import os
+import numpy as np
+import h5py
+import tempdir
+from activepapers.storage import ActivePaper
+from activepapers import codec
+
+def test_chunks_identical_to_hdf5():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "test.h5")
+        array = np.arange(10000, dtype=np.float64).reshape((100, 100))
+        with h5py.File(filename, 'w') as f:
+            options = dict(chunks=(30, 40), compression='gzip',
+                           compression_opts=4, shuffle=True)
+            ref = f.create_dataset('ref', data=array, **options)
+            par = f.create_dataset('par', shape=array.shape,
+                                   dtype=array.dtype, **options)
+            assert codec.supports_parallel_codec(par)
+            codec.write(par, array, workers=3)
+            for offset in codec.chunk_offsets(array.shape, (30, 40)):
+                assert ref.id.read_direct_chunk(offset) \
+                       == par.id.read_direct_chunk(offset)
+            assert (par[...] == array).all()
+            assert (codec.read(ref, workers=3) == array).all()
+
+def test_partially_written_dataset():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "test.h5")
+        with h5py.File(filename, 'w') as f:
+            ds = f.create_dataset('x', shape=(50,), dtype=np.int32,
+                                  chunks=(10,), compression='gzip',
+                                  fillvalue=-1)
+            ds[12:15] = 7
+            assert (codec.read(ds, workers=2) == ds[...]).all()
+
+def test_unsupported_filters():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "test.h5")
+        array = np.arange(100, dtype=np.int16)
+        with h5py.File(filename, 'w') as f:
+            ds = f.create_dataset('x', shape=(100,), dtype=np.int16,
+                                  chunks=(10,), fletcher32=True)
+            assert not codec.supports_parallel_codec(ds)
+            codec.write(ds, array)
+            assert (codec.read(ds) == array).all()
+
+def test_dataset_wrapper():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data.create_dataset('x', data=np.arange(1000.), chunks=(64,),
+                                  compression='gzip', workers=4)
+        script = paper.create_calclet("script",
+"""
+from activepapers.contents import data
+x = data['x'].read_parallel(workers=4)
+y = data.create_dataset('y', shape=x.shape, dtype=x.dtype,
+                        chunks=(100,), compression='gzip')
+y.write_parallel(2*x, workers=4)
+""")
+        script.run()
+        assert (paper.data['y'][...] == 2*np.arange(1000.)).all()
+        # Positional arguments are handled like keyword arguments.
+        writes = []
+        write = codec.write
+        def recording_write(ds, data, workers=None):
+            writes.append((ds.name, workers))
+            write(ds, data, workers)
+        codec.write = recording_write
+        try:
+            paper.data.create_dataset('z', (1000,), np.float64,
+                                      np.arange(1000.), chunks=(64,),
+                                      compression='gzip', workers=4)
+        finally:
+            codec.write = write
+        assert writes == [('/data/z', 4)]
+        assert (paper.data['z'][...] == np.arange(1000.)).all()
+        try:
+            paper.data.create_dataset('w', (10,), shape=(10,))
+            assert False
+        except TypeError:
+            pass
+        deps = [item.name
+                for item in paper.iter_dependencies(paper.data['y']._node)]
+        assert sorted(deps) == ['/code/script', '/data/x']
+        paper.close()
+
+def test_aligned_blocks():
+    blocks = codec.aligned_blocks((100, 30), (16, 10), 8, axis=0, size=20)
+    assert blocks == [(slice(0, 32),), (slice(32, 64),),
+                      (slice(64, 96),), (slice(96, 100),)]
+    blocks = codec.aligned_blocks((100, 30), None, 8, axis=1, size=20)
+    assert blocks == [(slice(None), slice(0, 20)),
+                      (slice(None), slice(20, 30))]
+    blocks = codec.aligned_blocks((100, 30), None, 8)
+    assert blocks == [(slice(0, 100),)]
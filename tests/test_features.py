@@ -428,3 +428,916 @@ angular.create_dataset("sine", data=np.sin(2.*np.pi*frequency*time))
             passed = False
         assert not passed
         paper.close()
+
+def test_storage_usage():
+    from activepapers.cli import storage_usage
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data.create_dataset("zeros", data=np.zeros((1000,)),
+                                  chunks=(100,), compression='gzip')
+        script = paper.create_calclet("script",
+"""
+from activepapers.contents import data
+data.create_dataset('copy', data=data['zeros'][...])
+""")
+        script.run()
+        items = dict((e['name'], e) for e in storage_usage(paper, 'item'))
+        assert items['/data/zeros']['logical'] == 8000
+        assert items['/data/zeros']['chunks'] == 10
+        assert items['/data/zeros']['disk'] < 8000
+        assert items['/data/copy']['ratio'] == 1.
+        codelets = dict((e['name'], e)
+                        for e in storage_usage(paper, 'codelet'))
+        assert codelets['/code/script']['logical'] == 8000
+        groups = dict((e['name'], e) for e in storage_usage(paper, 'group'))
+        assert groups['/data']['logical'] == 16000
+        paper.close()
+
+def test_access_patterns_and_rechunk():
+    from activepapers.chunking import selection_shape, advise_chunks
+    assert selection_shape((10, 20), (3, slice(None))) == (1, 20)
+    assert selection_shape((10, 20), Ellipsis) == (10, 20)
+    assert selection_shape((10, 20), (slice(2, 8, 2), [1, 5])) == (5, 5)
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w', record_access=True)
+        paper.data.create_dataset("x", data=np.arange(40000.)
+                                               .reshape((200, 200)),
+                                  chunks=(200, 1))
+        script = paper.create_calclet("script",
+"""
+from activepapers.contents import data
+x = data['x']
+data['rowsum'] = sum(x[i].sum() for i in range(0, 200, 10))
+""")
+        script.run()
+        patterns = paper.access_patterns()
+        assert patterns == {'/data/x': {'/code/script': {(1, 200): 20}}}
+        chunks = advise_chunks((200, 200), 8, [((1, 200), 20)], (200, 1))
+        assert chunks[1] == 200
+        paper.rechunk('/data/x', chunks)
+        x = paper.data['x']
+        assert x.chunks == chunks
+        assert (x[...] == np.arange(40000.).reshape((200, 200))).all()
+        assert not paper.is_stale(paper.data['rowsum']._node)
+        paper.close()
+
+def test_file_format():
+    from activepapers.storage import upgrade
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w', libver='latest')
+        for name in ['z', 'a', 'm']:
+            paper.data.create_dataset(name, data=0)
+        assert list(paper.data) == ['z', 'a', 'm']
+        paper.close()
+        paper = ActivePaper(filename, 'r+')
+        assert paper.track_order
+        group = paper.data.create_group('group')
+        group.create_dataset('y', data=1)
+        group.create_dataset('b', data=2)
+        assert list(group) == ['y', 'b']
+        paper.close()
+
+        filename = os.path.join(t, "old.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data.create_dataset('x', data=np.arange(10))
+        script = paper.create_calclet("script",
+"""
+from activepapers.contents import data
+data['y'] = 2*data['x'][...]
+""")
+        script.run()
+        paper.close()
+        with h5py.File(filename, 'r') as f:
+            timestamp = f['data/y'].attrs['ACTIVE_PAPER_TIMESTAMP']
+        upgrade(filename)
+        paper = ActivePaper(filename, 'r')
+        assert paper.track_order
+        y = paper.data['y']
+        assert (y[...] == 2*np.arange(10)).all()
+        assert y._node.attrs['ACTIVE_PAPER_TIMESTAMP'] == timestamp
+        assert not paper.is_stale(y._node)
+        paper.close()
+
+def test_cache_settings():
+    from activepapers.storage import cache_settings
+    assert cache_settings('default') == {}
+    settings = cache_settings({'preset': 'sequential', 'rdcc_w0': 0.5})
+    assert settings['rdcc_w0'] == 0.5
+    assert settings['rdcc_nslots'] == 12421
+    os.environ['ACTIVEPAPERS_CACHE_RDCC_NBYTES'] = '1000'
+    try:
+        assert cache_settings('default') == {'rdcc_nbytes': 1000}
+    finally:
+        del os.environ['ACTIVEPAPERS_CACHE_RDCC_NBYTES']
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w', cache='mixed')
+        paper.data.create_dataset('x', data=np.arange(10))
+        paper.close()
+        paper = ActivePaper(filename, 'r', cache={'mdc_initial_size': 2**23})
+        assert paper.file.id.get_mdc_config().initial_size == 2**23
+        assert (paper.data['x'][...] == np.arange(10)).all()
+        paper.close()
+
+def test_compact_storage():
+    from activepapers import library
+    def layout(node):
+        return node.id.get_create_plist().get_layout()
+    with tempdir.TempDir() as t:
+        library.library = [t]
+        os.mkdir(os.path.join(t, "local"))
+        paper = ActivePaper(os.path.join(t, "local/lib.ap"), 'w')
+        paper.data['x'] = 3.
+        paper.close()
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w', compact=True)
+        paper.add_module("my_math",
+"""
+def square(x):
+    return x*x
+""")
+        paper.create_data_ref("x", "local:lib")
+        script = paper.create_calclet("script",
+"""
+from activepapers.contents import data
+import numpy as np
+from my_math import square
+data['y'] = square(data['x'][...])
+data.create_dataset('z', data=np.arange(5))
+""")
+        script.run()
+        for path in ['/code/script', '/code/python-packages/my_math',
+                     '/data/x', '/data/y']:
+            assert layout(paper.file[path]) == h5py.h5d.COMPACT
+        assert layout(paper.file['/data/z']) != h5py.h5d.COMPACT
+        assert paper.data['y'][...] == 9.
+        paper.close()
+        paper = ActivePaper(filename, 'r+')
+        assert paper.compact
+        # Replacing the code of a calclet keeps its attributes.
+        script = paper.create_calclet("script",
+"""
+from activepapers.contents import data
+data['y'] = 2*data['x'][...]
+""")
+        assert ascii(script.node.attrs['ACTIVE_PAPER_DATATYPE']) == 'calclet'
+        script.run()
+        assert paper.data['y'][...] == 6.
+        paper.close()
+
+def test_metadata_image():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w', metadata_image=True)
+        paper.data.create_dataset('x', data=np.arange(10))
+        script = paper.create_calclet("script",
+"""
+from activepapers.contents import data
+data['group/y'] = 2*data['x'][...]
+""")
+        script.run()
+        expected = sorted(paper.item_metadata())
+        paper.close()
+        paper = ActivePaper(filename, 'r')
+        assert 'metadata-image' in paper.file
+        assert sorted(paper.item_metadata()) == expected
+        y = [item for item in expected if item.name == '/data/group/y'][0]
+        assert y.owner == '/code/script'
+        assert y.dependencies == ('/code/script', '/data/x')
+        assert paper.dependency_graph()['/data/x'] == set(['/data/group/y'])
+        paper.close()
+        # A writer that does not know about metadata images
+        # makes the image invalid.
+        f = h5py.File(filename, 'r+')
+        f['history'].resize((len(f['history'])+1,))
+        del f['data/group/y']
+        f.close()
+        paper = ActivePaper(filename, 'r')
+        names = [item.name for item in paper.item_metadata()]
+        assert '/data/group/y' not in names
+        paper.close()
+        paper = ActivePaper(filename, 'r+')
+        assert 'metadata-image' not in paper.file
+        paper.close()
+        paper = ActivePaper(filename, 'r')
+        assert 'metadata-image' in paper.file
+        assert paper.metadata_image
+        paper.close()
+
+def test_streaming():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data.create_dataset('x', data=np.arange(1000.).reshape(250, 4),
+                                  chunks=(32, 4))
+        script = paper.create_calclet("script",
+"""
+from activepapers.contents import data
+import numpy as np
+blocks = list(data['x'].iter_chunks(size=50))
+assert [len(b) for b in blocks] == [64, 64, 64, 58]
+with data.create_appendable('y', np.float64, 100, shape=(4,)) as y:
+    for block in data['x'].iter_chunks():
+        y.append(2*block)
+    y.append(np.zeros((3, 4)))
+    assert len(y) == 253
+""")
+        script.run()
+        y = paper.data['y']
+        assert y.shape == (253, 4)
+        assert y.chunks == (100, 4)
+        assert (y[:250] == 2*np.arange(1000.).reshape(250, 4)).all()
+        assert (y[250:] == 0.).all()
+        deps = [item.name for item in paper.iter_dependencies(y._node)]
+        assert sorted(deps) == ['/code/script', '/data/x']
+        assert not paper.is_stale(y._node)
+        paper.close()
+
+def test_parallel_map():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        for i in range(4):
+            paper.data['x%d' % i] = float(i)
+        paper.data['unused'] = 0.
+        paper.add_module("my_math",
+"""
+def square(x):
+    return x*x
+""")
+        script = paper.create_calclet("script",
+"""
+from activepapers.contents import data, parallel_map
+def f(i):
+    from my_math import square
+    return square(data['x%d' % i][...])
+for backend in ['process', 'thread']:
+    result = parallel_map(f, range(4), workers=3, backend=backend)
+    assert result == [0., 1., 4., 9.]
+def write(i):
+    data['y%d' % i] = i
+for backend in ['process', 'thread']:
+    try:
+        parallel_map(write, range(2), workers=2, backend=backend)
+        raise AssertionError("worker modified the paper")
+    except IOError:
+        pass
+data['z'] = sum(result)
+""")
+        script.run()
+        assert 'y0' not in paper.data
+        z = paper.data['z']
+        deps = [item.name for item in paper.iter_dependencies(z._node)]
+        assert sorted(deps) == ['/code/python-packages/my_math',
+                                '/code/script',
+                                '/data/x0', '/data/x1', '/data/x2', '/data/x3']
+        paper.close()
+
+def test_parallel_map_in_concurrent_codelets():
+    import threading
+    with tempdir.TempDir() as t:
+        papers = []
+        for i in range(2):
+            paper = ActivePaper(os.path.join(t, "paper%d.ap" % i), 'w')
+            paper.data['x'] = np.arange(4.)
+            paper.create_calclet("script",
+"""
+from activepapers.contents import data, parallel_map
+import time
+def f(i):
+    time.sleep(0.05)
+    return data['x'][i]
+data['y'] = parallel_map(f, range(4), workers=2, backend='process')
+""")
+            papers.append(paper)
+        errors = []
+        threads = [threading.Thread(target=lambda paper=paper:
+                                    errors.append(paper.run_codelet('script')))
+                   for paper in papers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == [None, None]
+        for paper in papers:
+            assert (paper.data['y'][...] == np.arange(4.)).all()
+            paper.close()
+
+def test_region_tracking():
+    import time
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w', track_regions=True)
+        paper.data.create_dataset('x', data=np.arange(100.),
+                                  chunks=(10,), maxshape=(None,))
+        for name, expression in [('head', "x[:10].sum()"),
+                                 ('middle', "x[40:50].sum()"),
+                                 ('total', "np.asarray(x).sum()")]:
+            paper.create_calclet(name,
+"""
+from activepapers.contents import data
+import numpy as np
+x = data['x']
+data['%s'] = %s
+""" % (name, expression)).run()
+        stale = lambda name: paper.is_stale(paper.data_group[name])
+        assert not any(stale(name) for name in ['head', 'middle', 'total'])
+        time.sleep(0.01)
+        x = paper.data['x']
+        x.resize((110,))
+        x[100:] = 1.
+        # Appending makes only the reads up to the end stale.
+        assert not stale('head') and not stale('middle') and stale('total')
+        x[45] = 0.
+        assert not stale('head') and stale('middle')
+        assert paper.dirty_regions(paper.data_group['middle']) \
+               == {'/data/x': [((45, 46),)]}
+        assert paper.dirty_regions(paper.data_group['total']) \
+               == {'/data/x': [((100, 110),), ((45, 46),)]}
+        assert not stale('head')
+        x.write_direct(np.zeros((5,)), dest_sel=np.s_[:5])
+        assert stale('head')
+        assert paper.dirty_regions(paper.data_group['head']) \
+               == {'/data/x': [((0, 5),)]}
+        out = np.empty((5,))
+        x.read_direct(out, np.s_[:5])
+        assert (out == 0.).all()
+        paper.close()
+        # Without region tracking, every modification makes
+        # all dependent items stale.
+        paper = ActivePaper(filename, 'r+')
+        paper.track_regions = False
+        assert paper.is_stale(paper.data_group['head'])
+        paper.close()
+
+def test_region_tracking_in_threads():
+    import sys
+    import activepapers.regions
+    # Switch threads often to make lost updates likely.
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with tempdir.TempDir() as t:
+            filename = os.path.join(t, "paper.ap")
+            paper = ActivePaper(filename, 'w', track_regions=True)
+            paper.data.create_dataset('x', data=np.arange(1000.),
+                                      chunks=(10,))
+            paper.create_calclet("script",
+"""
+from activepapers.contents import data, parallel_map
+def f(i):
+    return sum(data['x'][20*i+j] for j in range(10))
+data['y'] = sum(parallel_map(f, range(16), workers=8, backend='thread'))
+""").run()
+            regions = activepapers.regions.dependency_regions(
+                          paper.data_group['y'])
+            assert sorted(regions['/data/x']) \
+                   == [((20*i, 20*i+10),) for i in range(16)]
+            paper.close()
+    finally:
+        sys.setswitchinterval(interval)
+
+def test_incremental_calclet():
+    import time
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data.create_dataset('x', data=np.arange(100.),
+                                  chunks=(10,), maxshape=(None,))
+        calclet = paper.create_calclet("double",
+"""
+from activepapers.contents import data, new_rows, is_incremental_run
+import numpy as np
+rows = new_rows('x')
+data['rows_%d_%d' % (rows.start, rows.stop)] = is_incremental_run
+with data.require_appendable('y', np.float64, 16) as y:
+    y.append(2*data['x'][rows])
+""", incremental=True)
+        assert paper.track_regions
+        calclet.run()
+        def check(runs):
+            x = paper.data['x'][...]
+            assert (paper.data['y'][...] == 2*x).all()
+            assert sorted(name for name in paper.data
+                          if name.startswith('rows')) == runs
+        check(['rows_0_100'])
+        # Appended rows are processed by an incremental run.
+        time.sleep(0.01)
+        x = paper.data['x']
+        x.resize((120,))
+        x[100:] = np.arange(20.)
+        assert paper.is_stale(paper.data_group['y'])
+        calclet.run()
+        check(['rows_0_100', 'rows_100_120'])
+        assert paper.data_group['rows_100_120'][()]
+        assert not paper.is_stale(paper.data_group['y'])
+        # A modification of an earlier row requires a complete run.
+        time.sleep(0.01)
+        x[5] = -1.
+        calclet.run()
+        check(['rows_0_120'])
+        # Existing outputs must have the requested data type.
+        wrong_type = paper.create_calclet("wrong_type",
+"""
+from activepapers.contents import data
+import numpy as np
+try:
+    data.require_appendable('y', np.int32, 16)
+    raise AssertionError("data type mismatch not detected")
+except TypeError:
+    pass
+""")
+        wrong_type.run()
+        paper.close()
+
+def test_checkpoints():
+    import time
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data['crash'] = 1
+        paper.create_calclet("squares",
+"""
+from activepapers.contents import data, checkpoint, resume
+import numpy as np
+crash = data['crash'][()]
+state = resume()
+if state is None:
+    out = data.create_dataset('out', shape=(0,), dtype=np.int64,
+                              chunks=(4,), maxshape=(None,))
+    start = 0
+else:
+    out = data['out']
+    start = int(state['step'])
+data['started_at_%d' % start] = start
+for i in range(start, 10):
+    out.resize((i+1,))
+    out[i] = i*i
+    if crash and state is None and i == 5:
+        raise ValueError("crash")
+    checkpoint({'step': i+1})
+""")
+        def check(starts):
+            assert (paper.data['out'][...] == np.arange(10)**2).all()
+            assert sorted(name for name in paper.data
+                          if name.startswith('started')) == starts
+            assert paper.checkpoints() == []
+            assert not paper.is_stale(paper.data_group['out'])
+        assert paper.run_codelet('squares') is not None
+        assert paper.checkpoints() == ['/code/squares']
+        assert paper.is_stale(paper.data_group['out'])
+        assert len(paper.data['out']) == 6
+        # The row written after the last checkpoint is discarded.
+        assert paper.run_codelet('squares', resume=True) is None
+        check(['started_at_0', 'started_at_5'])
+        # A modified input makes the checkpoint invalid.
+        assert paper.run_codelet('squares') is not None
+        time.sleep(0.01)
+        paper.data['crash'][()] = 0
+        assert paper.run_codelet('squares', resume=True) is None
+        check(['started_at_0'])
+        paper.close()
+
+def test_reuse_storage():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w', reuse_storage=True)
+        paper.data['n'] = 10
+        paper.create_calclet("calc",
+"""
+from activepapers.contents import data
+import numpy as np
+n = int(data['n'][()])
+assert 'big' not in data
+big = data.create_dataset('big', shape=(1000, 50), dtype=np.float64)
+big[:n] = 1.
+data['squares'] = np.arange(n)**2
+data.create_dataset('packed', data=np.arange(1000)+n,
+                    compression='gzip', chunks=(100,))
+if n > 5:
+    data['extra'] = np.arange(3)
+""")
+        def offsets():
+            return [paper.data_group[name].id.get_offset()
+                    for name in ['big', 'squares']]
+        assert paper.run_codelet('calc') is None
+        assert 'extra' in paper.data_group
+        before = offsets()
+        paper.data['n'][()] = 2
+        assert paper.run_codelet('calc') is None
+        # The outputs of the same shape are written in place.
+        assert offsets()[0] == before[0]
+        big = paper.data_group['big']
+        assert (big[:2] == 1.).all() and (big[2:] == 0.).all()
+        assert (paper.data_group['squares'][...] == [0, 1]).all()
+        assert (paper.data_group['packed'][...] == np.arange(1000)+2).all()
+        # Outputs that were not created again are gone.
+        assert 'extra' not in paper.data_group
+        assert 'reusable-storage' not in paper.file
+        assert not paper.is_stale(big)
+        # A failing run leaves no slots behind.
+        del paper.data['n']
+        paper.data['n'] = 'x'
+        assert paper.run_codelet('calc') is not None
+        assert 'reusable-storage' not in paper.file
+        assert 'big' not in paper.data_group
+        paper.close()
+
+def test_materialize_dummies():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data['x'] = np.arange(10)
+        paper.create_calclet("calc_a",
+"""
+from activepapers.contents import data
+data['a'] = data['x'][...] + 1
+""")
+        paper.create_calclet("calc_b",
+"""
+from activepapers.contents import data
+data['b'] = 2*data['a'][...]
+""")
+        for codelet in ['calc_a', 'calc_b']:
+            assert paper.run_codelet(codelet) is None
+        def make_dummies():
+            for name in ['/data/a', '/data/b']:
+                paper.replace_by_dummy(name)
+        make_dummies()
+        # Upstream dummies are recomputed first.
+        assert paper.materialization_plan(paper.data_group['b']) \
+               == ['/code/calc_a', '/code/calc_b']
+        assert (paper.data['b'][...] == 2*np.arange(1, 11)).all()
+        assert not paper.is_dummy(paper.data_group['a'])
+        assert not paper.is_dummy(paper.data_group['b'])
+        make_dummies()
+        paper.close()
+        # A read-only paper keeps its dummies, the recomputed
+        # items are stored in a sidecar file.
+        paper = ActivePaper(filename, 'r')
+        b = paper.data['b']
+        assert (b[...] == 2*np.arange(1, 11)).all()
+        t_b = b._node.attrs['ACTIVE_PAPER_TIMESTAMP']
+        assert paper.is_dummy(paper.data_group['b'])
+        paper.close()
+        assert os.path.exists(filename + '.cache')
+        paper = ActivePaper(filename, 'r')
+        assert paper.data['b']._node.attrs['ACTIVE_PAPER_TIMESTAMP'] == t_b
+        paper.close()
+
+def test_slim():
+    from activepapers.cli import slim, slim_plan
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data['x'] = np.arange(100000.)
+        for name, expr in [('big', "2*x"), ('small', "x[:10]"),
+                           ('slow', "4*x")]:
+            paper.create_calclet(name,
+"""
+from activepapers.contents import data
+x = data['x'][...]
+data['%s'] = %s
+""" % (name, expr))
+            assert paper.run_codelet(name) is None
+            assert paper.file['code'][name].attrs['ACTIVE_PAPER_RUNTIME'] > 0
+        for name, runtime in [('big', 1.), ('small', 1.), ('slow', 100.)]:
+            paper.file['code'][name].attrs['ACTIVE_PAPER_RUNTIME'] = runtime
+        assert slim_plan(paper, 0.5)[0] == []
+        names, saved, runtime = slim_plan(paper, 1.5)
+        assert names == ['/data/big']
+        assert saved == 800000 and runtime == 1.
+        assert slim_plan(paper, 2.5)[0] == ['/data/big', '/data/small']
+        paper.close()
+        size = os.path.getsize(filename)
+        slim(filename, 1.5, True, False)
+        assert os.path.getsize(filename) < size - 700000
+        paper = ActivePaper(filename, 'r')
+        assert paper.is_dummy(paper.data_group['big'])
+        assert not paper.is_dummy(paper.data_group['slow'])
+        # The existing dummy counts against the budget.
+        assert slim_plan(paper, 1.5)[0] == []
+        assert (paper.data['big'][...] == 2*np.arange(100000.)).all()
+        paper.close()
+
+def test_array_cache():
+    from activepapers.arraycache import ArrayCache, is_full_read
+    assert is_full_read(Ellipsis) and is_full_read((slice(None), Ellipsis))
+    assert not is_full_read(slice(0, 10)) and not is_full_read(0)
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        cache = ArrayCache(10**6)
+        paper = ActivePaper(filename, 'w', array_cache=cache)
+        paper.data['x'] = np.arange(1000.)
+        for i in range(3):
+            paper.create_calclet("sum%d" % i,
+"""
+from activepapers.contents import data
+x = data['x'][...]
+assert not x.flags.writeable
+data['sum%d'] = x.sum() + x[:%d].sum()
+""" % (i, i))
+            assert paper.run_codelet("sum%d" % i) is None
+        stats = cache.statistics()
+        assert stats['misses'] == 1 and stats['hits'] == 2
+        assert stats['nbytes'] == 8000
+        # Writes invalidate the cached array.
+        paper.data['x'][0] = 1000.
+        assert cache.statistics()['entries'] == 0
+        assert paper.run_codelet("sum0") is None
+        assert paper.data['sum0'][()] == np.arange(1000.).sum() + 1000.
+        # Arrays that don't fit are not cached.
+        small = ArrayCache(1000)
+        assert small.read(paper.data_group['x']).flags.writeable
+        assert small.statistics()['entries'] == 0
+        paper.close()
+
+def test_prefetch():
+    from activepapers.prefetch import Prefetcher, input_datasets, \
+                                      storage_ranges
+    from activepapers.cli import update
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data['x'] = np.arange(1000.)
+        paper.data.create_dataset('y', data=np.arange(1000.), chunks=(100,))
+        for name, script in [('calc_z', "data['z'] = data['x'][...]"),
+                             ('calc_w', "data['w'] = data['y'][...] "
+                                                  "+ data['z'][...]")]:
+            paper.create_calclet(name,
+                                 "from activepapers.contents import data\n"
+                                 + script + "\n")
+            assert paper.run_codelet(name) is None
+        assert sum(size for offset, size
+                   in storage_ranges(paper.data_group['y'])) == 8000
+        assert input_datasets(paper, '/code/calc_w') == ['/data/y', '/data/z']
+        # The outputs of the calclet running before are not prefetched.
+        assert input_datasets(paper, '/code/calc_w', '/code/calc_z') \
+               == ['/data/y']
+        prefetcher = Prefetcher(max_bytes=12000, block_size=1000)
+        prefetcher.prefetch(paper.file, ['/data/x', '/data/y'])
+        prefetcher.wait()
+        assert prefetcher.bytes_read == 12000
+        paper.data['x'][0] = 1.
+        paper.close()
+        update(filename, False, False, prefetch=1)
+        paper = ActivePaper(filename, 'r')
+        assert paper.data['w'][0] == 1.
+        paper.rebuild(os.path.join(t, "clone.ap"), prefetch_bytes=10**6)
+        paper.close()
+
+def test_predicted_dependencies():
+    from activepapers.analysis import analyze, predict, tracked, \
+                                      mismatches, schedule
+    from activepapers.cli import update
+    prediction = analyze("from activepapers.contents import data, open\n"
+                         "import numpy, helpers\n"
+                         "g = data.create_group('g')\n"
+                         "g['a'] = data['x'][...]\n"
+                         "with open('notes.txt', 'w') as f: pass\n"
+                         "data[name] = 1\n")
+    assert prediction.reads == frozenset(['/data/x'])
+    assert prediction.writes == frozenset(['/data/g', '/data/g/a',
+                                           '/data/notes.txt'])
+    assert prediction.modules == frozenset(['numpy', 'helpers'])
+    assert not prediction.complete
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data['x'] = np.arange(10.)
+        paper.add_module('helpers', "def double(x): return 2*x\n")
+        header = "from activepapers.contents import data\n"
+        paper.create_calclet('calc_z', header + "import helpers\n"
+                             "data['z'] = helpers.double(data['x'][...])\n")
+        paper.create_calclet('calc_w', header + "data['w'] = data['z'][...]\n")
+        paper.create_calclet('calc_v', header + "data['v'] = data['x'][...]\n"
+                             "if False: data['u'] = 0\n")
+        paper.create_calclet('calc_t', header + "data['t%d' % 1] = 1\n")
+        assert predict(paper, '/code/calc_z').reads \
+               == frozenset(['/data/x', '/code/python-packages/helpers'])
+        assert tracked(paper, '/code/calc_z') is None
+        assert schedule(paper, ['/code/calc_w', '/code/calc_z',
+                                '/code/calc_v']) \
+               == [['/code/calc_v', '/code/calc_z'], ['/code/calc_w']]
+        # Calclets with incomplete predictions run alone.
+        assert schedule(paper, ['/code/calc_w', '/code/calc_z',
+                                '/code/calc_v', '/code/calc_t']) \
+               == [['/code/calc_v', '/code/calc_z'], ['/code/calc_w'],
+                   ['/code/calc_t']]
+        paper.close()
+        update(filename, False, False, new=True)
+        paper = ActivePaper(filename, 'r')
+        assert (paper.data['w'][...] == 2*np.arange(10.)).all()
+        assert tracked(paper, '/code/calc_z') \
+               == predict(paper, '/code/calc_z')
+        assert mismatches(paper, '/code/calc_w') \
+               == dict(unpredicted_reads=[], unused_reads=[],
+                       unpredicted_writes=[], unused_writes=[],
+                       complete=True)
+        assert mismatches(paper, '/code/calc_v')['unused_writes'] \
+               == ['/data/u']
+        paper.close()
+
+def test_parameter_sweep():
+    from activepapers.cli import update
+    from activepapers.utility import owner, mod_time
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data['x'] = np.arange(5.)
+        paper.data['params'] = np.array([(1., 0), (2., 1), (3., 2)],
+                                        dtype=[('scale', float),
+                                               ('offset', int)])
+        paper.create_calclet('sweep',
+                             "from activepapers.contents import data, "
+                             "output, parameters\n"
+                             "output['y'] = parameters['scale']"
+                             "*data['x'][...] + parameters['offset']\n",
+                             parameters='params')
+        assert paper.stale_rows('/code/sweep') == [0, 1, 2]
+        assert paper.run_codelet('sweep') is None
+        for row, (scale, offset) in enumerate([(1., 0), (2., 1), (3., 2)]):
+            y = paper.data['sweep/%d/y' % row]
+            assert (y[...] == scale*np.arange(5.) + offset).all()
+            assert owner(y._node) == '/code/sweep'
+            assert '/data/params' in \
+                   [ascii(d) for d in
+                    y._node.attrs['ACTIVE_PAPER_DEPENDENCIES']]
+        assert paper.stale_rows('/code/sweep') == []
+        t0 = mod_time(paper.file['/data/sweep/0/y'])
+        # Changing one row makes only its outputs stale.
+        paper.data['params'][1] = (5., 0)
+        assert paper.stale_rows('/code/sweep') == [1]
+        paper.close()
+        # "aptool ls -l" marks the same outputs as stale.
+        import io, sys
+        from activepapers.cli import ls
+        stdout = sys.stdout
+        sys.stdout = io.StringIO()
+        try:
+            ls(filename, True, None, [])
+            listing = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        assert [line.split()[2][1:] for line in listing.splitlines()
+                if line.split()[2].startswith('*')] == ['data/sweep/1/y']
+        update(filename, False, False)
+        paper = ActivePaper(filename, 'r')
+        assert (paper.data['sweep/1/y'][...] == 5*np.arange(5.)).all()
+        assert mod_time(paper.file['/data/sweep/0/y']) == t0
+        paper.close()
+        # Removed rows lose their outputs.
+        paper = ActivePaper(filename, 'r+')
+        del paper.data['params']
+        paper.data['params'] = np.array([(1., 0)],
+                                        dtype=[('scale', float),
+                                               ('offset', int)])
+        assert paper.stale_rows('/code/sweep') == []
+        assert paper.run_codelet('sweep') is None
+        assert sorted(paper.data['sweep']) == ['0']
+        paper.close()
+
+def test_preview():
+    from activepapers.preview import PreviewPaper, sample_rows
+    assert sample_rows(10, 0.3) == slice(0, 9, 3)
+    assert len(sample_rows(10, 0.3, 'random')) == 3
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data['x'] = np.arange(100.)
+        paper.data['scale'] = 2.
+        paper.create_calclet('calc',
+                             "from activepapers.contents import data\n"
+                             "x = data['x']\n"
+                             "data['n'] = len(x)\n"
+                             "data['y'] = data['scale'][...]*x[...]\n"
+                             "data['z'] = 2*data['y'][...]\n")
+        paper.close()
+        size = os.path.getsize(filename)
+        paper = PreviewPaper(filename, 0.1)
+        assert paper.run_codelet('calc') is None
+        assert paper.data['n'][...] == 10
+        assert (paper.upper['data/y'][...] == 2*np.arange(0., 100., 10.)).all()
+        # Outputs written during the preview are not sampled.
+        assert len(paper.upper['data/z']) == 10
+        assert sorted(ds.name for ds in paper.outputs()) \
+               == ['/data/n', '/data/y', '/data/z']
+        paper.close()
+        assert os.path.getsize(filename) == size
+        paper = ActivePaper(filename, 'r')
+        assert 'y' not in paper.data
+        paper.close()
+
+def test_in_memory_paper():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(None, 'w', in_memory=True)
+        paper.data['x'] = np.arange(10.)
+        paper.create_calclet('calc',
+                             "from activepapers.contents import data\n"
+                             "data['y'] = 2*data['x'][...]\n")
+        assert paper.run_codelet('calc') is None
+        paper.save_as(filename)
+        paper.close()
+        assert os.listdir(t) == ["paper.ap"]
+        # An existing paper, modified in memory only
+        size = os.path.getsize(filename)
+        paper = ActivePaper(filename, 'r+', in_memory=True)
+        assert (paper.data['y'][...] == 2*np.arange(10.)).all()
+        paper.data['x'][0] = 1.
+        paper.close()
+        assert os.path.getsize(filename) == size
+        paper = ActivePaper(filename, 'r')
+        assert paper.data['x'][0] == 0.
+        # Rebuilding into an in-memory paper
+        clone = ActivePaper(None, 'w', in_memory=True)
+        paper.rebuild(clone)
+        assert (clone.data['y'][...] == paper.data['y'][...]).all()
+        clone.close()
+        paper.close()
+        # Write-back on close
+        paper = ActivePaper(filename, 'r+', in_memory=True, write_back=True)
+        paper.data['x'][0] = 1.
+        paper.close()
+        paper = ActivePaper(filename, 'r')
+        assert paper.data['x'][0] == 1.
+        # The session discarded above left no trace.
+        assert len(paper.file['history']) == 2
+        paper.close()
+        assert sorted(os.listdir(t)) == ["paper.ap"]
+
+def test_overlay():
+    import activepapers.overlay
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        overlay = os.path.join(t, "overlay.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data['x'] = np.arange(10.)
+        paper.data['big'] = np.zeros((100000,))
+        paper.create_calclet('calc',
+                             "from activepapers.contents import data\n"
+                             "data['y'] = 2*data['x'][...]\n")
+        assert paper.run_codelet('calc') is None
+        paper.close()
+        size = os.path.getsize(filename)
+        activepapers.overlay.create(filename, overlay)
+        paper = activepapers.overlay.OverlayPaper(overlay)
+        # Datasets are copied to the overlay by any modification.
+        paper.data['x'].attrs['unit'] = 'm'
+        assert 'x' in paper.upper['data']
+        paper.data['x'][0] = 1.
+        item = paper.get_node('/data/y')
+        assert paper.is_stale(item)
+        del item
+        assert paper.run_codelet('calc') is None
+        assert paper.data['y'][0] == 2.
+        del paper.root['/data/big']
+        assert sorted(paper.data) == ['x', 'y']
+        assert paper.changes() == (['/data/x', '/data/y'], ['/data/big'])
+        paper.close()
+        # Only the modified datasets are stored in the overlay,
+        # and the paper is unchanged.
+        assert os.path.getsize(overlay) < size/10
+        assert os.path.getsize(filename) == size
+        paper = activepapers.overlay.OverlayPaper(overlay)
+        assert paper.data['y'][0] == 2.
+        assert 'big' not in paper.data
+        paper.close()
+        paper = ActivePaper(filename, 'r')
+        assert paper.data['y'][0] == 0.
+        assert 'unit' not in paper.data['x'].attrs
+        assert 'big' in paper.data
+        paper.close()
+        assert sorted(activepapers.overlay.commit(overlay)) \
+               == ['/data/x', '/data/y']
+        assert sorted(os.listdir(t)) == ["paper.ap"]
+        paper = ActivePaper(filename, 'r')
+        assert paper.data['y'][0] == 2.
+        assert sorted(paper.data) == ['x', 'y']
+        paper.close()
+        # write_direct copies datasets to the overlay as well.
+        activepapers.overlay.create(filename, overlay)
+        paper = activepapers.overlay.OverlayPaper(overlay)
+        paper.data['x'].write_direct(np.zeros((10,)))
+        assert paper.changes() == (['/data/x'], [])
+        assert paper.data['x'][1] == 0.
+        paper.close()
+        activepapers.overlay.discard(overlay)
+        paper = ActivePaper(filename, 'r')
+        assert paper.data['x'][1] == 1.
+        paper.close()
+        # Overlays become invalid when the paper changes.
+        activepapers.overlay.create(filename, overlay)
+        paper = ActivePaper(filename, 'r+')
+        paper.data['z'] = 1.
+        paper.close()
+        try:
+            activepapers.overlay.OverlayPaper(overlay)
+            assert False
+        except ValueError:
+            pass
+        activepapers.overlay.discard(overlay)
+        assert sorted(os.listdir(t)) == ["paper.ap"]
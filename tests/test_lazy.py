@@ -0,0 +1,55 @@
+# Test lazy array expressions
+
+import os
+import numpy as np
+import h5py
+import tempdir
+from activepapers.storage import ActivePaper
+from activepapers import lazy
+
+def test_expressions():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "test.h5")
+        a = np.arange(3000.).reshape((1000, 3))
+        b = np.array([1., 2., 3.])
+        with h5py.File(filename, 'w') as f:
+            x = lazy.wrap(f.create_dataset('a', data=a, chunks=(64, 3)))
+            y = lazy.wrap(f.create_dataset('b', data=b))
+            expr = np.sqrt(2*x + y) - x/y
+            assert expr.shape == (1000, 3)
+            assert expr.dtype == np.float64
+            expected = np.sqrt(2*a + b) - a/b
+            assert np.allclose(expr.compute(), expected)
+            assert np.allclose(expr.compute(workers=3), expected)
+            assert np.allclose(expr.sum(), expected.sum())
+            assert np.allclose(expr.max(axis=0), expected.max(axis=0))
+            assert np.allclose(expr.mean(axis=1).compute(),
+                               expected.mean(axis=1))
+            assert (x > 10).dtype == np.bool_
+            assert (x > 10).sum() == (a > 10).sum()
+            assert (-x).astype(np.int32).compute().dtype == np.int32
+            assert (1 + lazy.wrap(2)).compute() == 3
+
+def test_store_in_calclet():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data.create_dataset('x', data=np.arange(10000.), chunks=(500,))
+        paper.data.create_dataset('unused', data=0)
+        script = paper.create_calclet("script",
+"""
+from activepapers.contents import data, lazy
+import numpy as np
+x = lazy(data['x'])
+y = (np.sin(x)**2 + np.cos(x)**2) * x
+y.store(data, 'y', workers=2, chunks=(1000,))
+data['total'] = x.sum()
+""")
+        script.run()
+        y = paper.data['y']
+        assert y.chunks == (1000,)
+        assert np.allclose(y[...], np.arange(10000.))
+        assert paper.data['total'][...] == np.arange(10000.).sum()
+        deps = [item.name for item in paper.iter_dependencies(y._node)]
+        assert sorted(deps) == ['/code/script', '/data/x']
+        paper.close()
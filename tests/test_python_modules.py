@@ -1,5 +1,7 @@
 import os
 import sys
+import threading
+import time
 import tempdir
 from nose.tools import raises
 from activepapers.storage import ActivePaper
@@ -102,3 +104,36 @@ import ctypes
 """)
         script.run()
         paper.close()
+
+def test_concurrent_codelets():
+    # Codelets of different papers run at the same time in different
+    # threads, each one seeing its own activepapers.contents and modules.
+    delay = 0.5
+    with tempdir.TempDir() as t:
+        papers = []
+        for value in [1, 2]:
+            paper = ActivePaper(os.path.join(t, "paper%d.ap" % value), "w")
+            paper.add_module("some_values", "a_value = %d\n" % value)
+            paper.create_importlet("wait",
+"""
+import time
+from activepapers.contents import data
+import some_values
+time.sleep(%f)
+data['a_value'] = some_values.a_value
+""" % delay)
+            papers.append(paper)
+        threads = [threading.Thread(target=paper.run_codelet,
+                                    args=('wait',))
+                   for paper in papers]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        assert elapsed < 1.8*delay
+        for value, paper in zip([1, 2], papers):
+            assert paper.data['a_value'][...] == value
+            assert 'some_values' not in sys.modules
+            paper.close()
@@ -0,0 +1,88 @@
+# Test layered papers and isolated execution of codelets
+
+import os
+import numpy as np
+import h5py
+import tempdir
+from activepapers.storage import ActivePaper
+from activepapers.layers import LayeredPaper
+from activepapers.workers import WorkerPool
+
+def make_paper(filename):
+    paper = ActivePaper(filename, 'w')
+    paper.data['x'] = np.arange(10.)
+    paper.data.create_group('group')
+    paper.data['group/y'] = 1.
+    paper.create_calclet("script",
+"""
+from activepapers.contents import data, open
+data['z'] = 2*data['x'][...]
+data['group']['w'] = data['group/y'][...] + 1
+with open('log.txt', 'w') as f:
+    f.write('done')
+""")
+    paper.close()
+
+def test_layered_paper():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        make_paper(filename)
+        paper = LayeredPaper(filename)
+        assert paper.run_codelet('script') is None
+        assert sorted(paper.data) == ['group', 'log.txt', 'x', 'z']
+        assert sorted(paper.data['group']) == ['w', 'y']
+        assert paper.data['group/w'][...] == 2.
+        # Nothing but the new items is in the upper layer
+        assert 'x' not in paper.upper['data']
+        assert 'y' not in paper.upper['data/group']
+        paper.close()
+        paper = ActivePaper(filename, 'r')
+        assert 'z' not in paper.data
+        paper.close()
+
+def test_isolated_run():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        make_paper(filename)
+        pool = WorkerPool()
+        try:
+            paper = ActivePaper(filename, 'r+')
+            for i in range(2):
+                assert pool.run_codelet(paper, 'script') is None
+            assert (paper.data['z'][...] == 2*np.arange(10.)).all()
+            assert paper.data['group/w'][...] == 2.
+            assert paper.open_internal_file('data/log.txt').read() == 'done'
+            z = paper.data['z']._node
+            deps = [item.name for item in paper.iter_dependencies(z)]
+            assert sorted(deps) == ['/code/script', '/data/x']
+            assert not paper.is_stale(z)
+            # The runtime is needed by "aptool slim".
+            assert 'ACTIVE_PAPER_RUNTIME' in paper.file['code/script'].attrs
+            paper.create_calclet("failure", "raise ValueError('test')")
+            error = pool.run_codelet(paper, 'failure')
+            assert "ValueError: test" in error
+            # A failure outside of a codelet affects only that codelet.
+            errors = pool.run_codelets(paper, ['script', 'missing'])
+            assert errors[0] is None
+            assert "KeyError" in errors[1]
+            assert (paper.data['z'][...] == 2*np.arange(10.)).all()
+            paper.close()
+        finally:
+            pool.close()
+
+def test_parallel_parameter_sweep():
+    with tempdir.TempDir() as t:
+        filename = os.path.join(t, "paper.ap")
+        paper = ActivePaper(filename, 'w')
+        paper.data['n'] = np.arange(4)
+        paper.create_calclet("sweep",
+"""
+from activepapers.contents import output, parameters
+output['square'] = parameters*parameters
+""", parameters='n')
+        errors = paper.run_sweep('sweep', processes=2)
+        assert errors == {0: None, 1: None, 2: None, 3: None}
+        assert [paper.data['sweep/%d/square' % i][...] for i in range(4)] \
+               == [0, 1, 4, 9]
+        assert paper.stale_rows('/code/sweep') == []
+        paper.close()